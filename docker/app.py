@@ -1,24 +1,50 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, make_response, get_flashed_messages, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, make_response, get_flashed_messages, request, jsonify, send_from_directory, g, has_request_context
 import requests
+from collections import OrderedDict, deque
 from functools import wraps
-from mailjet_rest import Client
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
-from argon2 import PasswordHasher
+from argon2 import PasswordHasher, extract_parameters
 from argon2.exceptions import VerifyMismatchError
 from authlib.integrations.flask_client import OAuth
 import json, subprocess, secrets
+import codecs
+import atexit
+import gzip
+import hashlib
+import heapq
+import hmac
+import mmap
 import os
+import pickle
 import random
+import threading
 import re
 import shutil
+import smtplib
+import sqlite3
+import stat
+import struct
+import tempfile
+import time
+import zlib
 from PIL import Image
 from pathlib import Path
 from dotenv import load_dotenv, set_key
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from email.message import EmailMessage
+from email.utils import formataddr
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
 dotenv_path = os.path.join(os.path.dirname(__file__), './data/.env') # Load the .env file from the specified path
 load_dotenv(dotenv_path)
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, file locking is skipped there
+    fcntl = None
 
 import python_avatars
 
@@ -33,39 +59,254 @@ app.config['DATA'] = "./data"  # Directory where files are stored
 app.config['IDEAS_FILE'] = Path(app.config['DATA'], 'ideas.json')
 app.config['USERS_FILE'] = Path(app.config['DATA'], 'users.json')
 app.config['AVATAR_DIR'] = Path(app.config['DATA'], 'avatars')
+app.config['DATABASE_FILE'] = Path(app.config['DATA'], 'giftmanager.db')
+app.config['JOURNAL_DIR'] = Path(app.config['DATA'], 'journal')
+app.config['LOCK_FILE'] = Path(app.config['DATA'], '.lock')
+app.config['GENERATION_FILE'] = Path(app.config['DATA'], '.generation')
+app.config['SEQUENCE_FILE'] = Path(app.config['DATA'], '.idea_sequence')
+app.config['OG_CACHE_FILE'] = Path(app.config['DATA'], 'og_cache.json')
+app.config['OG_CACHE_LOCK_FILE'] = Path(app.config['DATA'], '.og_cache.lock')
+app.config['ARCHIVE_DIR'] = Path(app.config['DATA'], 'archive')
+app.config['OUTBOX_FILE'] = Path(app.config['DATA'], 'outbox.json')
+app.config['OUTBOX_SENT_DIR'] = Path(app.config['DATA'], 'outbox_sent')
+app.config['SCHEDULER_LOCK_FILE'] = Path(app.config['DATA'], '.scheduler.lock')
+app.config['SCHEDULER_STATE_FILE'] = Path(app.config['DATA'], 'scheduler.json')
 
 app.config['AVATAR_CLAIM_TIMEOUT'] = 3600 # in seconds
 
-mailjet_api_key = os.getenv("MAILJET_API_KEY")
-mailjet_api_secret = os.getenv("MAILJET_API_SECRET")
-mailjet = Client(auth=(mailjet_api_key, mailjet_api_secret), version='v3.1')
-ph = PasswordHasher()
+DEFAULT_PASSWORD_HASHER = PasswordHasher()
+ph = DEFAULT_PASSWORD_HASHER  # Replaced by password_hasher() when the argon2 settings change
 
 
-def read_env_variable(key, default=None):
-    """Read environment variable from .env file with proper defaults"""
-    # Define the path here to avoid the default parameter issue
-    env_path = dotenv_path
-    
-    try:
-        with open(env_path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    current_key, value = line.split('=', 1)
-                    if current_key.strip() == key:
+class Settings:
+    """Parsed view of the .env file.
+
+    The file is parsed once and re-parsed only when its mtime or size changes,
+    which is checked at most every max_age seconds, so reading a setting is a
+    dictionary lookup. set() writes through to the file and updates the parsed
+    values in place. Keys missing from the file fall back to the process
+    environment.
+    """
+
+    def __init__(self, path, max_age=1.0):
+        self.path = path
+        self.max_age = max_age
+        self._values = {}
+        self._signature = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def _parse(self):
+        values = {}
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    line = line.strip()
+                    if line and not line.startswith('#') and '=' in line:
+                        key, value = line.split('=', 1)
                         value = value.strip()
                         # Remove quotes
                         if value and ((value[0] == '"' and value[-1] == '"') or (value[0] == "'" and value[-1] == "'")):
                             value = value[1:-1]
-                        return value if value else default
-    except FileNotFoundError:
-        pass  # .env file doesn't exist, that's okay
-    except Exception as e:
-        print(f"Error reading .env file: {e}")
-    
-    # Fallback to system environment
-    return os.getenv(key, default)
+                        # The first occurrence of a key wins
+                        values.setdefault(key.strip(), value)
+        except FileNotFoundError:
+            pass  # .env file doesn't exist, that's okay
+        except Exception as e:
+            print(f"Error reading .env file: {e}")
+        return values
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.max_age:
+            return self._values
+        with self._lock:
+            signature = self._stat()
+            if signature != self._signature or self._checked_at is None:
+                self._values = self._parse()
+                self._signature = signature
+            self._checked_at = now
+        return self._values
+
+    def get(self, key, default=None):
+        values = self._refresh()
+        if key in values:
+            return values[key] or default
+        return os.getenv(key, default)
+
+    def get_bool(self, key, default=False):
+        value = self.get(key)
+        return default if value is None else value.lower() == 'true'
+
+    def get_int(self, key, default=0):
+        try:
+            return int(self.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    def invalidate(self):
+        """Check the .env file for changes on the next access."""
+        self._checked_at = None
+
+    def set(self, key, value):
+        """Write key to the .env file and update the parsed values in place."""
+        value = str(value)
+        with self._lock:
+            set_key(self.path, key, value)
+            values = dict(self._values)
+            values[key] = value
+            self._values = values
+            self._signature = self._stat()
+            self._checked_at = time.monotonic()
+
+
+settings = Settings(dotenv_path)
+
+
+def read_env_variable(key, default=None):
+    """Read environment variable from .env file with proper defaults"""
+    return settings.get(key, default)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of contacting a host that failed too often in a row."""
+
+
+class ResponseTooLarge(requests.exceptions.RequestException):
+    """Raised when a response body exceeds the size the client accepts."""
+
+
+class OutboundHttpClient:
+    """Client for calls to other servers (OG image pages, Mailjet, the OIDC provider).
+
+    One pooled requests.Session per process keeps connections to each host
+    alive. Every request gets connect/read timeouts, a total deadline for
+    reading the body and a maximum body size. Idempotent requests are retried
+    with exponential backoff on connection errors and 502/503/504 answers.
+    Once a host failed failure_threshold times in a row its circuit opens and
+    requests to it fail fast for reset_after seconds. After that the circuit
+    is half-open: a single probe request is let through while the others keep
+    failing fast, and its outcome closes the circuit or opens it again.
+    Failure counts are kept for at most max_hosts hosts, the least recently
+    failing ones are forgotten first.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=10, total_timeout=30, max_bytes=5 * 1024 * 1024,
+                 retries=2, backoff=0.5, failure_threshold=5, reset_after=60, pool_size=10,
+                 max_hosts=256):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.pool_size = pool_size
+        self.max_hosts = max_hosts
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # host -> (consecutive failures, time the circuit opened, time the probe started)
+        self._failures = OrderedDict()
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                retry = Retry(total=self.retries, backoff_factor=self.backoff,
+                              status_forcelist=(502, 503, 504), raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def _check_circuit(self, host):
+        with self._lock:
+            failures, opened_at, probe_started = self._failures.get(host, (0, None, None))
+            if opened_at is None:
+                return
+            now = time.monotonic()
+            if now - opened_at < self.reset_after:
+                raise CircuitOpenError(f"{host} failed {failures} times in a row, not contacting it for now")
+            # Half-open: only one probe at a time, a probe that never reported back is replaced after reset_after
+            if probe_started is not None and now - probe_started < self.reset_after:
+                raise CircuitOpenError(f"{host} failed {failures} times in a row, waiting for a probe request")
+            self._failures[host] = (failures, opened_at, now)
+
+    def _record(self, host, success):
+        with self._lock:
+            if success:
+                self._failures.pop(host, None)
+                return
+            failures, opened_at, probe_started = self._failures.pop(host, (0, None, None))
+            failures += 1
+            if probe_started is not None or failures >= self.failure_threshold:
+                opened_at = time.monotonic()
+            self._failures[host] = (failures, opened_at, None)
+            while len(self._failures) > self.max_hosts:
+                self._failures.popitem(last=False)
+
+    @contextmanager
+    def stream(self, method, url, **kwargs):
+        """Send a request and yield the response with its body still unread, see iter_body()."""
+        host = urlsplit(url).netloc
+        self._check_circuit(host)
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        try:
+            response = self._get_session().request(method, url, stream=True, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record(host, False)
+            raise
+        self._record(host, response.status_code < 500)
+        response.deadline = time.monotonic() + self.total_timeout
+        try:
+            yield response
+        finally:
+            response.close()
+
+    def iter_body(self, response, chunk_size=16 * 1024):
+        """Iterate over the body of a streamed response within the deadline and size limit."""
+        host = urlsplit(response.url).netloc
+        received = 0
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                received += len(chunk)
+                if received > self.max_bytes:
+                    raise ResponseTooLarge(f"Response from {host} is larger than {self.max_bytes} bytes")
+                if time.monotonic() > response.deadline:
+                    raise requests.exceptions.Timeout(f"Reading the response from {host} took longer than {self.total_timeout}s")
+                yield chunk
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self._record(host, False)
+            raise
+
+    def request(self, method, url, **kwargs):
+        """Send a request and read the whole body (within the deadline and size limit)."""
+        with self.stream(method, url, **kwargs) as response:
+            response._content = b''.join(self.iter_body(response))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+http_client = OutboundHttpClient()
+# Pages users link to get their own client, so failing hosts there can never
+# crowd the OIDC provider or Mailjet out of the circuit breaker
+og_http_client = OutboundHttpClient()
 
 
 def prepopulate_file(filename: str, data: str):
@@ -113,6 +354,26 @@ LOGIN_PAGE_MESSAGE='No account? Contact a family member to create an account!'
 ENABLE_DEFAULT_LOGIN='true'
 REORDERING='true'
 IMGENABLED='false'
+STORAGE_BACKEND='json'
+GROUP_COMMIT_MS='0'
+PASSWORD_WORKERS=''
+PASSWORD_QUEUE_LIMIT=''
+LOGIN_THROTTLE='true'
+LOGIN_IP_ATTEMPTS_PER_MINUTE='20'
+LOGIN_USER_ATTEMPTS_PER_MINUTE='5'
+PASSWORD_HASH_BUDGET_MS='250'
+PASSWORD_HASH_MEASURED_MS=''
+EMAIL_TRANSPORT='mailjet'
+SMTP_HOST=''
+SMTP_PORT='587'
+SMTP_USERNAME=''
+SMTP_PASSWORD=''
+SMTP_STARTTLS='true'
+PURGE_INTERVAL_MINUTES='1440'
+AVATAR_GC_INTERVAL_MINUTES='60'
+OUTBOX_INTERVAL_MINUTES='1'
+CACHE_COMPACT_INTERVAL_MINUTES='60'
+JOURNAL_COMPACT_INTERVAL_MINUTES='60'
                  
 """)
 
@@ -125,21 +386,1697 @@ except FileExistsError:
 for i in range(1, 9):
     shutil.copy(Path("static", "icons",f"avatar{i}.png"), Path(app.config['AVATAR_DIR'], f"avatar{i}.png"))
 
+class DocumentCache:
+    """Keeps parsed JSON documents in memory until their signature changes.
+
+    Each entry is keyed by the storage location and remembers the signature it
+    was loaded with: the (mtime, size, inode) of a JSON file, or the write
+    generation of a SQLite table. Callers get their own copy of the document
+    (unpickled from a snapshot, which is much cheaper than re-parsing the JSON),
+    so routes can keep mutating what load_users()/load_gift_ideas() return.
+
+    Entries also remember the shared write generation they were validated at.
+    While that generation is unchanged, is_fresh() skips validating the
+    signature for up to max_age seconds, which still picks up edits made by hand.
+
+    Structures derived from a document (indexes, lookup maps) are built once per
+    entry with derive(). When the document changes they are carried over to the
+    new entry, so derive() can update the latest one instead of rebuilding it.
+    A save that passes the records it touched has structures with an
+    applied(changes) method brought up to date right away.
+    """
+
+    class Entry:
+        __slots__ = ('signature', 'snapshot', 'generation', 'checked_at', 'derived', 'previous')
+
+        def __init__(self, signature, snapshot, generation, derived=None, previous=None):
+            self.signature = signature
+            self.snapshot = snapshot
+            self.generation = generation
+            self.checked_at = time.monotonic()
+            self.derived = derived if derived is not None else {}
+            self.previous = previous
+
+    def __init__(self, max_age=1.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def is_fresh(self, key, generation):
+        entry = self._entries.get(str(key))
+        return entry is not None and entry.generation == generation and time.monotonic() - entry.checked_at <= self.max_age
+
+    def validate(self, key, signature, generation=None):
+        """Check an entry against the signature of its source and mark it as checked."""
+        entry = self._entries.get(str(key))
+        if entry is None or entry.signature != signature:
+            return False
+        with self._lock:
+            self._entries[str(key)] = self.Entry(signature, entry.snapshot, generation, entry.derived, entry.previous)
+        return True
+
+    def put(self, key, signature, document, generation=None, changes=None, base=None):
+        """Store document, changes (RecordChanges) are what a save changed in the version with signature base."""
+        snapshot = pickle.dumps(document, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            previous = self._entries.get(str(key))
+            derived, carried = {}, None
+            if previous is not None:
+                # Keep the latest version of every derived structure so it can be updated incrementally
+                carried = {**(previous.previous or {}), **previous.derived}
+                if changes is not None and previous.signature == base:
+                    for name, structure in previous.derived.items():
+                        if hasattr(structure, 'applied'):
+                            derived[name] = structure.applied(changes)
+            self._entries[str(key)] = self.Entry(signature, snapshot, generation, derived, carried)
+
+    def copy(self, key):
+        return pickle.loads(self._entries[str(key)].snapshot)
+
+    def signature(self, key):
+        entry = self._entries.get(str(key))
+        return entry.signature if entry is not None else None
+
+    def derive(self, key, name, build, update=None):
+        """Return the structure called name built from the document at key.
+
+        build(document) creates it from scratch; update(previous, document), if
+        given, creates it from the structure derived from the previous version.
+        Both get a private copy of the document.
+        """
+        entry = self._entries[str(key)]
+        derived = entry.derived.get(name)
+        if derived is None:
+            document = pickle.loads(entry.snapshot)
+            previous = entry.previous.get(name) if entry.previous else None
+            derived = update(previous, document) if update and previous is not None else build(document)
+            entry.derived[name] = derived
+        return derived
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(key), None)
+
+document_cache = DocumentCache()
+
+
+def file_signature(path):
+    file_stat = os.stat(path)
+    return (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+
+
+def atomic_write_json(path, document, indent=None):
+    """Write document to path through a temporary file, fsync and rename.
+
+    Readers either see the previous file or the new one, never a partially
+    written one, and a crash mid-write leaves the previous file intact.
+    """
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(document, file, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        if path.exists():
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # Make the rename itself durable
+    try:
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+class SharedGenerations:
+    """Write generation counters shared by all worker processes.
+
+    The counters live in a small file mapped into memory with mmap, so checking
+    whether another worker has written since the last load is a memory read
+    instead of a stat() or a query. Counters are only bumped while holding the
+    process file lock.
+    """
+
+    SLOTS = ('users', 'ideas')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._map = None
+
+    def _mapping(self):
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    self.path.parent.mkdir(exist_ok=True, parents=True)
+                    size = 8 * len(self.SLOTS)
+                    with open(self.path, 'a+b') as file:
+                        if os.fstat(file.fileno()).st_size < size:
+                            file.truncate(size)
+                        # MAP_SHARED mapping, stays shared with workers forked after it is created
+                        self._map = mmap.mmap(file.fileno(), size)
+        return self._map
+
+    def read(self, slot):
+        return struct.unpack_from('<Q', self._mapping(), 8 * self.SLOTS.index(slot))[0]
+
+    def bump(self, slot):
+        generation = self.read(slot) + 1
+        struct.pack_into('<Q', self._mapping(), 8 * self.SLOTS.index(slot), generation)
+        return generation
+
+
+class ReadWriteLock:
+    """In-process readers/writer lock. Waiting writers block new readers."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+
+class ProcessFileLock:
+    """Exclusive fcntl lock on a file, held on behalf of the whole process.
+
+    Threads of this process share the lock: it is taken when the first holder
+    acquires it and released when the last one releases it. Exclusion between
+    threads is the job of the in-process locks.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._mutex = threading.Lock()
+        self._holders = 0
+        self._file = None
+        self._pid = None
+
+    def acquire(self):
+        with self._mutex:
+            if self._pid != os.getpid():
+                # A forked child must not share the parent's open file description,
+                # flock() would treat both processes as the same lock owner
+                self.path.parent.mkdir(exist_ok=True, parents=True)
+                self._file = open(self.path, 'a+')
+                self._pid = os.getpid()
+                self._holders = 0
+            if self._holders == 0:
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._holders += 1
+
+    def release(self):
+        with self._mutex:
+            self._holders -= 1
+            if self._holders == 0 and fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class GroupCommitWriter:
+    """Coalesces saves that arrive within a short window into a single write.
+
+    submit() queues the latest version of a document and returns a callable
+    that blocks until a write including that version is on disk. The first
+    submitter of a batch is the leader: its wait sleeps for the window, then
+    writes every pending document once. The process lock is held from the
+    first queued save until the batch is written, so other processes cannot
+    read the file while it is behind. With a window of 0 submit() writes
+    immediately.
+    """
+
+    def __init__(self, window, lock=None):
+        self.window = window
+        self.lock = lock
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._writing = {}
+        self._submitted = 0
+        self._durable = 0
+        self._flushing = False
+        self._failures = []
+
+    def has_pending(self, key):
+        return str(key) in self._pending or str(key) in self._writing
+
+    def pending(self, key):
+        """Return a copy of the not yet written version of key, if there is one."""
+        with self._condition:
+            entry = self._pending.get(str(key)) or self._writing.get(str(key))
+            if entry is None:
+                return None
+            return pickle.loads(pickle.dumps(entry[1], pickle.HIGHEST_PROTOCOL))
+
+    def submit(self, key, write, document):
+        if self.window <= 0:
+            write(key, document)
+            return lambda: None
+
+        with self._condition:
+            self._pending[str(key)] = (write, document, key)
+            self._submitted += 1
+            ticket = self._submitted
+            leader = not self._flushing
+            if leader:
+                self._flushing = True
+                if self.lock is not None:
+                    self.lock.acquire()
+
+        return lambda: self._wait(ticket, leader)
+
+    def _wait(self, ticket, leader):
+        if leader:
+            time.sleep(self.window)
+            try:
+                self._flush()
+            finally:
+                if self.lock is not None:
+                    self.lock.release()
+
+        with self._condition:
+            while self._durable < ticket:
+                self._condition.wait()
+            for low, high, error in self._failures:
+                if low < ticket <= high:
+                    raise error
+
+    def _flush(self):
+        while True:
+            with self._condition:
+                batch = self._writing = self._pending
+                self._pending = {}
+                low, high = self._durable, self._submitted
+                if not batch:
+                    self._flushing = False
+                    return
+
+            error = None
+            for write, document, key in batch.values():
+                try:
+                    write(key, document)
+                except Exception as e:
+                    print(f"Error writing {key}: {e}")
+                    error = e
+
+            with self._condition:
+                if error is not None:
+                    self._failures = self._failures[-15:] + [(low, high, error)]
+                self._writing = {}
+                self._durable = high
+                self._condition.notify_all()
+
+
+def wait_all(waits):
+    """Call every durability wait, then re-raise the first error."""
+    errors = []
+    for wait in waits:
+        try:
+            wait()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+class RecordChanges:
+    """The rows a save touched: records added or updated by key, and deleted keys.
+
+    reordered is set when the document order changed other than by appending
+    new records at the end, e.g. after the user dragged ideas around.
+    """
+
+    KEYS = {'ideas': 'gift_idea_id', 'users': 'username'}
+
+    def __init__(self, upserted=None, deleted=None, reordered=False):
+        self.upserted = upserted if upserted is not None else {}
+        self.deleted = deleted if deleted is not None else []
+        self.reordered = reordered
+
+    def __bool__(self):
+        return bool(self.upserted or self.deleted or self.reordered)
+
+    @classmethod
+    def between(cls, slot, old, new):
+        """Diff two versions of a document in memory."""
+        key_field = cls.KEYS[slot]
+        old_records = {record[key_field]: record for record in old}
+        # The last of several records with the same key wins
+        new_records = {record[key_field]: record for record in new}
+        upserted = {key: record for key, record in new_records.items() if old_records.get(key) != record}
+        deleted = [key for key in old_records if key not in new_records]
+        expected = [key for key in old_records if key in new_records] + [key for key in new_records if key not in old_records]
+        return cls(upserted, deleted, list(new_records) != expected)
+
+
+class JsonStorage:
+    """Stores gift ideas and users in the ideas.json/users.json documents."""
+
+    name = 'json'
+
+    def __init__(self, ideas_file, users_file, sequence_file, cache, writer, generations):
+        self.ideas_file = Path(ideas_file)
+        self.users_file = Path(users_file)
+        self.sequence_file = Path(sequence_file)
+        self.cache = cache
+        self.writer = writer
+        self.generations = generations
+        self.slots = {str(self.ideas_file): 'ideas', str(self.users_file): 'users'}
+
+    def refresh(self, slot):
+        """Bring the cache entry of slot up to date and return its key.
+
+        Returns None while a save of slot waits for its group commit, the
+        cache entry is older than that save.
+        """
+        path = self.ideas_file if slot == 'ideas' else self.users_file
+        if self.writer.has_pending(path):
+            return None
+
+        generation = self.generations.read(slot)
+        if not self.cache.is_fresh(path, generation):
+            signature = file_signature(path)
+            if not self.cache.validate(path, signature, generation):
+                with open(path, 'r') as file:
+                    document = json.load(file)
+                self.cache.put(path, signature, document, generation)
+        return path
+
+    def _load(self, path):
+        while True:
+            # A save waiting for its group commit is newer than the file on disk
+            document = self.writer.pending(path)
+            if document is not None:
+                return document
+            key = self.refresh(self.slots[str(path)])
+            if key is not None:
+                return self.cache.copy(key)
+
+    def _write(self, path, document):
+        slot = self.slots[str(path)]
+        base = file_signature(path) if path.exists() else None
+        # Diff against the cached version only while it still matches the file
+        changes = None
+        if base is not None and self.cache.signature(path) == base:
+            changes = RecordChanges.between(slot, self.cache.copy(path), document)
+        atomic_write_json(path, document, indent=4)
+        generation = self.generations.bump(slot)
+        self.cache.put(path, file_signature(path), document, generation, changes, base)
+
+    def load_ideas(self):
+        return self._load(self.ideas_file)
+
+    def load_users(self):
+        return self._load(self.users_file)
+
+    def commit(self, ideas=None, users=None):
+        """Write the given documents and return a callable waiting for durability."""
+        waits = []
+        if users is not None:
+            waits.append(self.writer.submit(self.users_file, self._write, users))
+        if ideas is not None:
+            waits.append(self.writer.submit(self.ideas_file, self._write, ideas))
+        return lambda: wait_all(waits)
+
+    def save_ideas(self, ideas):
+        self.commit(ideas=ideas)()
+
+    def save_users(self, users):
+        self.commit(users=users)()
+
+    def read_sequence(self):
+        """Return the next unreserved gift idea ID, or None if no ID was reserved yet."""
+        try:
+            with open(self.sequence_file, 'r') as file:
+                return int(json.load(file))
+        except FileNotFoundError:
+            return None
+
+    def _max_idea_id(self):
+        key = self.refresh('ideas')
+        if key is None:
+            return max((idea['gift_idea_id'] for idea in self.load_ideas()), default=0)
+        return self.cache.derive(key, 'max_idea_id', lambda ideas: max((idea['gift_idea_id'] for idea in ideas), default=0))
+
+    def reserve_ids(self, count):
+        """Reserve count consecutive gift idea IDs and return the first one.
+
+        Must be called with the process lock held. The sequence file only moves
+        forward, so deleting the newest idea does not hand its ID out again, and
+        never goes below the highest existing ID, which can be ahead of it after
+        a restore or a hand-edited ideas.json.
+        """
+        first_id = max(self.read_sequence() or 0, self._max_idea_id() + 1)
+        atomic_write_json(self.sequence_file, first_id + count)
+        return first_id
+
+
+class SqliteStorage:
+    """Stores gift ideas and users as one JSON row per record in a SQLite database.
+
+    Saving a document only writes the rows whose content actually changed, so
+    marking a single idea as bought is one UPDATE instead of rewriting every
+    idea. The changed rows are found by diffing against the cached version in
+    memory, which matches the table while the process lock is held. Each table
+    has a generation counter in the meta table that is bumped on write and
+    used as the cache signature.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ideas (
+            gift_idea_id INTEGER PRIMARY KEY,
+            user_id TEXT,
+            bought_by TEXT,
+            added_by TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ideas_user_id ON ideas (user_id);
+        CREATE INDEX IF NOT EXISTS ideas_bought_by ON ideas (bought_by);
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    COLUMNS = {
+        'ideas': ('gift_idea_id', ('user_id', 'bought_by', 'added_by')),
+        'users': ('username', ()),
+    }
+
+    def __init__(self, database_file, cache, generations):
+        self.database_file = Path(database_file)
+        self.cache = cache
+        self.generations = generations
+        self._local = threading.local()
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            self.database_file.parent.mkdir(exist_ok=True, parents=True)
+            # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+            connection = sqlite3.connect(self.database_file, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _generation(self, connection, table):
+        row = connection.execute("SELECT value FROM meta WHERE key = ?", (f'{table}_generation',)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_generation(self, connection, table):
+        connection.execute(
+            "INSERT INTO meta (key, value) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            (f'{table}_generation',)
+        )
+
+    def refresh(self, table):
+        """Bring the cache entry of table up to date and return its key."""
+        key = f'{self.database_file}:{table}'
+        shared_generation = self.generations.read(table)
+        if self.cache.is_fresh(key, shared_generation):
+            return key
+
+        connection = self._connection()
+        if not self.cache.validate(key, self._generation(connection, table), shared_generation):
+            # Read the rows and the generation in one snapshot
+            connection.execute('BEGIN')
+            try:
+                signature = self._generation(connection, table)
+                document = [json.loads(row[0]) for row in connection.execute(f"SELECT data FROM {table} ORDER BY rowid")]
+            finally:
+                connection.execute('COMMIT')
+            self.cache.put(key, signature, document, shared_generation)
+        return key
+
+    def _load(self, table):
+        return self.cache.copy(self.refresh(table))
+
+    def _write(self, connection, table, changes):
+        """Upsert the changed records and delete the removed ones."""
+        key_column, columns = self.COLUMNS[table]
+        changed = [
+            (key, *(record.get(column) for column in columns), json.dumps(record))
+            for key, record in changes.upserted.items()
+        ]
+        removed = [(key,) for key in changes.deleted]
+
+        if changed:
+            all_columns = [key_column, *columns, 'data']
+            assignments = ', '.join(f"{column} = excluded.{column}" for column in all_columns[1:])
+            connection.executemany(
+                f"INSERT INTO {table} ({', '.join(all_columns)}) VALUES ({', '.join('?' * len(all_columns))}) "
+                f"ON CONFLICT({key_column}) DO UPDATE SET {assignments}",
+                changed
+            )
+        if removed:
+            connection.executemany(f"DELETE FROM {table} WHERE {key_column} = ?", removed)
+        if changed or removed:
+            self._bump_generation(connection, table)
+        return self._generation(connection, table)
+
+    def load_ideas(self):
+        return self._load('ideas')
+
+    def load_users(self):
+        return self._load('users')
+
+    def commit(self, ideas=None, users=None):
+        """Write the rows that changed in the given documents in one SQLite transaction. Needs the process lock."""
+        documents = {table: records for table, records in (('users', users), ('ideas', ideas)) if records is not None}
+        changes = {table: RecordChanges.between(table, self._load(table), records) for table, records in documents.items()}
+        bases = {table: self.cache.signature(f'{self.database_file}:{table}') for table in documents}
+        connection = self._connection()
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            signatures = {table: self._write(connection, table, changes[table]) for table in documents}
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        for table, records in documents.items():
+            shared_generation = self.generations.bump(table)
+            self.cache.put(f'{self.database_file}:{table}', signatures[table], records, shared_generation,
+                           changes[table], bases[table])
+        return lambda: None
+
+    def save_ideas(self, ideas):
+        self.commit(ideas=ideas)
+
+    def save_users(self, users):
+        self.commit(users=users)
+
+    def read_sequence(self):
+        """Return the next unreserved gift idea ID, or None if no ID was reserved yet."""
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'idea_sequence'").fetchone()
+        return int(row[0]) if row else None
+
+    def reserve_ids(self, count):
+        """Reserve count consecutive gift idea IDs and return the first one."""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'idea_sequence'").fetchone()
+            # The primary key index keeps this cheap, and covers IDs restored behind the sequence
+            highest_id = connection.execute("SELECT MAX(gift_idea_id) FROM ideas").fetchone()[0] or 0
+            first_id = max(int(row[0]) if row else 0, highest_id + 1)
+            connection.execute(
+                "INSERT INTO meta (key, value) VALUES ('idea_sequence', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (first_id + count,)
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return first_id
+
+    def is_empty(self):
+        connection = self._connection()
+        return not any(connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() for table in ('ideas', 'users'))
+
+    def migrate_from(self, source):
+        """One-shot import of the users and ideas of another storage backend."""
+        connection = self._connection()
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone() or not self.is_empty():
+            return False
+
+        ideas = source.load_ideas()
+
+        # Older versions could hand out the same ID twice; give duplicates a fresh one
+        seen_ids = set()
+        next_id = max((idea['gift_idea_id'] for idea in ideas), default=0) + 1
+        for idea in ideas:
+            if idea['gift_idea_id'] in seen_ids:
+                idea['gift_idea_id'] = next_id
+                next_id += 1
+            seen_ids.add(idea['gift_idea_id'])
+
+        self.commit(ideas=ideas, users=source.load_users())
+        # Keep IDs reserved by the old backend out of circulation
+        connection.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [('migrated_from', f'{source.name} {datetime.now().isoformat()}'),
+             ('idea_sequence', max(next_id, source.read_sequence() or 0))]
+        )
+        print(f"Migrated users and gift ideas from {source.name} storage to {self.database_file}")
+        return True
+
+
+class JournalStorage:
+    """Stores gift ideas and users as a snapshot plus an append-only journal of changes.
+
+    Saving a document diffs it against the current state and appends the
+    differences as typed events (idea_added, idea_updated, idea_deleted,
+    ideas_reordered, the same for users, and ids_reserved), so marking an idea
+    as bought appends one record instead of rewriting every idea. The events
+    of a commit go into one journal line and each gets the next sequence
+    number; the last one is the version of the data, and every record
+    remembers the version that last changed it. Each process replays the
+    lines it has not seen yet when the shared generation moves. compact()
+    writes the state as a fresh snapshot and starts an empty journal, the
+    scheduler runs it in the background.
+    """
+
+    name = 'journal'
+
+    KEYS = {'ideas': 'gift_idea_id', 'users': 'username'}
+    PREFIXES = {'ideas': 'idea', 'users': 'user'}
+    SLOTS = {'idea': 'ideas', 'user': 'users', 'ideas': 'ideas', 'users': 'users'}
+
+    def __init__(self, directory, cache, generations, lock, max_tombstones=10000):
+        self.directory = Path(directory)
+        self.snapshot_file = self.directory / 'snapshot.json'
+        self.journal_file = self.directory / 'journal.jsonl'
+        self.cache = cache
+        self.generations = generations
+        self.lock = lock
+        self.max_tombstones = max_tombstones
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.records = {'ideas': {}, 'users': {}}
+        self.versions = {'ideas': {}, 'users': {}}  # key -> seq of its last change
+        self.tombstones = {'ideas': {}, 'users': {}}  # key -> seq it was deleted at
+        self.tombstones_since = 0  # Deletions before this seq are no longer known
+        self.changed_at = {'ideas': 0, 'users': 0}
+        self.next_id = None
+        self.journal_events = 0
+        self._inode = None
+        self._offset = 0
+
+    def _load_all(self):
+        """Rebuild the state from the snapshot and the whole journal."""
+        with self.lock:
+            self._reset()
+            try:
+                with open(self.snapshot_file, 'r') as file:
+                    snapshot = json.load(file)
+            except FileNotFoundError:
+                snapshot = None
+            if snapshot is not None:
+                self.seq = self.snapshot_seq = snapshot['seq']
+                self.next_id = snapshot.get('next_id')
+                self.tombstones_since = snapshot.get('tombstones_since', 0)
+                for slot, key_field in self.KEYS.items():
+                    self.records[slot] = {record[key_field]: record for record in snapshot[slot]}
+                    # Both kept in sequence order, see changes_since()
+                    self.versions[slot] = dict(sorted(((key, seq) for key, seq in snapshot['versions'][slot]), key=lambda item: item[1]))
+                    self.tombstones[slot] = dict(sorted(((key, seq) for key, seq in snapshot['tombstones'][slot]), key=lambda item: item[1]))
+                self.changed_at.update(snapshot.get('changed_at', {}))
+            self._inode = None
+            self._offset = 0
+            self._loaded = True
+            self._catch_up()
+
+    def _sync(self):
+        if self._loaded:
+            return self._catch_up()
+        self._load_all()
+        return set(self.KEYS)
+
+    def _catch_up(self):
+        """Apply the journal lines written since the last call, return the slots they changed."""
+        try:
+            file = open(self.journal_file, 'rb')
+        except FileNotFoundError:
+            return set()
+        with file:
+            inode = os.fstat(file.fileno()).st_ino
+            if self._inode is None:
+                self._inode = inode
+            elif inode != self._inode:
+                # Compacted by another process, start over from its snapshot
+                self._load_all()
+                return set(self.KEYS)
+            file.seek(self._offset)
+            data = file.read()
+
+        # A line without its newline is still being written (or was cut short by a crash)
+        end = data.rfind(b'\n') + 1
+        changed = set()
+        for line in data[:end].splitlines():
+            if line.strip():
+                changed.update(self._apply_line(json.loads(line)))
+        self._offset += end
+        return changed
+
+    def _apply_line(self, entry):
+        changed = set()
+        for event in entry['events']:
+            if event['seq'] <= self.seq:
+                continue  # Already part of the snapshot
+            self.seq = event['seq']
+            self.journal_events += 1
+            kind = event['type']
+            if kind == 'ids_reserved':
+                self.next_id = event['next_id']
+                continue
+
+            prefix, _, action = kind.partition('_')
+            slot = self.SLOTS[prefix]
+            records = self.records[slot]
+            if action in ('added', 'updated'):
+                records[event['key']] = event['record']
+                # Re-inserted so the dict stays in sequence order
+                self.versions[slot].pop(event['key'], None)
+                self.versions[slot][event['key']] = event['seq']
+                self.tombstones[slot].pop(event['key'], None)
+            elif action == 'deleted':
+                records.pop(event['key'], None)
+                self.versions[slot].pop(event['key'], None)
+                self.tombstones[slot].pop(event['key'], None)
+                self.tombstones[slot][event['key']] = event['seq']
+            elif action == 'reordered':
+                self.records[slot] = {key: records[key] for key in event['keys'] if key in records}
+            self.changed_at[slot] = event['seq']
+            changed.add(slot)
+        return changed
+
+    def _diff(self, slot, document):
+        """Return the events turning the records of slot into document, and the RecordChanges they make."""
+        prefix = self.PREFIXES[slot]
+        old = self.records[slot]
+        changes = RecordChanges.between(slot, old.values(), document)
+
+        events = [
+            {'type': f'{prefix}_updated' if key in old else f'{prefix}_added', 'key': key, 'record': record}
+            for key, record in changes.upserted.items()
+        ]
+        events.extend({'type': f'{prefix}_deleted', 'key': key} for key in changes.deleted)
+        if changes.reordered:
+            events.append({'type': f'{slot}_reordered', 'keys': list(dict.fromkeys(record[self.KEYS[slot]] for record in document))})
+        return events, changes
+
+    def _append(self, events):
+        """Write events as one journal line and apply them. Needs the process lock."""
+        for offset, event in enumerate(events, 1):
+            event['seq'] = self.seq + offset
+        line = json.dumps({'at': time.time(), 'events': events}) + '\n'
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if self._inode is None:
+                self._inode = os.fstat(fd).st_ino
+            if os.fstat(fd).st_size > self._offset:
+                # Leftover of a write cut short by a crash, we are caught up under the lock
+                os.ftruncate(fd, self._offset)
+            os.write(fd, line.encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._offset += len(line.encode('utf-8'))
+
+        # Apply the decoded line, so this process holds exactly what a replay produces
+        return self._apply_line(json.loads(line))
+
+    def refresh(self, slot):
+        """Bring the cache entry of slot up to date and return its key."""
+        key = f'{self.directory}:{slot}'
+        generation = self.generations.read(slot)
+        if self.cache.is_fresh(key, generation):
+            return key
+
+        with self._lock:
+            self._sync()
+            if not self.cache.validate(key, self.changed_at[slot], generation):
+                self.cache.put(key, self.changed_at[slot], list(self.records[slot].values()), generation)
+        return key
+
+    def _load(self, slot):
+        return self.cache.copy(self.refresh(slot))
+
+    def load_ideas(self):
+        return self._load('ideas')
+
+    def load_users(self):
+        return self._load('users')
+
+    def commit(self, ideas=None, users=None):
+        """Append the changes of the given documents to the journal."""
+        with self.lock, self._lock:
+            self._sync()
+            events = []
+            changes = {}
+            bases = {slot: self.changed_at[slot] for slot in self.records}
+            for slot, document in (('users', users), ('ideas', ideas)):
+                if document is not None:
+                    slot_events, changes[slot] = self._diff(slot, document)
+                    events.extend(slot_events)
+            changed = self._append(events) if events else set()
+
+            for slot in changed:
+                generation = self.generations.bump(slot)
+                self.cache.put(f'{self.directory}:{slot}', self.changed_at[slot], list(self.records[slot].values()), generation,
+                               changes.get(slot), bases[slot])
+        return lambda: None
+
+    def save_ideas(self, ideas):
+        self.commit(ideas=ideas)
+
+    def save_users(self, users):
+        self.commit(users=users)
+
+    def version(self):
+        """Return the sequence number of the last change."""
+        with self._lock:
+            self._sync()
+            return self.seq
+
+    def changes_since(self, version):
+        """Return the current version and, per slot, the records changed and the keys deleted after version.
+
+        The changes are None when version is unknown or older than the
+        deletions still remembered, the caller then has to start over.
+        Walks the versions newest first, so it costs O(changes).
+        """
+        with self._lock:
+            self._sync()
+            if version is None or version < self.tombstones_since or version > self.seq:
+                return self.seq, None
+            changes = {}
+            for slot in self.KEYS:
+                changed = []
+                for key, seq in reversed(self.versions[slot].items()):
+                    if seq <= version:
+                        break
+                    changed.append(self.records[slot][key])
+                deleted = []
+                for key, seq in reversed(self.tombstones[slot].items()):
+                    if seq <= version:
+                        break
+                    deleted.append(key)
+                changes[slot] = (pickle.loads(pickle.dumps(changed[::-1], pickle.HIGHEST_PROTOCOL)), deleted[::-1])
+            return self.seq, changes
+
+    def read_sequence(self):
+        """Return the next unreserved gift idea ID, or None if no ID was reserved yet."""
+        with self._lock:
+            self._sync()
+            return self.next_id
+
+    def reserve_ids(self, count):
+        """Reserve count consecutive gift idea IDs and return the first one. Needs the process lock."""
+        with self._lock:
+            self._sync()
+            first_id = max(self.next_id or 0, max(self.records['ideas'], default=0) + 1)
+            self._append([{'type': 'ids_reserved', 'next_id': first_id + count}])
+        return first_id
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot, return how many events it held."""
+        with self.lock, self._lock:
+            self._sync()
+            if self.journal_events == 0:
+                return 0
+
+            tombstones = {}
+            for slot in self.KEYS:
+                entries = sorted(self.tombstones[slot].items(), key=lambda item: item[1])
+                if len(entries) > self.max_tombstones:
+                    # Clients that synced before the dropped deletions need a full reload
+                    self.tombstones_since = max(self.tombstones_since, entries[-self.max_tombstones - 1][1] + 1)
+                    entries = entries[-self.max_tombstones:]
+                    self.tombstones[slot] = dict(entries)
+                tombstones[slot] = entries
+
+            atomic_write_json(self.snapshot_file, {
+                'seq': self.seq,
+                'next_id': self.next_id,
+                'tombstones_since': self.tombstones_since,
+                'changed_at': self.changed_at,
+                'ideas': list(self.records['ideas'].values()),
+                'users': list(self.records['users'].values()),
+                'versions': {slot: list(self.versions[slot].items()) for slot in self.KEYS},
+                'tombstones': tombstones,
+            })
+
+            # Start an empty journal, other processes notice the new file and reload
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.journal.', suffix='.tmp')
+            os.fsync(fd)
+            os.close(fd)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.journal_file)
+
+            events = self.journal_events
+            self.journal_events = 0
+            self.snapshot_seq = self.seq
+            self._inode = os.stat(self.journal_file).st_ino
+            self._offset = 0
+        print(f"Compacted {events} journal events into a snapshot at version {self.snapshot_seq}")
+        return events
+
+    def is_empty(self):
+        return not self.snapshot_file.exists() and not self.journal_file.exists()
+
+    def migrate_from(self, source):
+        """One-shot import of the users and ideas of another storage backend."""
+        if not self.is_empty():
+            return False
+
+        ideas = source.load_ideas()
+
+        # Older versions could hand out the same ID twice; give duplicates a fresh one
+        seen_ids = set()
+        next_id = max((idea['gift_idea_id'] for idea in ideas), default=0) + 1
+        for idea in ideas:
+            if idea['gift_idea_id'] in seen_ids:
+                idea['gift_idea_id'] = next_id
+                next_id += 1
+            seen_ids.add(idea['gift_idea_id'])
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(self.snapshot_file, {
+            'seq': 0,
+            'next_id': max(next_id, source.read_sequence() or 0),
+            'migrated_from': f'{source.name} {datetime.now().isoformat()}',
+            'ideas': ideas,
+            'users': source.load_users(),
+            'versions': {slot: [] for slot in self.KEYS},
+            'tombstones': {slot: [] for slot in self.KEYS},
+        })
+        with self._lock:
+            self._load_all()
+        print(f"Migrated users and gift ideas from {source.name} storage to {self.directory}")
+        return True
+
+
+class Transaction:
+    """Documents saved during a transaction, written when it commits."""
+
+    def __init__(self):
+        self.ideas = None
+        self.users = None
+
+
+class DataStore:
+    """Serializes read-modify-write cycles on the storage backend.
+
+    Mutating code runs inside store.transaction(): it holds the in-process
+    write lock and the cross-process file lock, loads see the latest data
+    (including what was saved earlier in the same transaction), and saves are
+    buffered and committed together when the block exits without an error.
+    Loads outside a transaction only take the read lock, so they never see
+    one document of a transaction committed without the other.
+    """
+
+    def __init__(self, backend, process_lock):
+        self.backend = backend
+        self.process_lock = process_lock
+        self._lock = ReadWriteLock()
+        self._local = threading.local()
+
+    def _current(self):
+        return getattr(self._local, 'transaction', None)
+
+    @contextmanager
+    def transaction(self):
+        current = self._current()
+        if current is not None:
+            # Nested transactions join the outer one
+            yield current
+            return
+
+        self._lock.acquire_write()
+        self.process_lock.acquire()
+        transaction = self._local.transaction = Transaction()
+        wait = None
+        try:
+            yield transaction
+            wait = self.backend.commit(ideas=transaction.ideas, users=transaction.users)
+        finally:
+            self._local.transaction = None
+            self.process_lock.release()
+            self._lock.release_write()
+            if wait is not None:
+                wait()
+
+    def _load(self, name, load):
+        transaction = self._current()
+        if transaction is not None:
+            staged = getattr(transaction, name)
+            return staged if staged is not None else load()
+
+        self._lock.acquire_read()
+        try:
+            return load()
+        finally:
+            self._lock.release_read()
+
+    def _save(self, name, document):
+        with self.transaction() as transaction:
+            setattr(transaction, name, document)
+
+    def derived(self, slot, name, build, update=None):
+        """Return a structure derived from the current version of slot.
+
+        See DocumentCache.derive(). Inside a transaction that already saved
+        slot, the structure is built from the saved document instead.
+        """
+        transaction = self._current()
+        staged = getattr(transaction, slot) if transaction is not None else None
+        if staged is not None:
+            return build(pickle.loads(pickle.dumps(staged, pickle.HIGHEST_PROTOCOL)))
+
+        if transaction is None:
+            self._lock.acquire_read()
+        try:
+            key = self.backend.refresh(slot)
+            if key is None:
+                return build(getattr(self.backend, f'load_{slot}')())
+            return self.backend.cache.derive(key, name, build, update)
+        finally:
+            if transaction is None:
+                self._lock.release_read()
+
+    def load_ideas(self):
+        return self._load('ideas', self.backend.load_ideas)
+
+    def save_ideas(self, ideas):
+        self._save('ideas', ideas)
+
+    def load_users(self):
+        return self._load('users', self.backend.load_users)
+
+    def save_users(self, users):
+        self._save('users', users)
+
+    def reserve_ids(self, count=1):
+        """Reserve count consecutive gift idea IDs and return them as a range."""
+        with self.transaction():
+            first_id = self.backend.reserve_ids(count)
+        return range(first_id, first_id + count)
+
+    def changes_since(self, version):
+        """Return (version, changes) for clients syncing the ideas and users.
+
+        version is the string a previous call returned, or None. changes maps
+        'ideas' and 'users' to (changed records, deleted keys), or is None
+        when the client has to reload everything. Only the journal backend
+        tracks versions per record; with the others a client gets either
+        "nothing changed" or a full reload.
+        """
+        self._lock.acquire_read()
+        try:
+            if isinstance(self.backend, JournalStorage):
+                try:
+                    since = int(version) if version is not None else None
+                except ValueError:
+                    since = None
+                current, changes = self.backend.changes_since(since)
+                return str(current), changes
+
+            keys = [self.backend.refresh(slot) for slot in ('ideas', 'users')]
+            if None in keys:
+                return '', None  # A save is waiting for its group commit
+            signatures = [str(self.backend.cache.signature(key)) for key in keys]
+            current = f"{self.backend.name}-{hashlib.sha1('|'.join(signatures).encode()).hexdigest()[:16]}"
+            if version == current:
+                return current, {'ideas': ([], []), 'users': ([], [])}
+            return current, None
+        finally:
+            self._lock.release_read()
+
+
+def create_storage(lock, generations):
+    """Build the storage backend selected by STORAGE_BACKEND in the .env file."""
+    group_commit_ms = settings.get_int('GROUP_COMMIT_MS', 0)
+    writer = GroupCommitWriter(group_commit_ms / 1000, lock)
+    json_storage = JsonStorage(app.config['IDEAS_FILE'], app.config['USERS_FILE'], app.config['SEQUENCE_FILE'], document_cache, writer, generations)
+    backend = settings.get('STORAGE_BACKEND', 'json').lower()
+
+    if backend == 'json':
+        return json_storage
+    if backend == 'sqlite':
+        sqlite_storage = SqliteStorage(app.config['DATABASE_FILE'], document_cache, generations)
+        with lock:
+            sqlite_storage.migrate_from(json_storage)
+        return sqlite_storage
+    if backend == 'journal':
+        journal_storage = JournalStorage(app.config['JOURNAL_DIR'], document_cache, generations, lock)
+        with lock:
+            journal_storage.migrate_from(json_storage)
+        return journal_storage
+
+    raise ValueError(f"Unknown STORAGE_BACKEND '{backend}', expected 'json', 'sqlite' or 'journal'")
+
+process_lock = ProcessFileLock(app.config['LOCK_FILE'])
+generations = SharedGenerations(app.config['GENERATION_FILE'])
+storage = create_storage(process_lock, generations)
+store = DataStore(storage, process_lock)
+
 def load_gift_ideas():
-    with open(app.config['IDEAS_FILE'], 'r') as file:
-        return json.load(file)
+    return store.load_ideas()
 
 def save_gift_ideas(gift_ideas):
-    with open(app.config['IDEAS_FILE'], 'w') as file:
-        json.dump(gift_ideas, file, indent=4)
+    store.save_ideas(gift_ideas)
 
 def load_users():
-    with open(app.config['USERS_FILE'], 'r') as file:
-        return json.load(file)
+    return store.load_users()
 
 def save_users(users):
-    with open(app.config['USERS_FILE'], 'w') as file:
-        json.dump(users, file, indent=4)
+    store.save_users(users)
+    if has_request_context():
+        # The request identity was resolved from the previous version
+        g.pop('identity', None)
+
+def next_gift_idea_id():
+    return store.reserve_ids()[0]
+
+def idea_sort_key(idea):
+    # Ideas without a priority go to the bottom
+    return (idea.get('priority', float('inf')), idea['gift_idea_id'])
+
+
+class IdeaIndex:
+    """Lookup tables over the gift ideas of one data generation.
+
+    by_id maps gift_idea_id to its idea; by_recipient, by_buyer and by_added_by
+    map a username to its ideas (user_id, bought_by and added_by fields).
+    Recipient lists are sorted like the list pages show them, the others by ID.
+    The ideas are shared by every request and must be copied before they are
+    handed to a route, see the load_gift_ideas_* helpers.
+    """
+
+    FIELDS = {'by_recipient': 'user_id', 'by_buyer': 'bought_by', 'by_added_by': 'added_by'}
+
+    def __init__(self, ideas):
+        self.by_id = {idea['gift_idea_id']: idea for idea in ideas}
+        for attribute, field in self.FIELDS.items():
+            buckets = {}
+            for idea in ideas:
+                if idea.get(field):
+                    buckets.setdefault(idea[field], []).append(idea)
+            for key in buckets:
+                self._sort(attribute, buckets[key])
+            setattr(self, attribute, buckets)
+
+    @staticmethod
+    def _sort(attribute, bucket):
+        bucket.sort(key=idea_sort_key if attribute == 'by_recipient' else lambda idea: idea['gift_idea_id'])
+
+    def updated(self, ideas):
+        """Return the index of ideas, rebuilding only the lists of the ideas that changed."""
+        by_id = {idea['gift_idea_id']: idea for idea in ideas}
+        if len(by_id) != len(ideas):
+            # Duplicate IDs from older versions, the incremental path cannot track them
+            return IdeaIndex(ideas)
+
+        changed = [idea for idea_id, idea in by_id.items() if self.by_id.get(idea_id) != idea]
+        removed = [idea for idea_id, idea in self.by_id.items() if idea_id not in by_id]
+        touched_ids = {idea['gift_idea_id'] for idea in changed + removed}
+
+        index = IdeaIndex.__new__(IdeaIndex)
+        index.by_id = by_id
+        for attribute, field in self.FIELDS.items():
+            buckets = dict(getattr(self, attribute))
+            affected = {idea.get(field) for idea in changed + removed}
+            affected.update(self.by_id[idea['gift_idea_id']].get(field) for idea in changed if idea['gift_idea_id'] in self.by_id)
+            for key in affected - {None, ''}:
+                bucket = [idea for idea in buckets.get(key, []) if idea['gift_idea_id'] not in touched_ids]
+                bucket.extend(idea for idea in changed if idea.get(field) == key)
+                if bucket:
+                    self._sort(attribute, bucket)
+                    buckets[key] = bucket
+                else:
+                    buckets.pop(key, None)
+            setattr(index, attribute, buckets)
+        return index
+
+
+def gift_idea_index():
+    return store.derived('ideas', 'index', IdeaIndex, IdeaIndex.updated)
+
+def record_purchase_time(idea):
+    """Stamp idea as bought now, as a readable date_bought and as epoch seconds in bought_at."""
+    now = datetime.now()
+    idea['date_bought'] = now.strftime('%Y-%m-%d %H:%M:%S')
+    idea['bought_at'] = int(now.timestamp())
+
+def purchase_epoch(idea):
+    """Return when idea was bought in epoch seconds, or None if it has no purchase date."""
+    if 'bought_at' in idea:
+        return idea['bought_at']
+    if 'date_bought' in idea:
+        # Bought before bought_at was recorded
+        try:
+            return datetime.strptime(idea['date_bought'], '%Y-%m-%d %H:%M:%S').timestamp()
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class PurchaseExpiryIndex:
+    """Min-heap of (purchase epoch, gift_idea_id) over the bought ideas of one data generation.
+
+    entries maps the ID of every bought idea to (purchase field, epoch), so
+    moving to the next generation only parses the ideas whose purchase date
+    changed and pushes them onto a copy of the heap. Every save of the ideas
+    hands applied() the records it touched, so the index follows the commits
+    without looking at the other ideas. Heap entries that no longer match
+    entries are skipped when read and dropped once they make up half of the
+    heap.
+    """
+
+    def __init__(self, ideas, previous=None):
+        known = previous.entries if previous is not None else {}
+        entries = {}
+        pushed = []
+        for idea in ideas:
+            self._track(idea, known.get(idea['gift_idea_id']), entries, pushed)
+        self._build(entries, pushed, previous)
+
+    @staticmethod
+    def _track(idea, entry, entries, pushed):
+        """Add idea to entries, parsing its purchase date only if it differs from entry."""
+        source = idea.get('bought_at', idea.get('date_bought'))
+        if source is None:
+            return
+        if entry is None or entry[0] != source:
+            epoch = purchase_epoch(idea)
+            if epoch is None:
+                return
+            entry = (source, epoch)
+            pushed.append((epoch, idea['gift_idea_id']))
+        entries[idea['gift_idea_id']] = entry
+
+    def _build(self, entries, pushed, previous):
+        self.entries = entries
+        if previous is not None and len(previous.heap) + len(pushed) <= 2 * len(entries) + 16:
+            self.heap = list(previous.heap)
+            for item in pushed:
+                heapq.heappush(self.heap, item)
+        else:
+            self.heap = [(epoch, idea_id) for idea_id, (_, epoch) in entries.items()]
+            heapq.heapify(self.heap)
+
+    def updated(self, ideas):
+        return PurchaseExpiryIndex(ideas, previous=self)
+
+    def applied(self, changes):
+        """Return the index after a save that made changes (RecordChanges) to the ideas."""
+        entries = dict(self.entries)
+        pushed = []
+        for idea_id in changes.deleted:
+            entries.pop(idea_id, None)
+        for idea_id, idea in changes.upserted.items():
+            self._track(idea, entries.pop(idea_id, None), entries, pushed)
+
+        index = PurchaseExpiryIndex.__new__(PurchaseExpiryIndex)
+        index._build(entries, pushed, self)
+        return index
+
+    def expired(self, threshold):
+        """Return the IDs of the ideas bought before threshold (epoch seconds).
+
+        Only the part of the heap below threshold and its direct children are visited.
+        """
+        found = set()
+        pending = [0] if self.heap else []
+        while pending:
+            position = pending.pop()
+            epoch, idea_id = self.heap[position]
+            if epoch >= threshold:
+                continue
+            entry = self.entries.get(idea_id)
+            if entry is not None and entry[1] == epoch:
+                found.add(idea_id)
+            pending.extend(child for child in (2 * position + 1, 2 * position + 2) if child < len(self.heap))
+        return found
+
+
+def purchase_expiry_index():
+    return store.derived('ideas', 'purchase_expiry', PurchaseExpiryIndex, PurchaseExpiryIndex.updated)
+
+def backfill_purchase_times():
+    """Give ideas bought before bought_at was recorded their bought_at, so their dates are parsed only once."""
+    with store.transaction():
+        ideas = load_gift_ideas()
+        missing = [idea for idea in ideas if 'bought_at' not in idea and 'date_bought' in idea]
+        for idea in missing:
+            epoch = purchase_epoch(idea)
+            if epoch is not None:
+                idea['bought_at'] = int(epoch)
+        if any('bought_at' in idea for idea in missing):
+            save_gift_ideas(ideas)
+
+backfill_purchase_times()
+
+class IdeaArchive:
+    """Append-only, gzip compressed store of the ideas moved out of the ideas document.
+
+    Ideas are partitioned by the year they were bought in, one
+    ideas-<year>.jsonl.gz file per year holding one JSON idea per line. Every
+    append adds a gzip member to the end of the file, so existing data is
+    never rewritten. Files are only read when someone browses the archive, the
+    parsed ideas of the most recently read years are kept until their file
+    changes. A member cut short by a crash is skipped when reading.
+    """
+
+    def __init__(self, directory, cached_years=4):
+        self.directory = Path(directory)
+        self.cached_years = cached_years
+        self._years = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, year):
+        return self.directory / f'ideas-{year}.jsonl.gz'
+
+    def years(self):
+        """Return the archived years, newest first."""
+        if not self.directory.is_dir():
+            return []
+        years = []
+        for path in self.directory.glob('ideas-*.jsonl.gz'):
+            year = path.name[len('ideas-'):-len('.jsonl.gz')]
+            if year.isdigit():
+                years.append(int(year))
+        return sorted(years, reverse=True)
+
+    def append(self, ideas):
+        """Archive ideas, call it before removing them from the ideas document."""
+        archived_at = int(time.time())
+        by_year = {}
+        for idea in ideas:
+            epoch = purchase_epoch(idea)
+            year = datetime.fromtimestamp(epoch).year if epoch is not None else datetime.now().year
+            by_year.setdefault(year, []).append(dict(idea, archived_at=archived_at))
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for year, records in by_year.items():
+            lines = ''.join(json.dumps(record) + '\n' for record in records)
+            member = gzip.compress(lines.encode('utf-8'))
+            # One write of a whole member, made durable before the ideas are removed
+            fd = os.open(self._path(year), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, member)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _decompress(data):
+        view = memoryview(data)
+        position = 0
+        while position < len(data):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                chunk = decompressor.decompress(view[position:])
+                if not decompressor.eof:
+                    raise zlib.error('truncated member')
+            except zlib.error as e:
+                print(f"Skipping damaged archive data: {e}")
+                position = data.find(b'\x1f\x8b\x08', position + 1)
+                if position == -1:
+                    return
+                continue
+            yield chunk
+            position = len(data) - len(decompressor.unused_data)
+
+    def _read_year(self, year):
+        """Return username -> ideas they bought in year, newest first."""
+        path = self._path(year)
+        try:
+            signature = file_signature(path)
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            cached = self._years.get(year)
+            if cached is not None and cached[0] == signature:
+                self._years.move_to_end(year)
+                return cached[1]
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        by_id = {}
+        for chunk in self._decompress(data):
+            for line in chunk.decode('utf-8').splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    # An idea archived twice (crash before it left the ideas document) is kept once
+                    by_id[record['gift_idea_id']] = record
+        by_buyer = {}
+        for record in by_id.values():
+            by_buyer.setdefault(record.get('bought_by'), []).append(record)
+        for records in by_buyer.values():
+            records.sort(key=lambda record: purchase_epoch(record) or 0, reverse=True)
+
+        with self._lock:
+            self._years[year] = (signature, by_buyer)
+            self._years.move_to_end(year)
+            while len(self._years) > self.cached_years:
+                self._years.popitem(last=False)
+        return by_buyer
+
+    def bought_by(self, username, page=1, per_page=24):
+        """Return one page of the archived ideas bought by username, newest first, and whether more follow.
+
+        Years are read one after the other until the page is filled.
+        """
+        skip = (page - 1) * per_page
+        items = []
+        for year in self.years():
+            records = self._read_year(year).get(username, [])
+            if skip >= len(records):
+                skip -= len(records)
+                continue
+            items.extend(records[skip:skip + per_page + 1 - len(items)])
+            skip = 0
+            if len(items) > per_page:
+                break
+        return copy_records(items[:per_page]), len(items) > per_page
+
+
+idea_archive = IdeaArchive(app.config['ARCHIVE_DIR'])
+
+def copy_records(records):
+    return pickle.loads(pickle.dumps(records, pickle.HIGHEST_PROTOCOL))
+
+def find_gift_idea(idea_id):
+    """Return a copy of the gift idea with this ID, or None"""
+    idea = gift_idea_index().by_id.get(idea_id)
+    return copy_records(idea) if idea else None
+
+def load_gift_ideas_for(user_id):
+    """Return copies of the ideas for user_id, sorted by priority"""
+    return copy_records(gift_idea_index().by_recipient.get(user_id, []))
+
+def load_gift_ideas_bought_by(username):
+    return copy_records(gift_idea_index().by_buyer.get(username, []))
+
+def load_gift_ideas_added_by(username):
+    return copy_records(gift_idea_index().by_added_by.get(username, []))
+
+
+class RequestIdentity:
+    """The logged-in user of the current request, resolved once from the session."""
+
+    def __init__(self, username, users):
+        self.username = username
+        self.users = users
+        self.users_by_name = {}
+        for user in users:
+            self.users_by_name.setdefault(user['username'], user)
+        self.user = self.users_by_name.get(username) if username else None
+        self.is_guest = bool(self.user and self.user.get('guest', False))
+        self.is_admin = bool(self.user and self.user.get('admin'))
+
+
+def current_identity():
+    """Return the RequestIdentity of the current request, loading users at most once."""
+    identity = g.get('identity')
+    if identity is None or identity.username != session.get('username'):
+        identity = g.identity = RequestIdentity(session.get('username'), load_users())
+    return identity
+
+class DisplayNames(dict):
+    """Username -> full name map, unknown usernames are shown as they are."""
+
+    def __init__(self, users):
+        super().__init__()
+        for user in users:
+            self.setdefault(user['username'], user.get('full_name', user['username']))
+
+    def __missing__(self, username):
+        return username
+
+
+def display_names():
+    """Return the DisplayNames of the current users, built once per users generation."""
+    return store.derived('users', 'display_names', DisplayNames)
+
+class VisibilityIndex:
+    """Which users each user can see, derived from the users document.
+
+    group_members maps each family to its non-guest members and ungrouped
+    holds the non-guest users without a family, who are visible to everyone.
+    visible_users() resolves the users one user can see and remembers the
+    answer until the users document changes. The returned records are shared,
+    do not modify them.
+    """
+
+    def __init__(self, users):
+        self.users_by_name = {}
+        for user in users:
+            self.users_by_name.setdefault(user['username'], user)
+        self.non_guests = [user for user in users if not user.get('guest')]
+        self.ungrouped = [user for user in self.non_guests if not user.get('groups')]
+        self.group_members = {}
+        for user in self.non_guests:
+            for group in dict.fromkeys(user.get('groups') or []):
+                self.group_members.setdefault(group, []).append(user)
+        self._visible = {}
+
+    def members(self, group):
+        return self.group_members.get(group, [])
+
+    def _members_of(self, groups, include_ungrouped):
+        selected = {id(user) for group in groups for user in self.members(group)}
+        if include_ungrouped:
+            selected.update(id(user) for user in self.ungrouped)
+        # Keep the order of the users document
+        return tuple(user for user in self.non_guests if id(user) in selected)
+
+    def _resolve(self, username):
+        user = self.users_by_name.get(username)
+        if user is None:
+            return ()
+        groups = user.get('groups', [])
+
+        if user.get('guest'):
+            if user.get('access_type', 'family') == 'family':
+                # Guests see the members of their assigned families, never users without one
+                return self._members_of(groups, include_ungrouped=False)
+            access_users = set(user.get('access_users', []))
+            return tuple(u for u in self.non_guests if u['username'] in access_users)
+
+        if not groups:
+            # Users without a family see everyone
+            return tuple(self.non_guests)
+        # Users see their families and everyone without a family
+        return self._members_of(groups, include_ungrouped=True)
+
+    def visible_users(self, username):
+        visible = self._visible.get(username)
+        if visible is None:
+            visible = self._visible[username] = self._resolve(username)
+        return visible
+
+
+def visibility_index():
+    return store.derived('users', 'visibility', VisibilityIndex)
+
+
+class ShareLink:
+    """A public share link and its owner, with the expiry already parsed."""
+
+    __slots__ = ('owner', 'owner_position', 'link', 'link_position', 'expires_at')
+
+    def __init__(self, owner, owner_position, link, link_position):
+        self.owner = owner
+        self.owner_position = owner_position
+        self.link = link
+        self.link_position = link_position
+        # Raises ValueError/KeyError for a malformed link, see ShareTokenIndex
+        self.expires_at = datetime.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S')
+
+    def is_valid(self):
+        return self.link.get('is_active', True) and datetime.now() <= self.expires_at
+
+    def resolve(self, users):
+        """Return the (owner, link) records of this share link in a loaded users list."""
+        if self.owner_position < len(users) and users[self.owner_position]['username'] == self.owner['username']:
+            owner = users[self.owner_position]
+        else:
+            owner = next((user for user in users if user['username'] == self.owner['username']), None)
+        links = ((owner or {}).get('sharing') or {}).get('public_links', [])
+        if self.link_position < len(links) and links[self.link_position]['token'] == self.link['token']:
+            return owner, links[self.link_position]
+        return owner, next((link for link in links if link['token'] == self.link['token']), None)
+
+
+class ShareTokenIndex(dict):
+    """Share token -> ShareLink of every public link, derived from the users document."""
+
+    def __init__(self, users):
+        super().__init__()
+        for owner_position, user in enumerate(users):
+            for link_position, link in enumerate((user.get('sharing') or {}).get('public_links', [])):
+                try:
+                    self[link['token']] = ShareLink(user, owner_position, link, link_position)
+                except (KeyError, TypeError, ValueError) as e:
+                    # One bad entry must not take down every share link
+                    print(f"Skipping malformed share link of {user.get('username')}: {e!r}")
+
+
+def share_token_index():
+    return store.derived('users', 'share_tokens', ShareTokenIndex)
+
+def lookup_user(username):
+    """Find a user record by username (read-only, do not modify the result)"""
+    if has_request_context():
+        return current_identity().users_by_name.get(username)
+    return next((u for u in load_users() if u['username'] == username), None)
 
 
 # Define a decorator for requiring authentication
@@ -151,7 +2088,7 @@ def login_required(f):
             return redirect(url_for('login'))
         
         # Check if user is a guest and route doesn't allow guests
-        if is_guest_user(session['username']):
+        if current_identity().is_guest:
             # Check if the route has @guest_allowed decorator
             if not getattr(f, '_guest_allowed', False):
                 flash('This feature is not available for guest users.', 'danger')
@@ -168,14 +2105,8 @@ def admin_required(f):
             flash('Please log in first.', 'warning')
             return redirect(url_for('login'))
 
-        # Load users from the JSON file
-        users = load_users()
-
-        # Find the user based on the username stored in the session
-        user = next((u for u in users if u['username'] == session['username']), None)
-
         # Check if the user exists and is an admin
-        if not user or not user.get('admin'):
+        if not current_identity().is_admin:
             flash('Admin access required.', 'danger')
             return redirect(url_for('dashboard'))
 
@@ -186,8 +2117,7 @@ def admin_required(f):
 
 def is_guest_user(username):
     """Check if a user is a guest"""
-    users = load_users()
-    user = next((u for u in users if u['username'] == username), None)
+    user = lookup_user(username)
     return user and user.get('guest', False)
 
 def guest_allowed(f):
@@ -198,12 +2128,8 @@ def guest_allowed(f):
             flash('Please log in first.', 'warning')
             return redirect(url_for('login'))
         
-        # Check if user is a guest
-        if is_guest_user(session['username']):
-            return f(*args, **kwargs)
-        else:
-            # Regular users can always access guest-allowed routes
-            return f(*args, **kwargs)
+        # Guests and regular users can both access guest-allowed routes
+        return f(*args, **kwargs)
     
     # Mark this function as guest allowed
     decorated_function._guest_allowed = True
@@ -241,23 +2167,24 @@ def show_avatar(filename=""):
 @app.route('/change_email', methods=['POST'])
 @login_required
 def change_email():
-    # Load users from JSON
-    users = load_users()
-
     # Get the new email from the form
     new_email = request.form['new_email']
 
-    # Update the user's email in the loaded data
-    for user in users:
-        if user['username'] == session['username']:
-            user['email'] = new_email
-            break
-    else:
-        flash('User not found.', 'danger')
-        return redirect(url_for('dashboard'))
+    with store.transaction():
+        # Load users from JSON
+        users = load_users()
 
-    # Save the updated data back to the JSON file
-    save_users(users)
+        # Update the user's email in the loaded data
+        for user in users:
+            if user['username'] == session['username']:
+                user['email'] = new_email
+                break
+        else:
+            flash('User not found.', 'danger')
+            return redirect(url_for('dashboard'))
+
+        # Save the updated data back to the JSON file
+        save_users(users)
 
     flash('Email updated successfully.', 'success')
     return redirect(url_for('dashboard'))
@@ -265,33 +2192,34 @@ def change_email():
 @app.route('/change_user_grouping', methods=['POST'])
 @login_required
 def change_user_grouping():
-    # Load users from JSON
-    users = load_users()
-
     # Get new grouping setting from the form
     if 'user_grouping' in request.form.keys():
         grouping = request.form['user_grouping']
     else:
         grouping = 'false'
 
-    for user in users:
-        if user['username'] == session['username']:
-            user['dashboard_user_grouping'] = 'true' if grouping == 'true' else 'false'
-            break
-    else:
-        flash('User not found.', 'danger')
-        return redirect(url_for('dashboard'))
+    with store.transaction():
+        # Load users from JSON
+        users = load_users()
+
+        for user in users:
+            if user['username'] == session['username']:
+                user['dashboard_user_grouping'] = 'true' if grouping == 'true' else 'false'
+                break
+        else:
+            flash('User not found.', 'danger')
+            return redirect(url_for('dashboard'))
 
-    # Save the updated data back to the JSON file
-    save_users(users)
+        # Save the updated data back to the JSON file
+        save_users(users)
 
     return redirect(url_for('dashboard'))
 
 def get_currency_symbol():
-    return read_env_variable("CURRENCY_SYMBOL", "$")
+    return settings.get("CURRENCY_SYMBOL", "$")
 
 def get_currency_position():
-    return read_env_variable("CURRENCY_POSITION", "before")
+    return settings.get("CURRENCY_POSITION", "before")
 
 def format_currency(amount):
     symbol = get_currency_symbol()
@@ -307,6 +2235,7 @@ def format_currency(amount):
 def utility_processor():
     return dict(
         get_full_name=get_full_name, 
+        display_names=display_names(),
         format_currency=format_currency,
         get_currency_symbol=get_currency_symbol,
         get_currency_position=get_currency_position,
@@ -324,6 +2253,27 @@ oauth.register(
     client_kwargs={"scope": "openid profile email phone"},
 )
 
+def load_oidc_metadata():
+    """Fetch the provider metadata and signing keys through http_client
+
+    authlib skips its own fetch once the metadata has '_loaded_at' set.
+    """
+    client = oauth.keycloak
+    metadata_url = os.getenv("OIDC_SERVER_METADATA_URL")
+    if not metadata_url or '_loaded_at' in client.server_metadata:
+        return client.server_metadata
+
+    response = http_client.get(metadata_url)
+    response.raise_for_status()
+    metadata = response.json()
+    if metadata.get('jwks_uri'):
+        jwks_response = http_client.get(metadata['jwks_uri'])
+        jwks_response.raise_for_status()
+        metadata['jwks'] = jwks_response.json()
+    metadata['_loaded_at'] = time.time()
+    client.server_metadata.update(metadata)
+    return client.server_metadata
+
 @app.route('/login_oidc')
 def login_oidc():
     # Determine the scheme from headers (in case behind reverse proxy)
@@ -342,6 +2292,7 @@ def login_oidc():
     session["state"] = state
 
     # Perform OIDC authorization redirect
+    load_oidc_metadata()
     return oauth.keycloak.authorize_redirect(redirect_uri, nonce=nonce, state=state)
 
 @app.route("/auth")
@@ -356,6 +2307,7 @@ def auth():
     
     try:
         # Retrieve the access token from OIDC provider
+        load_oidc_metadata()
         token = oauth.keycloak.authorize_access_token()
     except Exception as e:
         flash("OIDC authorization failed.", "danger")
@@ -381,43 +2333,44 @@ def auth():
     primary_oidc_value = user_info.get(primary_oidc_field)
     secondary_oidc_value = user_info.get(secondary_oidc_field)
 
-    # Load users from the JSON file
-    users = load_users()
+    with store.transaction():
+        # Load users from the JSON file
+        users = load_users()
 
-    # Find user in the database based on OIDC fields
-    user_in_db = None
-    if primary_oidc_value:
-        user_in_db = next(
-            (user for user in users if user.get(primary_db_field, "").lower() == primary_oidc_value.lower()), 
-            None
-        )
-    if not user_in_db and secondary_oidc_value:
-        user_in_db = next(
-            (user for user in users if user.get(secondary_db_field, "").lower() == secondary_oidc_value.lower()), 
-            None
-        )
+        # Find user in the database based on OIDC fields
+        user_in_db = None
+        if primary_oidc_value:
+            user_in_db = next(
+                (user for user in users if user.get(primary_db_field, "").lower() == primary_oidc_value.lower()), 
+                None
+            )
+        if not user_in_db and secondary_oidc_value:
+            user_in_db = next(
+                (user for user in users if user.get(secondary_db_field, "").lower() == secondary_oidc_value.lower()), 
+                None
+            )
 
-    if user_in_db:
-        # Log in the user by setting the session
-        session["username"] = user_in_db["username"]
-        flash("Login successful with OIDC!", "login_success")
-        return redirect(url_for("dashboard"))
+        if user_in_db:
+            # Log in the user by setting the session
+            session["username"] = user_in_db["username"]
+            flash("Login successful with OIDC!", "login_success")
+            return redirect(url_for("dashboard"))
     
-    # Handle auto-registration if enabled
-    if read_env_variable("ENABLE_AUTO_REGISTRATION", "false").lower() == "true":
-        # Create a new user profile
-        new_user = {
-            "username": user_info.get("preferred_username"),
-            "email": user_info.get("email"),
-            "full_name": user_info.get("name"),
-            "admin": False,
-        }
-        users.append(new_user)
-        save_users(users)  # Save the updated users list
-        session["username"] = new_user["username"]
+        # Handle auto-registration if enabled
+        if settings.get_bool('ENABLE_AUTO_REGISTRATION', False):
+            # Create a new user profile
+            new_user = {
+                "username": user_info.get("preferred_username"),
+                "email": user_info.get("email"),
+                "full_name": user_info.get("name"),
+                "admin": False,
+            }
+            users.append(new_user)
+            save_users(users)  # Save the updated users list
+            session["username"] = new_user["username"]
         
-        flash("New profile created. Please complete your profile setup.", "info")
-        return redirect(url_for("setup_profile"))  # Redirect to profile setup page
+            flash("New profile created. Please complete your profile setup.", "info")
+            return redirect(url_for("setup_profile"))  # Redirect to profile setup page
 
     flash("User not found and auto-registration is disabled.", "danger")
     return redirect(url_for("login"))
@@ -445,22 +2398,32 @@ def setup_profile():
         return redirect(url_for("dashboard"))
     
     # Check if default login is enabled
-    enable_default_login = read_env_variable("ENABLE_DEFAULT_LOGIN", "true").lower() == "true"
+    enable_default_login = settings.get_bool('ENABLE_DEFAULT_LOGIN', True)
 
     if request.method == "POST":
-        # Handle form submission to update profile details
+        # Hash outside the transaction, the KDF must not hold up other requests
         password = request.form.get("password")
-        if enable_default_login and password:
-            user["password"] = password_hash(password)
+        new_password_hash = password_hash(password) if enable_default_login and password else None
 
-        user["birthday"] = request.form["birthday"]
-        user["avatar"] = request.form["avatar"]
-        
-        # Update full name if provided
-        user["full_name"] = request.form.get("full_name", user.get("full_name"))
-        
-        # Save the updated user list to `users.json`
-        save_users(users)
+        with store.transaction():
+            users = load_users()
+            user = next((u for u in users if u["username"] == username), None)
+            if not user:
+                flash("User not found.", "danger")
+                return redirect(url_for("login"))
+
+            # Handle form submission to update profile details
+            if new_password_hash:
+                user["password"] = new_password_hash
+
+            user["birthday"] = request.form["birthday"]
+            user["avatar"] = request.form["avatar"]
+
+            # Update full name if provided
+            user["full_name"] = request.form.get("full_name", user.get("full_name"))
+
+            # Save the updated user list to `users.json`
+            save_users(users)
         
         flash("Profile setup complete!", "success")
         return redirect(url_for("dashboard"))
@@ -500,11 +2463,82 @@ def index():
     return redirect(url_for('login'))
 
 
+class TokenBucketLimiter:
+    """Token bucket per key, for at most max_keys keys (least recently used keys are dropped).
+
+    Every key may spend up to burst attempts at once, refilled at rate attempts per minute.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate / 60)
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def retry_after(self, key):
+        """Seconds until key has an attempt again."""
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            self._buckets[key] = (tokens, now)
+        return 0 if tokens >= 1 or self.rate <= 0 else int((1 - tokens) * 60 / self.rate) + 1
+
+
+class LoginThrottle:
+    """Limits login attempts per client IP and per username before any password is hashed."""
+
+    def __init__(self):
+        self.by_ip = TokenBucketLimiter(0, 0)
+        self.by_username = TokenBucketLimiter(0, 0)
+
+    def _configure(self):
+        # Settings are re-read so changes from setup_advanced apply right away
+        for limiter, key, default in ((self.by_ip, 'LOGIN_IP_ATTEMPTS_PER_MINUTE', 20),
+                                      (self.by_username, 'LOGIN_USER_ATTEMPTS_PER_MINUTE', 5)):
+            limiter.rate = limiter.burst = max(1, settings.get_int(key, default))
+        return settings.get_bool('LOGIN_THROTTLE', True)
+
+    def check(self, ip, username=None):
+        """Return 0 if the attempt may go ahead, else the seconds to wait before retrying."""
+        if not self._configure():
+            return 0
+        if not self.by_ip.allow(ip):
+            return self.by_ip.retry_after(ip)
+        if username is not None and not self.by_username.allow(username):
+            return self.by_username.retry_after(username)
+        return 0
+
+    def stats(self):
+        return {'rejected_by_ip': self.by_ip.rejected, 'rejected_by_username': self.by_username.rejected}
+
+
+login_throttle = LoginThrottle()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     guests_exist_flag = guests_exist()
-    enable_default_login = read_env_variable('ENABLE_DEFAULT_LOGIN', 'true').lower() == 'true'
-    enable_self_registration = read_env_variable('ENABLE_SELF_REGISTRATION', 'false').lower() == 'true'
+    enable_default_login = settings.get_bool('ENABLE_DEFAULT_LOGIN', True)
+    enable_self_registration = settings.get_bool('ENABLE_SELF_REGISTRATION', False)
 
 
     # For GET requests, render the login page
@@ -519,6 +2553,14 @@ def login():
         input_username = request.form['username'].lower()  # Ensure case-insensitivity
         password = request.form['password']
 
+        # Reject excess attempts before spending any time on password hashing
+        retry_after = login_throttle.check(request.remote_addr, input_username)
+        if retry_after:
+            flash(f'Too many login attempts, please try again in {retry_after} seconds.', 'login_error')
+            response = make_response(render_template("login.html", oidc_enabled=oidc_enabled, login_message=login_message, guests_exist=guests_exist_flag, enable_self_registration=enable_self_registration), 429)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
         try:
             # Load users from the JSON file
             users = load_users()
@@ -537,6 +2579,7 @@ def login():
                         )
                     # Verify the password hash
                     if verify_password(user['password'], password):
+                        rehash_password_if_needed(user['username'], user['password'], password)
                         session['username'] = user['username']
                         flash('Login successful!', 'login_success')
                         return redirect(url_for('dashboard'))
@@ -561,7 +2604,7 @@ def guests_exist():
 def register():
     """Self-registration page for new users"""
     # Check if self-registration is enabled
-    if not read_env_variable('ENABLE_SELF_REGISTRATION', 'false').lower() == 'true':
+    if not settings.get_bool('ENABLE_SELF_REGISTRATION', False):
         flash('Self-registration is not enabled. Please contact an administrator.', 'danger')
         return redirect(url_for('login'))
     
@@ -594,37 +2637,45 @@ def register():
             return render_template('register.html', joining_code=joining_code)
         
         # No password complexity requirements
+
+        # Hash outside the transaction, the KDF must not hold up other requests
+        hashed = password_hash(password)
         
-        # Load existing users
-        users = load_users()
-        
-        # Check for duplicate username
-        if any(user['username'].lower() == username for user in users):
+        with store.transaction():
+            # Load existing users
+            users = load_users()
+
+            # Check for duplicate username
+            duplicate_username = any(user['username'].lower() == username for user in users)
+            # Check for duplicate email only if email is provided
+            duplicate_email = email and any(user.get('email', '').lower() == email.lower() for user in users)
+
+            if not duplicate_username and not duplicate_email:
+                # Create new user
+                new_user = {
+                    "username": username,
+                    "password": hashed,
+                    "full_name": full_name,
+                    "email": email,  # Can be empty
+                    "birthday": birthday,  # Can be empty
+                    "avatar": avatar,
+                    "admin": False,
+                    "guest": False,
+                    "groups": []  # New users start with no groups by default
+                }
+
+                # Add user to database
+                users.append(new_user)
+                save_users(users)
+
+        if duplicate_username:
             flash('Username already exists. Please choose a different one.', 'danger')
             return render_template('register.html', joining_code=joining_code)
-        
-        # Check for duplicate email only if email is provided
-        if email and any(user.get('email', '').lower() == email.lower() for user in users):
+
+        if duplicate_email:
             flash('Email already registered. Please use a different email or contact support.', 'danger')
             return render_template('register.html', joining_code=joining_code)
         
-        # Create new user
-        new_user = {
-            "username": username,
-            "password": password_hash(password),
-            "full_name": full_name,
-            "email": email,  # Can be empty
-            "birthday": birthday,  # Can be empty
-            "avatar": avatar,
-            "admin": False,
-            "guest": False,
-            "groups": []  # New users start with no groups by default
-        }
-        
-        # Add user to database
-        users.append(new_user)
-        save_users(users)
-        
         flash('Registration successful! You can now log in.', 'success')
         return redirect(url_for('login'))
     
@@ -635,37 +2686,17 @@ def register():
 @app.route('/add2/', methods=['GET', 'POST'])
 @login_required
 def add2():
-    # Load data from JSON files
-    gift_ideas_data = load_gift_ideas()
-    users = load_users()
-
     # Get the current user's information
     current_user = session['username']
-    current_user_data = next((user for user in users if user["username"] == current_user), None)
-
-    if not current_user_data:
+    if current_identity().user is None:
         flash("Current user not found.", "danger")
         return redirect(url_for('dashboard'))
 
-    # Get the current user's groups (default to empty list if not present)
-    current_user_groups = current_user_data.get("groups", [])
-
-    # Filter the user list based on groups
-    if not current_user_groups:
-        # If the current user has no groups, allow them to see all users
-        user_list = [
-            {"full_name": user["full_name"], "username": user["username"]}
-            for user in users
-            if not user.get('guest')
-        ]
-    else:
-        # Filter the user list to include only those in the current user's groups
-        user_list = [
-            {"full_name": user["full_name"], "username": user["username"]}
-            for user in users
-            if not user.get("groups") or any(group in user.get("groups", []) for group in current_user_groups)
-            and not user.get('guest')
-        ]
+    # The user list contains the users the current user can see (shared families or no family)
+    user_list = [
+        {"full_name": user["full_name"], "username": user["username"]}
+        for user in visibility_index().visible_users(current_user)
+    ]
 
     if request.method == 'POST':
         # Handle the form submission, process the data, and add the idea
@@ -679,10 +2710,6 @@ def add2():
         # Retrieve the logged-in user's username
         added_by = session.get('username')
 
-        # Find the largest gift idea ID
-        largest_gift_idea_id = max((idea['gift_idea_id'] for idea in gift_ideas_data), default=0)
-
-
         # Process custom fields from the form
         custom_fields = {}
         # Get all form keys that start with 'custom_field_key_'
@@ -698,7 +2725,7 @@ def add2():
         # Create a new idea object
         new_idea = {
             'user_id': user,
-            'gift_idea_id': largest_gift_idea_id + 1,
+            'gift_idea_id': next_gift_idea_id(),
             'gift_name': name,
             'description': description,
             'link': link,
@@ -710,16 +2737,19 @@ def add2():
             'last_updated': datetime.now().isoformat()  # Set initial last_updated timestamp
         }
 
-        # Append the new idea to the list
-        gift_ideas_data.append(new_idea)
+        with store.transaction():
+            gift_ideas_data = load_gift_ideas()
 
-        # Save the updated ideas back to the file
-        save_gift_ideas(gift_ideas_data)
+            # Append the new idea to the list
+            gift_ideas_data.append(new_idea)
+
+            # Save the updated ideas back to the file
+            save_gift_ideas(gift_ideas_data)
 
         
         # Redirect to the user's gift ideas page
         return redirect(url_for('user_gift_ideas', selected_user_id=user))
-    imgenabled = read_env_variable('IMGENABLED', 'true').lower() == 'true'
+    imgenabled = settings.get_bool('IMGENABLED', True)
     # Render the "Add Idea" page with the filtered user list
     return render_template('add2.html', user_list=user_list, imgenabled=imgenabled)
 
@@ -734,37 +2764,17 @@ def need_restart():
 @app.route('/add_idea/<path:selected_user_id>', methods=['GET', 'POST'])
 @login_required
 def add_idea(selected_user_id):
-    # Load data from JSON files
-    gift_ideas_data = load_gift_ideas()
-    users = load_users()
-
     # Get the current user's information
     current_user = session['username']
-    current_user_data = next((user for user in users if user["username"] == current_user), None)
-
-    if not current_user_data:
+    if current_identity().user is None:
         flash("Current user not found.", "danger")
         return redirect(url_for('dashboard'))
 
-    # Get the current user's groups (default to empty list if not present)
-    current_user_groups = current_user_data.get("groups", [])
-
-    # Filter the user list based on groups
-    if not current_user_groups:
-        # If the current user has no groups, allow them to see all users
-        user_list = [
-            {"full_name": user["full_name"], "username": user["username"]}
-            for user in users
-            if not user.get('guest')
-        ]
-    else:
-        # Filter the user list to include only those in the current user's groups
-        user_list = [
-            {"full_name": user["full_name"], "username": user["username"]}
-            for user in users
-            if not user.get("groups") or any(group in user.get("groups", []) for group in current_user_groups)
-            and not user.get('guest')
-        ]
+    # The user list contains the users the current user can see (shared families or no family)
+    user_list = [
+        {"full_name": user["full_name"], "username": user["username"]}
+        for user in visibility_index().visible_users(current_user)
+    ]
 
     if request.method == 'POST':
         # Handle the form submission
@@ -778,9 +2788,6 @@ def add_idea(selected_user_id):
         # Retrieve the currently logged-in user
         added_by = session.get('username')
 
-        # Find the largest gift idea ID
-        largest_gift_idea_id = max((idea['gift_idea_id'] for idea in gift_ideas_data), default=0)
-
         # Process custom fields from the form
         custom_fields = {}
         # Get all form keys that start with 'custom_field_key_'
@@ -797,7 +2804,7 @@ def add_idea(selected_user_id):
         # Create a new idea object
         new_idea = {
             'user_id': user,
-            'gift_idea_id': largest_gift_idea_id + 1,
+            'gift_idea_id': next_gift_idea_id(),
             'gift_name': name,
             'description': description,
             'link': link,
@@ -809,50 +2816,53 @@ def add_idea(selected_user_id):
             'last_updated': datetime.now().isoformat()  # Set initial last_updated timestamp
         }
 
-        # Append the new idea to the list
-        gift_ideas_data.append(new_idea)
+        with store.transaction():
+            gift_ideas_data = load_gift_ideas()
 
-        # Save the updated gift ideas back to the file
-        save_gift_ideas(gift_ideas_data)
+            # Append the new idea to the list
+            gift_ideas_data.append(new_idea)
+
+            # Save the updated gift ideas back to the file
+            save_gift_ideas(gift_ideas_data)
 
         # Flash success message and redirect
         flash(f'Idea "{name}" added for user {user} by {added_by}!', 'success')
         return redirect(url_for('user_gift_ideas', selected_user_id=user))
-    imgenabled = read_env_variable('IMGENABLED', 'true').lower() == 'true'
+    imgenabled = settings.get_bool('IMGENABLED', True)
     # Render the "Add Idea" page with the user list, gift ideas, and the selected user as default
-    return render_template('add_idea.html', user_list=user_list, gift_ideas=gift_ideas_data, default_user=selected_user_id, imgenabled=imgenabled)
+    return render_template('add_idea.html', user_list=user_list, default_user=selected_user_id, imgenabled=imgenabled)
 
 
 @app.route('/delete_idea/<int:idea_id>', methods=['DELETE'])
 @login_required
 def delete_idea(idea_id):
-    # Load gift ideas using helper function
-    gift_ideas_data = load_gift_ideas()
-    users = load_users()
-    
+    with store.transaction():
+        # Load gift ideas using helper function
+        gift_ideas_data = load_gift_ideas()
+        users = load_users()
 
-    # Find the idea by its ID
-    idea = find_idea_by_id(gift_ideas_data, idea_id)
-    shared_list = next((user for user in users if user['username'] == idea['user_id'] and user.get('shared_list')), None)
+        # Find the idea by its ID
+        idea = find_idea_by_id(gift_ideas_data, idea_id)
+        shared_list = next((user for user in users if user['username'] == idea['user_id'] and user.get('shared_list')), None)
 
-    if idea:
         current_user_username = session['username']  # Use 'username' from the session
 
-# Check if the idea was added by the current user, if it's in their list, OR if they're a member of the shared list
-
-        # Check if the idea was added by the current user or if it's in their list
-        if idea['added_by'] == current_user_username or idea['user_id'] == current_user_username or (shared_list and current_user_username in shared_list.get('list_members', [])):
-            # Check if the idea is bought
-            if idea['bought_by']:
-                # Send an email to the buyer using Mailjet
-                send_email_to_buyer_via_mailjet(idea['bought_by'], f'{idea["gift_name"]}', 'IDEAS DELETED')
-
+        # Check if the idea was added by the current user, if it's in their list, OR if they're a member of the shared list
+        authorized = idea and (idea['added_by'] == current_user_username or idea['user_id'] == current_user_username or (shared_list and current_user_username in shared_list.get('list_members', [])))
+        if authorized:
             # Delete the idea
             gift_ideas_data.remove(idea)
 
             # Save the updated list of gift ideas using the helper function
             save_gift_ideas(gift_ideas_data)
 
+    if idea:
+        if authorized:
+            # Check if the idea is bought
+            if idea['bought_by']:
+                # Queue an email to the buyer, the outbox sends it in the background
+                send_email_to_buyer(idea['bought_by'], f'{idea["gift_name"]}', 'IDEAS DELETED')
+
             return '', 204  # Return a response with HTTP status code 204 (no content)
         else:
             flash('You are not authorized to delete this idea.', 'danger')
@@ -862,55 +2872,345 @@ def delete_idea(idea_id):
     return '', 403  # Return a response with HTTP status code 403 (forbidden)
 
 def get_user_email_by_username(username):
-    # Use the helper function to load users
-    users = load_users()
-
     # Find the user by username
-    user = next((u for u in users if u['username'] == username), None)
+    user = lookup_user(username)
     return user.get('email') if user else None
 
-def send_email_to_buyer_via_mailjet(buyer_username, idea_name, message_subject):
-    if not read_env_variable("MAILJET_API_KEY") or not read_env_variable("MAILJET_API_SECRET"):
-        print("Mailjet not configured. Skipping email notification.")
-        return True  # Return True to allow deletion to proceed
-    # Find the idea bought by the buyer
-    gift_ideas_data = load_gift_ideas()
-    for idea in gift_ideas_data:
-        if idea.get('bought_by') == buyer_username:
-            buyer_email = get_user_email_by_username(buyer_username)
-            
-            if buyer_email:
-                text_part = f"This ideas, '{idea_name}',has been deleted but you already BOUGHT IT."
-
-                # Send an email to the buyer using Mailjet
-                data = {
-                    'Messages': [
-                        {
-                            'From': {
-                                'Email': os.getenv("SYSTEM_EMAIL"),  # Your sender email address
-                                'Name': 'GiftManager',
-                            },
-                            'To': [
-                                {
-                                    'Email': buyer_email,  # Buyer's email
-                                    'Name': 'Buyer Name',
-                                },
-                            ],
-                            'Subject': message_subject,
-                            'TextPart': text_part,
-                        }
-                    ]
+class MailjetTransport:
+    """Sends a batch of messages with one call to the Mailjet v3.1 send API."""
+
+    name = 'mailjet'
+    batch_size = 50  # Mailjet accepts at most 50 messages per call
+
+    def __init__(self, api_key, api_secret):
+        self.api_key = api_key
+        self.api_secret = api_secret
+
+    def send(self, messages):
+        data = {
+            'Messages': [
+                {
+                    'From': {'Email': message['from'], 'Name': 'GiftManager'},
+                    'To': [{'Email': message['to'], 'Name': message['to_name']}],
+                    'Subject': message['subject'],
+                    'TextPart': message['text'],
                 }
+                for message in messages
+            ]
+        }
+        try:
+            response = http_client.post(
+                'https://api.mailjet.com/v3.1/send',
+                json=data,
+                auth=(self.api_key, self.api_secret)
+            )
+        except requests.exceptions.RequestException as e:
+            return [f'{e}'] * len(messages)
+
+        try:
+            results = response.json().get('Messages') or []
+        except ValueError:
+            results = []
+        if len(results) != len(messages):
+            error = f'HTTP {response.status_code}' if response.status_code != 200 else 'Unexpected response from Mailjet'
+            return [error] * len(messages)
+
+        # Mailjet reports every message separately, in the order they were sent
+        errors = []
+        for result in results:
+            if result.get('Status') == 'success':
+                errors.append(None)
+            else:
+                details = result.get('Errors') or [{}]
+                errors.append(details[0].get('ErrorMessage') or 'Rejected by Mailjet')
+        return errors
+
 
-                response = mailjet.send.create(data=data)
+class SmtpTransport:
+    """Sends messages over one SMTP connection per batch."""
 
-                if response.status_code == 200:
-                    print('Email sent to buyer successfully')
+    name = 'smtp'
+    batch_size = 20
+
+    def __init__(self, host, port=587, username=None, password=None, starttls=True, timeout=15):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, messages):
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as connection:
+                if self.starttls:
+                    connection.starttls()
+                if self.username:
+                    connection.login(self.username, self.password or '')
+                errors = []
+                for message in messages:
+                    try:
+                        connection.send_message(build_email_message(message))
+                        errors.append(None)
+                    except smtplib.SMTPRecipientsRefused as e:
+                        errors.append(f'Recipient refused: {e}')
+                return errors
+        except (OSError, smtplib.SMTPException) as e:
+            return [f'{e}'] * len(messages)
+
+
+class FileTransport:
+    """Writes every message as an .eml file instead of sending it, for setups without a mail provider."""
+
+    name = 'file'
+    batch_size = 50
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def send(self, messages):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            return [f'{e}'] * len(messages)
+        errors = []
+        for message in messages:
+            try:
+                path = self.directory / f"{message['id']}.eml"
+                path.write_bytes(build_email_message(message).as_bytes())
+                errors.append(None)
+            except OSError as e:
+                errors.append(f'{e}')
+        return errors
+
+
+def build_email_message(message):
+    email_message = EmailMessage()
+    email_message['From'] = formataddr(('GiftManager', message['from']))
+    email_message['To'] = formataddr((message['to_name'], message['to']))
+    email_message['Subject'] = message['subject']
+    email_message.set_content(message['text'])
+    return email_message
+
+def email_transport():
+    """Return the transport picked by EMAIL_TRANSPORT, or None when email is not configured.
+
+    Without EMAIL_TRANSPORT, Mailjet is used as soon as its keys are set.
+    """
+    name = (settings.get('EMAIL_TRANSPORT') or 'mailjet').strip().lower()
+    if name == 'file':
+        return FileTransport(app.config['OUTBOX_SENT_DIR'])
+    if name == 'smtp':
+        host = settings.get('SMTP_HOST')
+        if not host:
+            return None
+        return SmtpTransport(
+            host,
+            port=settings.get_int('SMTP_PORT', 587),
+            username=settings.get('SMTP_USERNAME'),
+            password=settings.get('SMTP_PASSWORD'),
+            starttls=settings.get_bool('SMTP_STARTTLS', True)
+        )
+    api_key = settings.get('MAILJET_API_KEY')
+    api_secret = settings.get('MAILJET_API_SECRET')
+    if not api_key or not api_secret:
+        return None
+    return MailjetTransport(api_key, api_secret)
+
+
+class EmailOutbox:
+    """Persistent queue of outgoing emails, sent off the request path.
+
+    Messages are stored in a JSON file shared by all workers, so nothing is
+    lost on a restart and requests only pay for appending to it. Enqueueing
+    starts a sender thread in the current process that sends what was queued
+    and exits; retries and leftovers are drained by the scheduler. Draining
+    claims due messages under the process lock, sends them in batches through
+    the configured transport and records the outcome. Failed messages are
+    retried with exponential backoff until max_attempts, then kept as failed.
+    A claim that is not settled within claim_timeout (a worker died
+    mid-send) is picked up again.
+    """
+
+    def __init__(self, path, transport_factory, max_attempts=6, retry_base=30, retry_max=3600,
+                 claim_timeout=300, batch_delay=0.5, keep_finished=200):
+        self.path = Path(path)
+        self.transport_factory = transport_factory
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.claim_timeout = claim_timeout
+        self.batch_delay = batch_delay
+        self.keep_finished = keep_finished
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @contextmanager
+    def _exclusive(self):
+        # The process lock is shared by all threads of a process, the file lock orders them
+        with self._file_lock, process_lock:
+            yield
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"Error reading email outbox: {e}")
+            return []
+
+    def _write(self, messages):
+        # Drop the oldest delivered/failed messages beyond keep_finished
+        finished = [message for message in messages if message['status'] in ('sent', 'failed')]
+        if len(finished) > self.keep_finished:
+            dropped = {id(message) for message in finished[:len(finished) - self.keep_finished]}
+            messages = [message for message in messages if id(message) not in dropped]
+        atomic_write_json(self.path, messages, indent=2)
+
+    def enqueue(self, to, subject, text, to_name=''):
+        message = {
+            'id': secrets.token_hex(8),
+            'from': settings.get('SYSTEM_EMAIL') or '',
+            'to': to,
+            'to_name': to_name,
+            'subject': subject,
+            'text': text,
+            'status': 'pending',
+            'attempts': 0,
+            'created_at': time.time(),
+            'next_attempt_at': 0,
+            'claimed_until': None,
+            'sent_at': None,
+            'last_error': None,
+        }
+        with self._exclusive():
+            messages = self._read()
+            messages.append(message)
+            self._write(messages)
+        self._start_sender()
+        return message['id']
+
+    def _start_sender(self):
+        with self._lock:
+            self._wakeup.set()
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._send_queued, name='email-outbox', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _send_queued(self):
+        while True:
+            # Give messages queued together a moment to go out in the same batch
+            time.sleep(self.batch_delay)
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                print(f"Error draining email outbox: {e}")
+            with self._lock:
+                if not self._wakeup.is_set():
+                    self._thread = None
+                    return
+
+    def _is_due(self, message, now):
+        if message['status'] == 'pending':
+            return message['next_attempt_at'] <= now
+        return message['status'] == 'sending' and message['claimed_until'] <= now
+
+    def _claim(self, limit):
+        now = time.time()
+        with self._exclusive():
+            messages = self._read()
+            claimed = []
+            for message in messages:
+                if len(claimed) >= limit:
+                    break
+                if self._is_due(message, now):
+                    message['status'] = 'sending'
+                    message['claimed_until'] = now + self.claim_timeout
+                    claimed.append(message)
+            if claimed:
+                self._write(messages)
+        return claimed
+
+    def _settle(self, claimed, errors):
+        now = time.time()
+        outcome = {message['id']: error for message, error in zip(claimed, errors)}
+        with self._exclusive():
+            messages = self._read()
+            for message in messages:
+                if message['id'] not in outcome or message['status'] != 'sending':
+                    continue
+                error = outcome[message['id']]
+                message['attempts'] += 1
+                message['claimed_until'] = None
+                if error is None:
+                    message['status'] = 'sent'
+                    message['sent_at'] = now
+                    message['last_error'] = None
+                elif message['attempts'] >= self.max_attempts:
+                    message['status'] = 'failed'
+                    message['last_error'] = error
                 else:
-                    print('Failed to send email to buyer')
-            else:
-                print(f'Buyer email not found for username: {buyer_username}')
-            break
+                    backoff = min(self.retry_max, self.retry_base * 2 ** (message['attempts'] - 1))
+                    message['status'] = 'pending'
+                    message['next_attempt_at'] = now + backoff * random.uniform(0.8, 1.2)
+                    message['last_error'] = error
+            self._write(messages)
+
+    def drain(self):
+        """Send everything that is due, return how many messages were sent and how many failed."""
+        sent = failed = 0
+        while True:
+            transport = self.transport_factory()
+            if transport is None:
+                break
+            claimed = self._claim(transport.batch_size)
+            if not claimed:
+                break
+            errors = transport.send(claimed)
+            self._settle(claimed, errors)
+            for message, error in zip(claimed, errors):
+                if error is None:
+                    sent += 1
+                    print(f"Email sent to {message['to']} via {transport.name}")
+                else:
+                    failed += 1
+                    print(f"Failed to send email to {message['to']} via {transport.name}: {error}")
+        return sent, failed
+
+    def stats(self):
+        counts = {'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0}
+        last_error = None
+        for message in self._read():
+            counts[message['status']] = counts.get(message['status'], 0) + 1
+            if message['status'] in ('pending', 'failed') and message['last_error']:
+                last_error = message['last_error']
+        counts['last_error'] = last_error
+        return counts
+
+
+outbox = EmailOutbox(app.config['OUTBOX_FILE'], email_transport)
+
+def send_email_to_buyer(buyer_username, idea_name, message_subject):
+    if email_transport() is None:
+        print("Email not configured. Skipping email notification.")
+        return False
+
+    buyer_email = get_user_email_by_username(buyer_username)
+    if not buyer_email:
+        print(f'Buyer email not found for username: {buyer_username}')
+        return False
+
+    text_part = f"This ideas, '{idea_name}',has been deleted but you already BOUGHT IT."
+    outbox.enqueue(buyer_email, message_subject, text_part, to_name=display_names()[buyer_username])
+    return True
 
 @app.route('/logout')
 def logout():
@@ -926,11 +3226,8 @@ def logout():
 @guest_allowed
 def dashboard():
     
-    # Read user data from the JSON file
-    users = load_users()
-
-    # Get the current user's data from the session
-    current_user = next((user for user in users if user['username'] == session['username']), None)
+    # Get the current user's data resolved for this request
+    current_user = current_identity().user
     
     if not current_user:
         flash('User data not found', 'danger')
@@ -939,127 +3236,48 @@ def dashboard():
     # Check if current user is a guest
     is_guest = current_user.get('guest', False)
     
-    # Initialize visible_users
-    visible_users = []
-
     # Initialize groups, that current user is a member of (to be filled down below)
     member_groups = []
     
     # Get boolean setting from user, if the dashboard should show the users grouped
     show_groups = (current_user.get('dashboard_user_grouping', 'false') == 'true')
+
+    # Users the current user can see: guests see their assigned families or people,
+    # regular users see their families and everyone without a family
+    visibility = visibility_index()
+    visible_users = visibility.visible_users(current_user['username'])
     
-    if is_guest:
-        # Handle guest user access
-        access_type = current_user.get('access_type', 'family')
-        
-        if access_type == 'family':
-            # Show users in guest's assigned groups (including guest groups)
-            guest_groups = current_user.get('groups', [])
-            visible_users = [
-                user for user in users
-                if user.get('groups') and any(group in guest_groups for group in user['groups'])
-                and not user.get('guest')  # Don't show other guests
-            ]
-        else:  # people access
-            # Show specific users assigned to guest
-            access_users = current_user.get('access_users', [])
-            visible_users = [
-                user for user in users
-                if user['username'] in access_users and not user.get('guest')
-            ]
-    else:
-        # Regular user logic
+    if not is_guest and show_groups:
         current_user_groups = current_user.get('groups', [])
         
-        # If current user has no groups, show all non-guest users
         if not current_user_groups:
-            visible_users = [user for user in users if not user.get('guest')]
-            
-            if show_groups:
-                # Get ALL groups from ALL users
-                all_groups = set()
-                for user in visible_users:
-                    all_groups.update(user.get('groups', []))
-                
-                # Create groups current user appears in ALL groups
-                member_groups = []
-                
-                for group in all_groups:
-                    # Get users who belong to this group
-                    group_members = [user for user in visible_users if group in user.get('groups', [])]
-                    
-                    # Add current user to EVERY group
-                    if current_user not in group_members:
-                        group_members.append(current_user)
-                    
-                    if group_members:
-                        member_groups.append({
-                            "name": group,
-                            "members": group_members
-                        })
+            # Users without a family appear in ALL groups of the visible users
+            all_groups = sorted({group for user in visible_users for group in user.get('groups', [])})
+            for group in all_groups:
+                member_groups.append({
+                    "name": group,
+                    "members": [*visibility.members(group), visibility.users_by_name[current_user['username']]]
+                })
         else:
-            if show_groups:
-                # First, get all users who should be visible (same logic as when show_groups=False)
-                visible_users = [
-                    user for user in users
-                    if (not user.get('groups') or any(group in current_user_groups for group in user.get('groups', [])))
-                    and not user.get('guest')
-                ]
-                
-                # Now create groups users with no groups should appear in ALL groups
-                member_groups = []
-                
-                for group in current_user_groups:
-                    # Get users who belong to this specific group
-                    group_members = []
-                    
-                    for user in visible_users:
-                        user_groups = user.get('groups', [])
-                        
-                        # User belongs to this group if:
-                        # 1. They have this group in their groups list, OR
-                        # 2. They have no groups at all (appear in all groups)
-                        if group in user_groups or not user_groups:
-                            group_members.append(user)
-                    
-                    if group_members:  # Only add group if it has members
-                        member_groups.append({
-                            "name": group,
-                            "members": group_members
-                        })
-                    
-            else:
-                # If current user has groups but does not want grouping on the dashboard
-                # Show users who share groups OR have no groups
-                visible_users = [
-                    user for user in users
-                    if (not user.get('groups') or any(group in current_user_groups for group in user.get('groups', [])))
-                    and not user.get('guest')
-                ]
-        
-        # Move current user to top
-        if show_groups:
-            # Find which group(s) contain the current user and move to top in each
-            for group in member_groups:
-                group['members'].insert(0, group['members'].pop(group['members'].index(current_user)))
-        else:
-            if current_user in visible_users:
-                visible_users.insert(0, visible_users.pop(visible_users.index(current_user)))
-
-    # Sort the users alphabetically by full name
+            # Users with no groups appear in ALL of the current user's groups
+            for group in current_user_groups:
+                group_members = [*visibility.members(group), *visibility.ungrouped]
+                if group_members:  # Only add group if it has members
+                    member_groups.append({
+                        "name": group,
+                        "members": group_members
+                    })
+
+    # Sort the users alphabetically by full name, with the current user on top
+    sort_key = lambda x: (x['username'] != current_user['username'], x['full_name'].lower())
     if show_groups:
+        # Guests have no groups to show, as before they get an empty grouped view
         # Set sorted_users to empty, since we don't need them with the grouping
         sorted_users = []
         for group in member_groups:
-            group['members'] = sorted(
-                    group['members'],
-                    key=lambda x: (x['username'] != current_user['username'], x['full_name'].lower())
-                )
+            group['members'] = sorted(group['members'], key=sort_key)
     else:
-        sorted_users = sorted(
-                visible_users,
-                key=lambda x: (x['username'] != current_user['username'], x['full_name'].lower())
-            )
+        sorted_users = sorted(visible_users, key=sort_key)
 
 
     # Prepare the profile information for the current user
@@ -1107,11 +3325,8 @@ def change_password():
     # Hash the new password before storing it
     newhash = password_hash(new_password)
 
-    # Read the users data from the JSON file
-    users = load_users()
-
     # Find the current user
-    current_user = next((user for user in users if user['username'] == session['username']), None)
+    current_user = lookup_user(session['username'])
 
     if not current_user:
         flash('User not found', 'danger')
@@ -1127,11 +3342,21 @@ def change_password():
         flash('New password and confirmation do not match', 'danger')
         return redirect(url_for('dashboard'))
 
-    # Update the password in the user data
-    current_user['password'] = newhash
+    with store.transaction():
+        # Read the users data from the JSON file
+        users = load_users()
+        user = next((user for user in users if user['username'] == session['username']), None)
+
+        # The password was changed by another request since it was verified
+        if not user or user['password'] != current_user['password']:
+            flash('Current password is incorrect', 'danger')
+            return redirect(url_for('dashboard'))
+
+        # Update the password in the user data
+        user['password'] = newhash
 
-    # Save the updated user data back to the JSON file
-    save_users(users)
+        # Save the updated user data back to the JSON file
+        save_users(users)
 
     flash('Password successfully changed', 'success')
     return redirect(url_for('dashboard'))
@@ -1150,34 +3375,35 @@ def find_idea_by_id(ideas, idea_id):
 @login_required
 @guest_allowed
 def mark_as_bought(idea_id):
-    # Load the current gift ideas from the JSON file
-    gift_ideas_data = load_gift_ideas()
-
-    # Find the idea by its ID
-    idea = find_idea_by_id(gift_ideas_data, idea_id)
-
     data = request.get_json()
-    hide_purchaser = read_env_variable('HIDE_PURCHASER', 'false').lower() == 'true'
+    hide_purchaser = settings.get_bool('HIDE_PURCHASER', False)
     bought_anonymously = True if 'anonymous' in data.keys() and data['anonymous'] else False
 
-    if idea:
-        if not idea['bought_by']:
-            # Mark the idea as bought by the current user
-            idea['bought_by'] = session['username']
-            idea['date_bought'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Record the current date and time
-            idea['bought_anonymously'] = bought_anonymously
-            flash(f'Marked "{idea["gift_name"]}" as bought!', 'success')
-
-            # Save the updated gift ideas back to the JSON file
-            save_gift_ideas(gift_ideas_data)  # Save the updated list
+    with store.transaction():
+        # Load the current gift ideas from the JSON file
+        gift_ideas_data = load_gift_ideas()
+
+        # Find the idea by its ID
+        idea = find_idea_by_id(gift_ideas_data, idea_id)
+
+        if idea:
+            if not idea['bought_by']:
+                # Mark the idea as bought by the current user
+                idea['bought_by'] = session['username']
+                record_purchase_time(idea)  # Record the current date and time
+                idea['bought_anonymously'] = bought_anonymously
+                flash(f'Marked "{idea["gift_name"]}" as bought!', 'success')
+
+                # Save the updated gift ideas back to the JSON file
+                save_gift_ideas(gift_ideas_data)  # Save the updated list
+            else:
+                # If already bought, display a warning
+                if hide_purchaser or bought_anonymously:
+                    flash(f'"{idea["gift_name"]}" has already been bought by an anonymous user.', 'warning')
+                else:    
+                    flash(f'"{idea["gift_name"]}" has already been bought by {idea["bought_by"]}.', 'warning')
         else:
-            # If already bought, display a warning
-            if hide_purchaser or bought_anonymously:
-                flash(f'"{idea["gift_name"]}" has already been bought by an anonymous user.', 'warning')
-            else:    
-                flash(f'"{idea["gift_name"]}" has already been bought by {idea["bought_by"]}.', 'warning')
-    else:
-        flash('Idea not found', 'danger')
+            flash('Idea not found', 'danger')
 
     # Redirect to the user's gift ideas page
     return redirect(url_for('user_gift_ideas', selected_user_id=session['username']))
@@ -1187,26 +3413,28 @@ def mark_as_bought(idea_id):
 @login_required
 @guest_allowed
 def mark_as_not_bought(idea_id):
-    # Load the current gift ideas from the JSON file
-    gift_ideas_data = load_gift_ideas()
+    with store.transaction():
+        # Load the current gift ideas from the JSON file
+        gift_ideas_data = load_gift_ideas()
 
-    # Find the idea by its ID
-    idea = find_idea_by_id(gift_ideas_data, idea_id)
+        # Find the idea by its ID
+        idea = find_idea_by_id(gift_ideas_data, idea_id)
 
-    if idea:
-        # Check if the idea has already been bought and if the current user is the buyer
-        if idea['bought_by'] == session['username']:
-            # Mark the idea as not bought by setting 'bought_by' to None (or '' if preferred)
-            idea['bought_by'] = None  # Using None is semantically clearer than ''
-            idea.pop('date_bought', None)  # Remove the date_bought field if it exists
-            flash(f'Marked "{idea["gift_name"]}" as not bought.', 'success')
-
-            # Save the updated gift ideas back to the JSON file
-            save_gift_ideas(gift_ideas_data)  # Save the updated list
+        if idea:
+            # Check if the idea has already been bought and if the current user is the buyer
+            if idea['bought_by'] == session['username']:
+                # Mark the idea as not bought by setting 'bought_by' to None (or '' if preferred)
+                idea['bought_by'] = None  # Using None is semantically clearer than ''
+                idea.pop('date_bought', None)  # Remove the date_bought field if it exists
+                idea.pop('bought_at', None)
+                flash(f'Marked "{idea["gift_name"]}" as not bought.', 'success')
+
+                # Save the updated gift ideas back to the JSON file
+                save_gift_ideas(gift_ideas_data)  # Save the updated list
+            else:
+                flash(f'You did not buy "{idea["gift_name"]}", so you cannot mark it as not bought.', 'danger')
         else:
-            flash(f'You did not buy "{idea["gift_name"]}", so you cannot mark it as not bought.', 'danger')
-    else:
-        flash('Idea not found', 'danger')
+            flash('Idea not found', 'danger')
 
     return '', 204  # Return a response with HTTP status code 204 (no content)
 
@@ -1215,26 +3443,32 @@ def mark_as_not_bought(idea_id):
 @login_required
 @guest_allowed
 def bought_items():
-    # Load the current gift ideas and users from the JSON files
-    gift_ideas_data = load_gift_ideas()
-    users = load_users()
-
-    # Filter the gift ideas to include only the ones that are bought by the current user
-    bought_items = [idea for idea in gift_ideas_data if idea['bought_by'] == session['username']]
+    archive_page = request.args.get('archive_page', type=int)
+    has_more = False
+    if archive_page:
+        # Older purchases, read from the archive one page at a time
+        archive_page = max(1, archive_page)
+        bought_items, has_more = idea_archive.bought_by(session['username'], archive_page)
+    else:
+        # Get the gift ideas that are bought by the current user
+        bought_items = load_gift_ideas_bought_by(session['username'])
 
     # Add the full name for each bought item
     for item in bought_items:
         item['recipient_name'] = get_full_name(item['user_id'])
 
-    return render_template('bought_items.html', bought_items=bought_items)
+    return render_template(
+        'bought_items.html',
+        bought_items=bought_items,
+        archive_page=archive_page,
+        has_more=has_more,
+        has_archive=archive_page or bool(idea_archive.years())
+    )
 
 
 def get_full_name(username):
-    users = load_users()  # Load the users from the JSON file
-    for user in users:
-        if user['username'] == username:
-            return user.get('full_name', username)  # Return the full name or fallback to username
-    return username  # If no match found, return the username itself
+    # Return the full name, or the username itself if no match is found
+    return display_names()[username]
 
 
 @app.route('/user_gift_ideas/<path:selected_user_id>')
@@ -1247,36 +3481,26 @@ def user_gift_ideas(selected_user_id):
         # Redirect to a different page, e.g., 'my_ideas'
         return redirect(url_for('my_ideas'))
 
-    # Filter the gift ideas for the selected user
-    gift_ideas_data = load_gift_ideas()  # Load the gift ideas from the JSON file
-    user_gift_ideas = [idea for idea in gift_ideas_data if idea['user_id'] == selected_user_id]
-
-    # Sort the gift ideas by priority, with ideas that have no priority appearing at the bottom
-    user_gift_ideas.sort(key=lambda x: (x.get('priority', float('inf')), x['gift_idea_id']))
+    # Get the gift ideas for the selected user, sorted by priority (ideas without one at the bottom)
+    user_gift_ideas = load_gift_ideas_for(selected_user_id)
 
     # Check if there are no ideas and redirect to the NOIDEA page
     if not user_gift_ideas:
         flash('No gift ideas for this user.', 'info')
         return redirect(url_for('noidea'))
     
-    imgenabled = read_env_variable('IMGENABLED', 'true').lower() == 'true'
+    imgenabled = settings.get_bool('IMGENABLED', True)
     hide_purchaser = read_env_variable('HIDE_PURCHASER', 'user_choice')
 
     # Ensure each idea has custom_fields and last_updated fields for template
     for idea in user_gift_ideas:
         if 'custom_fields' not in idea:
             idea['custom_fields'] = {}
-        # Replace bought_by if bought anonymously or globally hiding purchaser, for not leaking the info, but not for items bought by current user
-        if ('bought_by' in idea and
-            idea['bought_by'] and 
-            idea['bought_by'] != connected_user and
-            (('bought_anonymously' in idea and 
-                idea['bought_anonymously'] == True ) or
-            hide_purchaser)):
-            idea['bought_by'] = "Anonymous"
+        hide_purchaser_details(idea, connected_user, hide_purchaser)
 
-    users = load_users()
-    shared_list = next((user for user in users if user['username'] == selected_user_id and user.get('shared_list')), None)
+    shared_list = lookup_user(selected_user_id)
+    if shared_list and not shared_list.get('shared_list'):
+        shared_list = None
     is_shared_list_member = shared_list and connected_user in shared_list.get('list_members', [])
     # Call get_full_name function to fetch the user's full name directly in the route
     user_namels = get_full_name(selected_user_id)  # Get the full name based on the selected user ID
@@ -1288,23 +3512,29 @@ def user_gift_ideas(selected_user_id):
         is_shared_list_member=is_shared_list_member)
 
 
+def hide_purchaser_details(idea, viewer, hide_purchaser):
+    # Replace bought_by if bought anonymously or globally hiding purchaser, for not leaking the info, but not for items bought by current user
+    if ('bought_by' in idea and
+        idea['bought_by'] and 
+        idea['bought_by'] != viewer and
+        (('bought_anonymously' in idea and 
+            idea['bought_anonymously'] == True ) or
+        hide_purchaser)):
+        idea['bought_by'] = "Anonymous"
+    return idea
+
+
 @app.route('/my_ideas')
 @login_required
 def my_ideas():
     # Get the connected user
     connected_user = session.get('username')
     
-    # Load the gift ideas from the JSON file using load_gift_ideas()
-    gift_ideas_data = load_gift_ideas()
-
-    # Filter the gift ideas to include only the ones added by the connected user
-    my_gift_ideas = [idea for idea in gift_ideas_data if idea['user_id'] == connected_user and idea.get('added_by') == connected_user]
+    # Get the connected user's gift ideas (sorted by priority) and keep the ones they added themselves
+    my_gift_ideas = [idea for idea in load_gift_ideas_for(connected_user) if idea.get('added_by') == connected_user]
 
-    # Sort the gift ideas by priority, with ideas that have no priority appearing at the bottom
-    my_gift_ideas.sort(key=lambda x: (x.get('priority', float('inf')), x['gift_idea_id']))
-
-    reordering = read_env_variable('REORDERING', 'true').lower() == 'true'
-    imgenabled = read_env_variable('IMGENABLED', 'true').lower() == 'true'
+    reordering = settings.get_bool('REORDERING', True)
+    imgenabled = settings.get_bool('IMGENABLED', True)
     # Check if there are no ideas and redirect to a different page
     if not my_gift_ideas:
         flash('You haven\'t added any gift ideas.', 'info')
@@ -1323,23 +3553,24 @@ def update_order():
     data = request.get_json()
     new_order = data.get('order')
 
-    # Load the gift ideas from the JSON file using load_gift_ideas()
-    gift_ideas_data = load_gift_ideas()
-
-    # Loop to update the priorities of ideas
-    for idea in gift_ideas_data:
-        for item in new_order:
-            if int(idea['gift_idea_id']) == int(item['gift_idea_id']):
-                priority = item.get('priority')
-                if priority is None or priority == '':
-                    # Remove the priority field completely from JSON
-                    if 'priority' in idea:
-                        del idea['priority']
-                else:
-                    idea['priority'] = priority
+    with store.transaction():
+        # Load the gift ideas from the JSON file using load_gift_ideas()
+        gift_ideas_data = load_gift_ideas()
 
-    # Write the updated data back to the JSON file using save_gift_ideas()
-    save_gift_ideas(gift_ideas_data)
+        # Loop to update the priorities of ideas
+        for idea in gift_ideas_data:
+            for item in new_order:
+                if int(idea['gift_idea_id']) == int(item['gift_idea_id']):
+                    priority = item.get('priority')
+                    if priority is None or priority == '':
+                        # Remove the priority field completely from JSON
+                        if 'priority' in idea:
+                            del idea['priority']
+                    else:
+                        idea['priority'] = priority
+
+        # Write the updated data back to the JSON file using save_gift_ideas()
+        save_gift_ideas(gift_ideas_data)
 
     return "Order updated successfully!"
 
@@ -1384,10 +3615,17 @@ def generate_random_avatar(filename=None):
     return filename
 
 # Cleanup unused avatars
-def cleanup_unused_avatars(users):
-    """Delete only unused SVG avatars, never delete PNGs"""
+def cleanup_unused_avatars(users, min_age=0):
+    """Delete only unused SVG avatars, never delete PNGs
+
+    Avatars younger than min_age seconds are kept, they may have just been
+    generated for someone who has not saved their choice yet.
+    Returns the number of deleted avatars.
+    """
     avatar_dir = Path(app.config['AVATAR_DIR'])
     assigned_avatars = set(u.get('avatar') for u in users if u.get('avatar'))
+    newest_allowed = time.time() - min_age
+    removed = 0
 
     for file_path in avatar_dir.iterdir():
         if not file_path.is_file():
@@ -1400,9 +3638,15 @@ def cleanup_unused_avatars(users):
         # Only delete if not assigned to any user
         if file_path.name not in assigned_avatars:
             try:
+                if file_path.stat().st_mtime > newest_allowed:
+                    continue
                 os.remove(file_path)
+                removed += 1
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 print(f"[cleanup_unused_avatars] Error deleting {file_path.name}: {e}")
+    return removed
 
 # Generate avatar route
 @app.route('/generate_avatar', methods=['GET'])
@@ -1415,31 +3659,9 @@ def generate_avatar():
     filename = f"{datetime.now().timestamp()}.svg"
     path = avatar_dir / filename
 
-    # Generate avatar
+    # Generate avatar, unassigned ones are cleaned up by the avatar_gc job
     generate_random_avatar(filename)
 
-    # Cleanup unassigned avatars
-    users = load_users()
-    assigned_avatars = {u.get('avatar') for u in users if u.get('avatar')}
-
-    for file_path in avatar_dir.iterdir():
-        if not file_path.is_file():
-            continue
-
-        if file_path.suffix.lower() == '.png':
-            continue  # never delete PNGs
-
-        # Keep the avatar we just generated
-        if file_path.name == filename:
-            continue
-
-        # Delete if not assigned
-        if file_path.name not in assigned_avatars:
-            try:
-                file_path.unlink()
-            except Exception as e:
-                print(f"[generate_avatar] Error deleting {file_path.name}: {e}")
-
     return jsonify({"filename": filename})
 
 
@@ -1447,9 +3669,7 @@ def generate_avatar():
 @app.route('/change_avatar', methods=['POST'])
 @login_required
 def change_avatar():
-    users = load_users()
-    user = next((u for u in users if u['username'] == session['username']), None)
-    if not user:
+    if lookup_user(session['username']) is None:
         flash('User not found', 'danger')
         return redirect(url_for('login'))
 
@@ -1506,11 +3726,15 @@ def change_avatar():
         flash('Avatar file not found!', 'danger')
         return redirect(url_for('dashboard'))
 
-    user['avatar'] = avatar
-    save_users(users)
+    with store.transaction():
+        users = load_users()
+        user = next((u for u in users if u['username'] == session['username']), None)
+        if not user:
+            flash('User not found', 'danger')
+            return redirect(url_for('login'))
 
-    # Cleanup unused avatars
-    cleanup_unused_avatars(users)
+        user['avatar'] = avatar
+        save_users(users)
 
     return redirect(url_for('dashboard'))
 
@@ -1520,9 +3744,6 @@ def change_avatar():
 @admin_required
 def add_user():
     if request.method == 'POST':
-        # Load the latest state from the JSON file to ensure consistency
-        users = load_users()  # Using load_users function to read the users
-
         # Retrieve form data
         username = request.form['username']
         password = request.form['password']
@@ -1549,28 +3770,32 @@ def add_user():
         # Hash the password
         hashed = password_hash(password)
 
-        # Check for duplicate usernames
-        if any(user['username'] == username for user in users):
-            flash('Username already exists!', 'error')
-            return redirect(url_for('add_user'))
+        with store.transaction():
+            # Load the latest state from the JSON file to ensure consistency
+            users = load_users()  # Using load_users function to read the users
 
-        # Create a new user object with default groups
-        new_user = {
-            "username": username,
-            "password": hashed,
-            "full_name": full_name,
-            "birthday": birthday,
-            "admin": False,
-            "email": email if email else "",
-            "avatar": avatar if avatar else "default.svg",  # Always set a default
-            "groups": []  # New user starts with no groups
-        }
+            # Check for duplicate usernames
+            if any(user['username'] == username for user in users):
+                flash('Username already exists!', 'error')
+                return redirect(url_for('add_user'))
+
+            # Create a new user object with default groups
+            new_user = {
+                "username": username,
+                "password": hashed,
+                "full_name": full_name,
+                "birthday": birthday,
+                "admin": False,
+                "email": email if email else "",
+                "avatar": avatar if avatar else "default.svg",  # Always set a default
+                "groups": []  # New user starts with no groups
+            }
 
-        # Append the new user to the in-memory list
-        users.append(new_user)
+            # Append the new user to the in-memory list
+            users.append(new_user)
 
-        # Save the updated users list back to the JSON file
-        save_users(users)  # Using save_users function to write the users to file
+            # Save the updated users list back to the JSON file
+            save_users(users)  # Using save_users function to write the users to file
 
         flash('User added successfully!', 'success')
         return redirect(url_for('manage_users'))
@@ -1585,103 +3810,328 @@ def add_user():
 @app.route('/edit_idea/<int:idea_id>', methods=['GET', 'POST'])
 @login_required
 def edit_idea(idea_id):
-    # Load the gift ideas from the JSON file
-    gift_ideas_data = load_gift_ideas()
-# Check if the idea was added by the current user, if it's in their list, OR if they're a member of the shared list
-    users = load_users()
-    
-    # Find the idea by its ID
-    idea = find_idea_by_id(gift_ideas_data, idea_id)
+    # Only a submitted form changes the idea
+    with store.transaction() if request.method == 'POST' else nullcontext():
+        # Load the gift ideas from the JSON file
+        gift_ideas_data = load_gift_ideas()
+        # Check if the idea was added by the current user, if it's in their list, OR if they're a member of the shared list
+        users = load_users()
 
-    shared_list = next((user for user in users if user['username'] == idea['user_id'] and user.get('shared_list')), None)
+        # Find the idea by its ID
+        idea = find_idea_by_id(gift_ideas_data, idea_id)
 
-    if idea:
-        current_user_username = session['username']  # Use 'username' from the session
+        shared_list = next((user for user in users if user['username'] == idea['user_id'] and user.get('shared_list')), None)
 
-        # Check if the idea was added by the current user or if it's in their list
-        if idea['added_by'] == current_user_username or idea['user_id'] == current_user_username or (shared_list and current_user_username in shared_list.get('list_members', [])):
-            if request.method == 'POST':
+        if idea:
+            current_user_username = session['username']  # Use 'username' from the session
 
-                # Update idea details with submitted form data
-                idea['description'] = request.form.get('description', '')
-                idea['link'] = request.form.get('link', '')
-                idea['value'] = request.form.get('value', None)
-                idea['image_path'] = request.form.get('image_path', '')  # Get the image path from the form
+            # Check if the idea was added by the current user or if it's in their list
+            if idea['added_by'] == current_user_username or idea['user_id'] == current_user_username or (shared_list and current_user_username in shared_list.get('list_members', [])):
+                if request.method == 'POST':
 
-                # Check if the image path is correctly retrieved
-                if idea['image_path']:
-                    print(f"Image path to save: {idea['image_path']}")
-                else:
-                    print("No image path provided.")
+                    # Update idea details with submitted form data
+                    idea['description'] = request.form.get('description', '')
+                    idea['link'] = request.form.get('link', '')
+                    idea['value'] = request.form.get('value', None)
+                    idea['image_path'] = request.form.get('image_path', '')  # Get the image path from the form
 
-                # Process custom fields (handle optional)
-                custom_fields = {}
-                
-                # Track which existing fields should be kept
-                existing_keys_to_keep = []
-                
-                # Get all field indices from the form
-                for key in request.form.keys():
-                    if key.startswith('existing_custom_key_'):
-                        field_id = key.split('_')[-1]
-                        existing_keys_to_keep.append(field_id)
-                
-                # Process only the existing fields that are still in the form
-                for field_id in existing_keys_to_keep:
-                    field_key = request.form.get(f'existing_custom_key_{field_id}', '').strip()
-                    field_value = request.form.get(f'existing_custom_value_{field_id}', '').strip()
-                    
-                    if field_key:  # Only add if key exists (even if value is empty)
-                        custom_fields[field_key] = field_value
-                
-                # Handle new custom fields
-                new_field_count = 0
-                for key in request.form.keys():
-                    if key.startswith('new_custom_field_key_'):
-                        field_num = key.split('_')[-1]
-                        field_key = request.form.get(f'new_custom_field_key_{field_num}', '').strip()
-                        field_value = request.form.get(f'new_custom_field_value_{field_num}', '').strip()
-                        
-                        if field_key:  # Only add if key exists
+                    # Check if the image path is correctly retrieved
+                    if idea['image_path']:
+                        print(f"Image path to save: {idea['image_path']}")
+                    else:
+                        print("No image path provided.")
+
+                    # Process custom fields (handle optional)
+                    custom_fields = {}
+
+                    # Track which existing fields should be kept
+                    existing_keys_to_keep = []
+
+                    # Get all field indices from the form
+                    for key in request.form.keys():
+                        if key.startswith('existing_custom_key_'):
+                            field_id = key.split('_')[-1]
+                            existing_keys_to_keep.append(field_id)
+
+                    # Process only the existing fields that are still in the form
+                    for field_id in existing_keys_to_keep:
+                        field_key = request.form.get(f'existing_custom_key_{field_id}', '').strip()
+                        field_value = request.form.get(f'existing_custom_value_{field_id}', '').strip()
+
+                        if field_key:  # Only add if key exists (even if value is empty)
                             custom_fields[field_key] = field_value
-                            new_field_count += 1
-                
-                # Update custom fields (this will remove any deleted fields)
-                idea['custom_fields'] = custom_fields
-                
-                # Update last_updated timestamp
-                idea['last_updated'] = datetime.now().isoformat()
-                
-                # Save the updated gift ideas data back to the JSON file
-                save_gift_ideas(gift_ideas_data)
 
-                flash('Idea updated successfully!', 'success')
-                return redirect(url_for('user_gift_ideas', selected_user_id=idea['user_id']))
-            
-            imgenabled = read_env_variable('IMGENABLED', 'true').lower() == 'true'
-            if 'custom_fields' not in idea:
-                idea['custom_fields'] = {}
-            # Render the edit idea form with pre-filled data
-            return render_template('edit_idea.html', idea=idea, imgenabled=imgenabled)
+                    # Handle new custom fields
+                    new_field_count = 0
+                    for key in request.form.keys():
+                        if key.startswith('new_custom_field_key_'):
+                            field_num = key.split('_')[-1]
+                            field_key = request.form.get(f'new_custom_field_key_{field_num}', '').strip()
+                            field_value = request.form.get(f'new_custom_field_value_{field_num}', '').strip()
+
+                            if field_key:  # Only add if key exists
+                                custom_fields[field_key] = field_value
+                                new_field_count += 1
+
+                    # Update custom fields (this will remove any deleted fields)
+                    idea['custom_fields'] = custom_fields
+
+                    # Update last_updated timestamp
+                    idea['last_updated'] = datetime.now().isoformat()
+
+                    # Save the updated gift ideas data back to the JSON file
+                    save_gift_ideas(gift_ideas_data)
+
+                    flash('Idea updated successfully!', 'success')
+                    return redirect(url_for('user_gift_ideas', selected_user_id=idea['user_id']))
+
+                imgenabled = settings.get_bool('IMGENABLED', True)
+                if 'custom_fields' not in idea:
+                    idea['custom_fields'] = {}
+                # Render the edit idea form with pre-filled data
+                return render_template('edit_idea.html', idea=idea, imgenabled=imgenabled)
+            else:
+                flash('You are not authorized to edit this idea.', 'danger')
         else:
-            flash('You are not authorized to edit this idea.', 'danger')
-    else:
-        flash('Idea not found', 'danger')
+            flash('Idea not found', 'danger')
 
     return redirect(url_for('dashboard'))
 
 
+class PasswordPoolSaturated(Exception):
+    """Raised when the password hashing pool has no room for more work."""
+
+
+class PasswordHashingPool:
+    """Admission control for argon2 hashing and verification.
+
+    argon2-cffi releases the GIL while hashing, so request threads already
+    hash in parallel and the jobs run on the calling thread. What needs a
+    bound is how many request threads are tied up in KDF work: at most
+    workers jobs run at once and at most queue_limit more wait for a slot.
+    Further jobs raise PasswordPoolSaturated (answered with a 503) right away.
+    The defaults are sized from the request threads per process, so the
+    limit is reachable and one thread always stays free for other requests.
+    """
+
+    def __init__(self, workers, queue_limit, history=200):
+        self.workers = max(1, workers)
+        self.queue_limit = max(0, queue_limit)
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+        self._peak = 0
+        self._completed = 0
+        self._rejected = 0
+        self._latencies = deque(maxlen=history)
+
+    def run(self, function, *args):
+        with self._condition:
+            if self._running >= self.workers and self._waiting >= self.queue_limit:
+                self._rejected += 1
+                raise PasswordPoolSaturated()
+            self._waiting += 1
+            self._peak = max(self._peak, self._running + self._waiting)
+            while self._running >= self.workers:
+                self._condition.wait()
+            self._waiting -= 1
+            self._running += 1
+
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._completed += 1
+                self._latencies.append(time.perf_counter() - started)
+                self._condition.notify()
+
+    def metrics(self):
+        with self._condition:
+            latencies = sorted(self._latencies)
+            return {
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'in_flight': self._running + self._waiting,
+                'queued': self._waiting,
+                'peak': self._peak,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_ms': round(1000 * sum(latencies) / len(latencies), 1) if latencies else None,
+                'p95_ms': round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1) if latencies else None,
+            }
+
+
+# Request threads per process, gunicorn's --threads in the Docker image
+request_threads = max(1, int(os.environ.get('GUNICORN_THREADS') or 4))
+password_workers = settings.get_int('PASSWORD_WORKERS', max(1, request_threads // 2))
+hashing_pool = PasswordHashingPool(
+    workers=password_workers,
+    queue_limit=settings.get_int('PASSWORD_QUEUE_LIMIT', max(0, request_threads - password_workers - 1))
+)
+
+@app.errorhandler(PasswordPoolSaturated)
+def password_pool_saturated(error):
+    response = make_response('Too many sign-ins at the moment, please try again in a few seconds.', 503)
+    response.headers['Retry-After'] = '5'
+    return response
+
+# Lowest argon2 costs ever used, the OWASP baseline for argon2id (19 MiB of memory, 2 iterations)
+ARGON2_MIN_TIME_COST = 2
+ARGON2_MIN_MEMORY_COST = 19456  # KiB
+
+def password_hasher():
+    """Return the PasswordHasher for the argon2 parameters in the .env file (library defaults if unset, never below the minimum)"""
+    global ph
+    params = (
+        max(ARGON2_MIN_TIME_COST, settings.get_int('ARGON2_TIME_COST', DEFAULT_PASSWORD_HASHER.time_cost)),
+        max(ARGON2_MIN_MEMORY_COST, settings.get_int('ARGON2_MEMORY_COST', DEFAULT_PASSWORD_HASHER.memory_cost)),
+        settings.get_int('ARGON2_PARALLELISM', DEFAULT_PASSWORD_HASHER.parallelism),
+    )
+    if (ph.time_cost, ph.memory_cost, ph.parallelism) != params:
+        ph = PasswordHasher(time_cost=params[0], memory_cost=params[1], parallelism=params[2])
+    return ph
+
+def measure_password_hash_ms(time_cost, memory_cost, parallelism, rounds=2):
+    hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hasher.hash(secrets.token_urlsafe(16))
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+def calibrate_password_hasher(budget_ms):
+    """Benchmark this machine and return the argon2 settings that keep one hash within budget_ms.
+
+    Starts from the argon2-cffi defaults. When a hash fits the budget the time
+    cost is raised while it still fits. Otherwise the memory cost is halved
+    down to ARGON2_MIN_MEMORY_COST, then the time cost lowered down to
+    ARGON2_MIN_TIME_COST, until a hash fits. Returns the settings, the
+    milliseconds per hash and whether that fits the budget, which it does not
+    when even the minimum costs are too slow for this machine.
+    """
+    parallelism = DEFAULT_PASSWORD_HASHER.parallelism
+    memory_cost = DEFAULT_PASSWORD_HASHER.memory_cost
+    time_cost = DEFAULT_PASSWORD_HASHER.time_cost
+
+    measured = measure_password_hash_ms(time_cost, memory_cost, parallelism)
+    if measured <= budget_ms:
+        while time_cost < 10:
+            slower = measure_password_hash_ms(time_cost + 1, memory_cost, parallelism)
+            if slower > budget_ms:
+                break
+            time_cost, measured = time_cost + 1, slower
+    else:
+        while measured > budget_ms and memory_cost > ARGON2_MIN_MEMORY_COST:
+            memory_cost = max(ARGON2_MIN_MEMORY_COST, memory_cost // 2)
+            measured = measure_password_hash_ms(time_cost, memory_cost, parallelism)
+        while measured > budget_ms and time_cost > ARGON2_MIN_TIME_COST:
+            time_cost -= 1
+            measured = measure_password_hash_ms(time_cost, memory_cost, parallelism)
+
+    return {
+        'ARGON2_TIME_COST': time_cost,
+        'ARGON2_MEMORY_COST': memory_cost,
+        'ARGON2_PARALLELISM': parallelism,
+    }, measured, measured <= budget_ms
+
+def apply_password_hasher_calibration(budget_ms):
+    """Calibrate the argon2 parameters and store them in the .env file"""
+    params, measured, within_budget = calibrate_password_hasher(budget_ms)
+    for key, value in params.items():
+        settings.set(key, value)
+    settings.set('PASSWORD_HASH_BUDGET_MS', budget_ms)
+    settings.set('PASSWORD_HASH_MEASURED_MS', round(measured))
+    print(f"Calibrated password hashing: time_cost={params['ARGON2_TIME_COST']}, "
+          f"memory_cost={params['ARGON2_MEMORY_COST']} KiB, {measured:.0f} ms per hash (budget {budget_ms} ms)")
+    if not within_budget:
+        print(f"The budget of {budget_ms} ms is unattainable on this machine, "
+              f"even the minimum argon2 costs take {measured:.0f} ms per hash")
+    return params, measured, within_budget
+
 # Hash the password using Argon2
 def password_hash(password):
-    return ph.hash(password)
+    return hashing_pool.run(password_hasher().hash, password)
 
 # Verify the hashed password
 def verify_password(hash, password):
     try:
-        return ph.verify(hash, password)
+        return hashing_pool.run(password_hasher().verify, hash, password)
     except VerifyMismatchError:
         return False
 
+def rehash_password_if_needed(username, hash, password):
+    """After a successful login, upgrade a hash made with weaker argon2 parameters.
+
+    Best effort: when the hashing pool is full the upgrade waits for a later
+    login, the sign-in itself never fails because of it.
+    """
+    hasher = password_hasher()
+    try:
+        if not hasher.check_needs_rehash(hash):
+            return
+        current = extract_parameters(hash)
+    except ValueError:
+        return
+    # Only ever strengthen a hash, never trade it for weaker parameters
+    if hasher.time_cost < current.time_cost or hasher.memory_cost < current.memory_cost:
+        return
+    try:
+        new_hash = password_hash(password)
+    except PasswordPoolSaturated:
+        print(f"Password hashing pool is full, not upgrading the hash of {username} now")
+        return
+    with store.transaction():
+        users = load_users()
+        for user in users:
+            # Skip if the password was changed in the meantime
+            if user['username'] == username and user.get('password') == hash:
+                user['password'] = new_hash
+        save_users(users)
+
+def guest_lookup_tag(password):
+    """Keyed tag of a guest password, lets guest_login find the guest without trying every hash.
+
+    The tag is an HMAC keyed with a key derived from SECRET_KEY, prefixed with
+    an ID of that key so tags made with an older SECRET_KEY are recognized.
+    """
+    key = hmac.new(str(app.config['SECRET_KEY'] or '').encode(), b'giftmanager guest login', hashlib.sha256).digest()
+    key_id = hashlib.sha256(key).hexdigest()[:8]
+    return f"{key_id}${hmac.new(key, password.encode(), hashlib.sha256).hexdigest()}"
+
+
+class GuestLoginIndex:
+    """Guest users by password lookup tag, derived from the users document."""
+
+    def __init__(self, users):
+        key_id = guest_lookup_tag('').split('$')[0]
+        self.by_tag = {}
+        # Guests without a tag made with the current SECRET_KEY, they are verified one by one
+        self.untagged = []
+        for user in users:
+            if not user.get('guest'):
+                continue
+            tag = user.get('guest_lookup_tag', '')
+            if tag.startswith(f'{key_id}$'):
+                self.by_tag.setdefault(tag, []).append(user)
+            else:
+                self.untagged.append(user)
+
+
+def guest_login_index():
+    return store.derived('users', 'guest_login', GuestLoginIndex)
+
+_dummy_password_hash = None
+
+def burn_password_verification(password):
+    """Spend the time of one password verification so failed logins cost as much as successful ones."""
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = password_hash(secrets.token_urlsafe(16))
+    verify_password(_dummy_password_hash, password)
+
 
 def is_valid_pool_name(name):
     return bool(re.match(r'^[a-zA-Z0-9_-]+$', name))
@@ -1758,15 +4208,19 @@ def secret_santa():
                 flash('Invalid pool name', 'error')
                 return redirect(url_for('secret_santa'))
             
-            deleted = False
-            for user in users:
-                if 'assigned_users' in user and pool_name in user['assigned_users']:
-                    del user['assigned_users'][pool_name]
-                    deleted = True
-            
+            with store.transaction():
+                users = load_users()
+                deleted = False
+                for user in users:
+                    if 'assigned_users' in user and pool_name in user['assigned_users']:
+                        del user['assigned_users'][pool_name]
+                        deleted = True
+
+                if deleted:
+                    os.remove(Path(app.config['DATA'], f'santa_inst_{pool_name}.txt'))
+                    save_users(users)
+
             if deleted:
-                os.remove(Path(app.config['DATA'], f'santa_inst_{pool_name}.txt'))
-                save_users(users)
                 flash(f'Pool "{pool_name}" deleted', 'success')
             else:
                 flash(f'Pool "{pool_name}" not found', 'error')
@@ -1862,14 +4316,17 @@ def secret_santa():
                                  errors=[f' Critical error: {exclusion_violations[0]}'])
         
         try:
-            # Save to users
-            for user in users:
-                if user['username'] in assignments:
-                    if 'assigned_users' not in user:
-                        user['assigned_users'] = {}
-                    user['assigned_users'][pool_name] = assignments[user['username']]
-            
-            save_users(users)
+            with store.transaction():
+                users = load_users()
+
+                # Save to users
+                for user in users:
+                    if user['username'] in assignments:
+                        if 'assigned_users' not in user:
+                            user['assigned_users'] = {}
+                        user['assigned_users'][pool_name] = assignments[user['username']]
+
+                save_users(users)
             
             # Save instructions
             with open(Path(app.config['DATA'], f'santa_inst_{pool_name}.txt'), 'w') as f:
@@ -1903,15 +4360,9 @@ def secret_santa():
 @login_required
 @guest_allowed
 def secret_santa_assignments():
-    current_user = session['username']
-
-    # Use the pre-defined load_users function to read users data
-    users = load_users()
-
-    assigned_users = {}
-    for user in users:
-        if user['username'] == current_user and 'assigned_users' in user:
-            assigned_users = user['assigned_users']  # Dictionary of pool names and assigned users
+    # Dictionary of pool names and assigned users of the current user
+    user = current_identity().user
+    assigned_users = user.get('assigned_users', {}) if user else {}
 
     if not assigned_users:
         flash("You don't have any Secret Santa assignments yet.", "error")
@@ -1933,7 +4384,7 @@ def secret_santa_assignments():
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
-    return render_template('admin_dashboard.html')
+    return render_template('admin_dashboard.html', password_pool=hashing_pool.metrics(), outbox=outbox.stats(), jobs=scheduler.status())
 
 @app.route('/users', methods=['GET', 'POST'])
 @admin_required
@@ -1948,38 +4399,14 @@ def manage_users():
     if request.method == 'POST':
         
         username = request.form.get('username')
-        
-        # Handle delete
-        if 'delete_user' in request.form:
-            # Remove only the regular user from both arrays
-            all_users = [user for user in all_users if user['username'] != username]
-            
-            # Remove user from list_members in shared lists
-            for user_obj in all_users:
-                if user_obj.get('shared_list') and 'list_members' in user_obj:
-                    if username in user_obj['list_members']:
-                        user_obj['list_members'].remove(username)
-            
-            flash('User deleted successfully!', 'success')
 
-        # Handle toggle admin
-        elif 'toggle_admin' in request.form:
-            for user in users:
-                if user['username'] == username:
-                    user['admin'] = bool(int(request.form['toggle_admin']))
-                    # Also update in all_users to maintain consistency
-                    for u in all_users:
-                        if u['username'] == username and not u.get('shared_list'):
-                            u['admin'] = bool(int(request.form['toggle_admin']))
-                    flash('Admin status updated successfully!', 'success')
-                    break
-
-        # Handle user details update
-        else:
+        # A user details update may come with a new avatar, store it before touching the users
+        if 'delete_user' not in request.form and 'toggle_admin' not in request.form:
             updated_name = request.form.get('name')
             updated_email = request.form.get('email')
             updated_password = request.form.get('password')
             updated_avatar = request.form.get('avatar')
+            updated_password_hash = password_hash(updated_password) if updated_password else None
             
             
             # Check if a new avatar file was uploaded
@@ -2020,28 +4447,58 @@ def manage_users():
                         flash('Generated avatar timed out and was deleted! Please generate a new one.', 'error')
                         return redirect(url_for('manage_users'))
 
-            # Update user details
-            for user in users:
-                if user['username'] == username:
-                    
-                    user['full_name'] = updated_name
-                    user['email'] = updated_email if updated_email else user.get('email', 'N/A')
-                    user['avatar'] = updated_avatar if updated_avatar else user.get('avatar', 'avatar1.png')
-                    if updated_password:
-                        user['password'] = ph.hash(updated_password)
-                    
-                    
-                    # Also update in all_users
-                    for u in all_users:
-                        if u['username'] == username and not u.get('shared_list'):
-                            u.update(user)
-                    
-                    flash('User updated successfully!', 'success')
-                    break
-            
+        with store.transaction():
+            # Reload the users the change applies to
+            all_users = load_users()
+            users = [user for user in all_users if not user.get('guest', False) and not user.get('shared_list', False)]
+
+            # Handle delete
+            if 'delete_user' in request.form:
+                # Remove only the regular user from both arrays
+                all_users = [user for user in all_users if user['username'] != username]
+
+                # Remove user from list_members in shared lists
+                for user_obj in all_users:
+                    if user_obj.get('shared_list') and 'list_members' in user_obj:
+                        if username in user_obj['list_members']:
+                            user_obj['list_members'].remove(username)
+
+                flash('User deleted successfully!', 'success')
+
+            # Handle toggle admin
+            elif 'toggle_admin' in request.form:
+                for user in users:
+                    if user['username'] == username:
+                        user['admin'] = bool(int(request.form['toggle_admin']))
+                        # Also update in all_users to maintain consistency
+                        for u in all_users:
+                            if u['username'] == username and not u.get('shared_list'):
+                                u['admin'] = bool(int(request.form['toggle_admin']))
+                        flash('Admin status updated successfully!', 'success')
+                        break
+
+            # Handle user details update
+            else:
+                for user in users:
+                    if user['username'] == username:
+
+                        user['full_name'] = updated_name
+                        user['email'] = updated_email if updated_email else user.get('email', 'N/A')
+                        user['avatar'] = updated_avatar if updated_avatar else user.get('avatar', 'avatar1.png')
+                        if updated_password_hash:
+                            user['password'] = updated_password_hash
+
+
+                        # Also update in all_users
+                        for u in all_users:
+                            if u['username'] == username and not u.get('shared_list'):
+                                u.update(user)
+
+                        flash('User updated successfully!', 'success')
+                        break
 
-        # Save ALL users (including shared lists) back to the file
-        save_users(all_users)
+            # Save ALL users (including shared lists) back to the file
+            save_users(all_users)
         
         # Reload for display
         all_users = load_users()
@@ -2154,58 +4611,56 @@ def edit_login_message():
 def delete_old_gift_ideas():
 
     # Read the number of days from the environment variable
-    threshold_days = int(read_env_variable("DELETE_DAYS", dotenv_path) or 30)
+    threshold_days = settings.get_int("DELETE_DAYS", 30)
 
     # Calculate the threshold time
-    threshold_time = datetime.now() - timedelta(days=threshold_days)
+    threshold = (datetime.now() - timedelta(days=threshold_days)).timestamp()
+
+    # Nothing crossed the threshold, leave the ideas file alone
+    if not purchase_expiry_index().expired(threshold):
+        return 0
+
+    with store.transaction():
+        # Look again under the lock, another worker may have purged in the meantime
+        expired_ids = purchase_expiry_index().expired(threshold)
+        if not expired_ids:
+            return 0
 
-    try:
         # Load gift ideas using the helper function
         gift_ideas_data = load_gift_ideas()
 
-        # Prepare a list to hold the updated gift ideas
+        # Keep every idea except the expired ones
         updated_gift_ideas = []
-        removed_count = 0
-
-        # Loop through each gift idea and check if it should be removed
+        archived = []
         for idea in gift_ideas_data:
-            if 'date_bought' in idea:
-                date_bought = datetime.strptime(idea['date_bought'], '%Y-%m-%d %H:%M:%S')
-
-                # If the gift idea's date_bought is older than the threshold, remove it
-                if date_bought < threshold_time:
-                    removed_count += 1
-                    continue  # Skip this gift idea
-
-            # Otherwise, keep this gift idea
+            if idea['gift_idea_id'] in expired_ids:
+                # Checked again in case of duplicate IDs from older versions
+                epoch = purchase_epoch(idea)
+                if epoch is not None and epoch < threshold:
+                    archived.append(idea)
+                    continue
             updated_gift_ideas.append(idea)
 
+        # Move them to the archive first, a crash in between leaves them in both places
+        idea_archive.append(archived)
+
         # Save the updated list of gift ideas using the helper function
         save_gift_ideas(updated_gift_ideas)
 
-        # Record the last execution time
-        last_execution_time = datetime.now().isoformat()
-        with open('last_execution_time.txt', 'w') as time_file:
-            time_file.write(last_execution_time)
-
-        # Return the number of removed ideas
-        return removed_count
-
-    except Exception as e:
-        print(f"Error: {e}")
-        return 0  # Return 0 if an error occurs
+    # Return the number of archived ideas, the scheduler records when it ran
+    return len(archived)
 
 @app.route('/delete_old_gift_ideas', methods=['GET', 'POST'])
 @admin_required
 def delete_old_gift_ideas_page():
-    current_days = read_env_variable("DELETE_DAYS", dotenv_path) or 30
+    current_days = settings.get_int("DELETE_DAYS", 30)
     if request.method == 'POST':
         try:
             # Delete old gift ideas and get the count of deleted rows
             deleted_count = delete_old_gift_ideas()
 
             # Flash success message with the number of deleted rows
-            flash(f"{deleted_count} gift ideas older than the threshold have been successfully deleted.", "success")
+            flash(f"{deleted_count} gift ideas older than the threshold have been moved to the archive.", "success")
 
             # Render the result to the template
             return render_template('delete_old_gift_ideas.html', deleted_count=deleted_count)
@@ -2230,7 +4685,7 @@ def change_delete_days():
                 new_days = int(new_days)
 
                 # Update the .env file with the new value
-                set_key(dotenv_path, "DELETE_DAYS", str(new_days))  # Update the DELETE_DAYS value
+                settings.set("DELETE_DAYS", str(new_days))  # Update the DELETE_DAYS value
 
                 flash(f"The number of days to delete old gift ideas has been updated to {new_days}.", "success")
                 return redirect(url_for('change_delete_days'))
@@ -2241,7 +4696,7 @@ def change_delete_days():
             flash("Please provide a value for the number of days.", "danger")
 
     # Get the current value of the DELETE_OLD_GIFTS_DAYS from the .env file
-    current_days = read_env_variable("DELETE_DAYS", dotenv_path) or 30
+    current_days = settings.get_int("DELETE_DAYS", 30)
     return render_template('delete_old_gift_ideas.html', current_days=current_days)
 
 @app.route('/setupadmin', methods=['GET', 'POST'])
@@ -2263,7 +4718,7 @@ def setup():
         birthday = request.form.get('birthday')
 
         # Hash the admin password
-        admin_password_hash = ph.hash(admin_password)
+        admin_password_hash = password_hash(admin_password)
 
         # Create the admin user dictionary
         admin_user = {
@@ -2276,11 +4731,18 @@ def setup():
             "admin": True
         }
 
-        # Append the admin user to the existing list of users
-        users_data.append(admin_user)
+        with store.transaction():
+            # Another request may have created the admin meanwhile
+            users_data = load_users()
+            if users_data:
+                flash('Users are already configured. Setup page is unavailable.', 'info')
+                return redirect(url_for('login'))
 
-        # Save the updated users list
-        save_users(users_data)
+            # Append the admin user to the existing list of users
+            users_data.append(admin_user)
+
+            # Save the updated users list
+            save_users(users_data)
 
         flash('Admin account created successfully. Please configure the environment variables.', 'success')
         return redirect(url_for('setupenv'))  # Redirect to the setupenv route
@@ -2316,7 +4778,7 @@ def setupenv():
 
         # Save each variable to .env file
         for key, value in env_variables.items():
-            set_key(dotenv_path, key, value)
+            settings.set(key, value)
 
         flash('Environment variables saved successfully!', 'success')
         return redirect(url_for('index'))
@@ -2351,7 +4813,7 @@ def setup_oidc():
         try:
             # Save each variable to the .env file
             for key, value in oidc_env_variables.items():
-                set_key(dotenv_path, key, value)
+                settings.set(key, value)
 
             flash('OIDC settings saved successfully!', 'success')
             return redirect(url_for('setup_oidc'))  # Redirect to home page after saving
@@ -2398,16 +4860,18 @@ def manage_groups():
         assigned_users = request.form.getlist('assigned_users')
 
         if new_group_name:
-            for user in users:
-                # Add the new group to selected users
-                if user['username'] in assigned_users:
-                    if 'groups' not in user:
-                        user['groups'] = []
-                    if new_group_name not in user['groups']:
-                        user['groups'].append(new_group_name)
-
-            # Save updated user data after adding the group using the helper function
-            save_users(users)
+            with store.transaction():
+                users = load_users()
+                for user in users:
+                    # Add the new group to selected users
+                    if user['username'] in assigned_users:
+                        if 'groups' not in user:
+                            user['groups'] = []
+                        if new_group_name not in user['groups']:
+                            user['groups'].append(new_group_name)
+
+                # Save updated user data after adding the group using the helper function
+                save_users(users)
 
             flash('New group added successfully!', 'success')
             return redirect(url_for('manage_groups'))
@@ -2418,23 +4882,24 @@ def manage_groups():
 @app.route('/update_group_assignments', methods=['POST'])
 @admin_required
 def update_group_assignments():
-    # Load user data using the helper function
-    users = load_users()
+    with store.transaction():
+        # Load user data using the helper function
+        users = load_users()
 
-    # Extract existing groups from the users
-    groups = sorted(set(group for user in users for group in user.get('groups', [])))
+        # Extract existing groups from the users
+        groups = sorted(set(group for user in users for group in user.get('groups', [])))
 
-    # Handle group assignments (checkboxes)
-    for user in users:
-        user_groups = []
-        for group in groups:
-            checkbox_name = f"{user['username']}[{group}]"
-            if request.form.get(checkbox_name):
-                user_groups.append(group)
-        user['groups'] = user_groups
+        # Handle group assignments (checkboxes)
+        for user in users:
+            user_groups = []
+            for group in groups:
+                checkbox_name = f"{user['username']}[{group}]"
+                if request.form.get(checkbox_name):
+                    user_groups.append(group)
+            user['groups'] = user_groups
 
-    # Save updated user data after assignments using the helper function
-    save_users(users)
+        # Save updated user data after assignments using the helper function
+        save_users(users)
 
     flash('Group assignments updated successfully!', 'success')
     return redirect(url_for('manage_groups'))
@@ -2449,11 +4914,29 @@ def setup_advanced():
     images = read_env_variable("IMGENABLED")
     current_currency_symbol = get_currency_symbol()
     current_currency_position = get_currency_position()
-    enable_self_registration = read_env_variable("ENABLE_SELF_REGISTRATION", "false").lower() == 'true'
-    enable_link_sharing = read_env_variable("ENABLE_LINK_SHARING", "true").lower() == 'true'
+    enable_self_registration = settings.get_bool('ENABLE_SELF_REGISTRATION', False)
+    enable_link_sharing = settings.get_bool('ENABLE_LINK_SHARING', True)
     joining_code = read_env_variable("JOINING_CODE", "")
+    login_throttle_settings = {
+        'enabled': settings.get_bool('LOGIN_THROTTLE', True),
+        'ip_attempts': settings.get_int('LOGIN_IP_ATTEMPTS_PER_MINUTE', 20),
+        'user_attempts': settings.get_int('LOGIN_USER_ATTEMPTS_PER_MINUTE', 5),
+        **login_throttle.stats()
+    }
+    hasher = password_hasher()
+    password_hashing = {
+        'time_cost': hasher.time_cost,
+        'memory_cost': hasher.memory_cost,
+        'parallelism': hasher.parallelism,
+        'budget_ms': settings.get_int('PASSWORD_HASH_BUDGET_MS', 250),
+        'measured_ms': settings.get_int('PASSWORD_HASH_MEASURED_MS', 0),
+        'min_time_cost': ARGON2_MIN_TIME_COST,
+        'min_memory_cost': ARGON2_MIN_MEMORY_COST,
+    }
     
     return render_template('advanced.html',
+                         password_hashing=password_hashing,
+                         login_throttle=login_throttle_settings,
                          hide_purchaser=hide_purchaser,
                          current_reorder=current_reorder,
                          images=images,
@@ -2474,7 +4957,7 @@ def update_hide_purchaser():
     if hide_purchaser_value not in allowed_values:
         hide_purchaser_value = 'user_choice'  # Default fallback
     
-    set_key(dotenv_path, "HIDE_PURCHASER", hide_purchaser_value)
+    settings.set("HIDE_PURCHASER", hide_purchaser_value)
     return redirect(url_for('setup_advanced'))
 
 
@@ -2483,7 +4966,7 @@ def update_hide_purchaser():
 @admin_required
 def update_reordering():
     reordering = request.form.get('reordering', 'true').strip()
-    set_key(dotenv_path, "REORDERING", reordering)
+    settings.set("REORDERING", reordering)
     return redirect(url_for('setup_advanced'))
 
 # Route to update IMGENABLED (POST request)
@@ -2491,62 +4974,212 @@ def update_reordering():
 @admin_required
 def update_images():
     images = request.form.get('images', 'true').strip()
-    set_key(dotenv_path, "IMGENABLED", images)
+    settings.set("IMGENABLED", images)
     return redirect(url_for('setup_advanced'))
 
-@app.route('/rundl')
-def run_script():
-    try:
-        # Call the function and get the number of removed gift ideas
-        removed_count = delete_old_gift_ideas()
 
-        # Prepare the output message
-        script_output = f"Successfully removed {removed_count} gift ideas."
+class HeadImageParser(HTMLParser):
+    """Collects the preview image candidates of a page from the meta/link tags of its <head>.
+
+    Parsing stops at </head> (or the first <body> tag), and as soon as an
+    og:image is found since nothing can take precedence over it.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.og_image = None
+        self.twitter_image = None
+        self.image_src = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if tag == 'meta':
+            content = attrs.get('content')
+            if content and self.og_image is None and attrs.get('property') == 'og:image':
+                self.og_image = content
+                self.done = True
+            elif content and self.twitter_image is None and attrs.get('name') == 'twitter:image':
+                self.twitter_image = content
+        elif tag == 'link':
+            href = attrs.get('href')
+            if href and self.image_src is None and 'image_src' in (attrs.get('rel') or '').split():
+                self.image_src = href
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+    @property
+    def image_url(self):
+        # og:image first, then twitter:image, then image_src
+        return self.og_image or self.twitter_image or self.image_src
+
+
+def extract_og_image(url, max_bytes=512 * 1024, chunk_size=16 * 1024):
+    """Fetch url and return its og:image (or twitter:image/image_src) URL, None if it has none
+
+    The page is streamed and parsed incrementally; reading stops at the end of
+    <head> or after max_bytes, so large pages are never downloaded in full.
+    """
+    with og_http_client.stream('GET', url, verify=False) as response:
+        response.raise_for_status()  # Raise an error for bad status codes
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        parser = HeadImageParser()
+        received = 0
+        for chunk in og_http_client.iter_body(response, chunk_size=chunk_size):
+            received += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.done or received >= max_bytes:
+                break
+        parser.close()
 
-        # Return the output to the user
-        return render_template('script_output.html', script_output=script_output)
+    image_url = parser.image_url
+    if image_url is None:
+        return None  # No image found
+    # Convert relative URL to absolute URL if necessary
+    if not image_url.startswith('http'):
+        image_url = urljoin(url, image_url)
+    return image_url
+
+
+class OgImageCache:
+    """LRU cache of page URL -> OG image URL with per-entry expiry, persisted to a JSON file.
+
+    Pages without an image are cached too (for negative_ttl), failed fetches
+    only for error_ttl. Concurrent lookups of the same URL wait for a single
+    fetch instead of each fetching the page. The file is merged with what
+    other workers saved and rewritten at most every save_interval seconds,
+    under its own lock file so it never waits for a data commit.
+    """
+
+    def __init__(self, path, lock_path, max_entries=1000, ttl=7 * 86400, negative_ttl=3600, error_ttl=60, save_interval=10):
+        self.path = Path(path)
+        self.file_lock = ProcessFileLock(lock_path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # The file lock is shared by the threads of a process
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        with self._lock:
+            self._merge(self._read())
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Error reading OG image cache: {e}")
+            return {}
+
+    def _merge(self, entries):
+        # Known URLs keep their place in the LRU order and the entry that lives
+        # longest. URLs only found in the file (saved in their writer's LRU
+        # order) go in as the least recently used ones.
+        now = time.time()
+        added = []
+        for url, (image_url, expires_at) in entries.items():
+            if expires_at <= now:
+                continue
+            current = self._entries.get(url)
+            if current is None:
+                added.append((url, (image_url, expires_at)))
+            elif current[1] < expires_at:
+                self._entries[url] = (image_url, expires_at)
+        for url, entry in reversed(added):
+            self._entries[url] = entry
+            self._entries.move_to_end(url, last=False)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        try:
+            with self._save_lock, self.file_lock:
+                stored = self._read()
+                with self._lock:
+                    self._merge(stored)
+                    document = dict(self._entries)
+                atomic_write_json(self.path, document)
+        except OSError as e:
+            print(f"Error saving OG image cache: {e}")
+
+    def compact(self):
+        """Drop expired entries and rewrite the file, return how many were dropped."""
+        now = time.time()
+        with self._lock:
+            expired = [url for url, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for url in expired:
+                del self._entries[url]
+            self._dirty = True
+        self.save()
+        return len(expired)
+
+    def lookup(self, url, fetch):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(url)
+                self.hits += 1
+                return entry[0]
+            flight = self._inflight.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[url] = {'done': threading.Event(), 'result': None}
+                self.misses += 1
+            else:
+                self.hits += 1
 
-    except Exception as e:
-        error_message = f"Error occurred while running delete_old_gift_ideas: {e}\n\n"
-        return render_template('script_output.html', script_output=error_message)
-    
+        if not leader:
+            flight['done'].wait()
+            return flight['result']
 
+        image_url, ttl = None, self.error_ttl
+        try:
+            image_url = fetch(url)
+            ttl = self.ttl if image_url else self.negative_ttl
+        except Exception as e:
+            print(f"Error fetching OG image: {e}")
+        finally:
+            with self._lock:
+                self._entries[url] = (image_url, time.time() + ttl)
+                self._entries.move_to_end(url)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                self._dirty = True
+                save_due = time.monotonic() - self._saved_at >= self.save_interval
+                flight['result'] = image_url
+                del self._inflight[url]
+            flight['done'].set()
+        if save_due:
+            self.save()
+        return image_url
+
+
+og_image_cache = OgImageCache(app.config['OG_CACHE_FILE'], app.config['OG_CACHE_LOCK_FILE'], max_entries=settings.get_int('OG_CACHE_SIZE', 1000))
+atexit.register(og_image_cache.save)
 
 def fetch_og_image(url):
-    try:
-        response = requests.get(url, verify=False)
-        response.raise_for_status()  # Raise an error for bad status codes
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Try to get the og:image tag
-        og_image = soup.find('meta', property='og:image')
-        if og_image:
-            image_url = og_image.get('content')
-            # Convert relative URL to absolute URL if necessary
-            if not image_url.startswith('http'):
-                image_url = urljoin(url, image_url)
-            return image_url
-
-        # Fallback to twitter:image if og:image is not found
-        twitter_image = soup.find('meta', attrs={'name': 'twitter:image'})
-        if twitter_image:
-            image_url = twitter_image.get('content')
-            if not image_url.startswith('http'):
-                image_url = urljoin(url, image_url)
-            return image_url
-
-        # Fallback to image_src if og:image and twitter:image are not found
-        image_src = soup.find('link', rel='image_src')
-        if image_src:
-            image_url = image_src.get('href')
-            if not image_url.startswith('http'):
-                image_url = urljoin(url, image_url)
-            return image_url
-
-        return None  # No image found
-    except Exception as e:
-        print(f"Error fetching OG image: {e}")
-        return None
+    return og_image_cache.lookup(url, extract_og_image)
 
 @app.route('/fetch_og_image', methods=['GET'])
 def get_og_image():
@@ -2574,32 +5207,40 @@ def manage_guest_users():
         base_username = "guest_" + display_name.lower().replace(' ', '_').replace("'", "")
         username = base_username
         counter = 1
+
+        # Hash outside the transaction, the KDF must not hold up other requests
+        hashed = password_hash(password)
+        lookup_tag = guest_lookup_tag(password)
         
-        # Ensure unique username
-        while any(user['username'] == username for user in users):
-            username = f"{base_username}_{counter}"
-            counter += 1
-        
-        # Create guest user
-        new_guest = {
-            "username": username,
-            "password": password_hash(password),
-            "full_name": display_name,
-            "admin": False,
-            "guest": True,
-            "access_type": access_type,
-            "groups": [],
-            "access_users": []
-        }
-        
-        # Set access based on type
-        if access_type == 'family':
-            new_guest['groups'] = request.form.getlist('access_groups')
-        else:  # people access
-            new_guest['access_users'] = request.form.getlist('access_users')
-        
-        users.append(new_guest)
-        save_users(users)
+        with store.transaction():
+            users = load_users()
+
+            # Ensure unique username
+            while any(user['username'] == username for user in users):
+                username = f"{base_username}_{counter}"
+                counter += 1
+
+            # Create guest user
+            new_guest = {
+                "username": username,
+                "password": hashed,
+                "guest_lookup_tag": lookup_tag,
+                "full_name": display_name,
+                "admin": False,
+                "guest": True,
+                "access_type": access_type,
+                "groups": [],
+                "access_users": []
+            }
+
+            # Set access based on type
+            if access_type == 'family':
+                new_guest['groups'] = request.form.getlist('access_groups')
+            else:  # people access
+                new_guest['access_users'] = request.form.getlist('access_users')
+
+            users.append(new_guest)
+            save_users(users)
         flash('Guest user created successfully!', 'success')
         return redirect(url_for('manage_guest_users'))
     
@@ -2624,34 +5265,35 @@ def manage_guest_users():
 @app.route('/delete_guest_user/<path:username>', methods=['POST'])
 @admin_required
 def delete_guest_user(username):
-    users = load_users()
-    gift_ideas_data = load_gift_ideas()
-    
-    # Find the guest user before deleting to get their details
-    guest_user = next((user for user in users if user['username'] == username), None)
-    
-    if guest_user:
-        # 1. Remove the guest user
-        users = [user for user in users if user['username'] != username]
-        
-        # 2. Delete entirely the gift ideas that were bought by this guest
-        updated_gift_ideas = []
-        deleted_count = 0
-        
-        for idea in gift_ideas_data:
-            if idea.get('bought_by') == username:
-                # Skip adding this idea to the updated list (effectively deleting it)
-                deleted_count += 1
-                continue
-            updated_gift_ideas.append(idea)
-        
-        # Save both updated datasets
-        save_users(users)
-        save_gift_ideas(updated_gift_ideas)
-        
-        flash(f'Guest user {username} deleted successfully! {deleted_count} purchased gift ideas deleted.', 'success')
-    else:
-        flash('Guest user not found.', 'danger')
+    with store.transaction():
+        users = load_users()
+        gift_ideas_data = load_gift_ideas()
+
+        # Find the guest user before deleting to get their details
+        guest_user = next((user for user in users if user['username'] == username), None)
+
+        if guest_user:
+            # 1. Remove the guest user
+            users = [user for user in users if user['username'] != username]
+
+            # 2. Delete entirely the gift ideas that were bought by this guest
+            updated_gift_ideas = []
+            deleted_count = 0
+
+            for idea in gift_ideas_data:
+                if idea.get('bought_by') == username:
+                    # Skip adding this idea to the updated list (effectively deleting it)
+                    deleted_count += 1
+                    continue
+                updated_gift_ideas.append(idea)
+
+            # Save both updated datasets
+            save_users(users)
+            save_gift_ideas(updated_gift_ideas)
+
+            flash(f'Guest user {username} deleted successfully! {deleted_count} purchased gift ideas deleted.', 'success')
+        else:
+            flash('Guest user not found.', 'danger')
     
     return redirect(url_for('manage_guest_users'))
 
@@ -2659,15 +5301,36 @@ def delete_guest_user(username):
 @app.route('/guest_login', methods=['POST'])
 def guest_login():
     password = request.form['password']
+
+    # Reject excess attempts before spending any time on password hashing
+    retry_after = login_throttle.check(request.remote_addr)
+    if retry_after:
+        flash(f'Too many login attempts, please try again in {retry_after} seconds.', 'login_error')
+        return redirect(url_for('login'))
+
+    tag = guest_lookup_tag(password)
+    index = guest_login_index()
     
-    users = load_users()
+    # Look for the guest user with this password's lookup tag, normally a single argon2 verify
+    guest = next((user for user in index.by_tag.get(tag, []) if verify_password(user['password'], password)), None)
+    if guest is None and index.untagged:
+        # Guests created before lookup tags existed are tried one by one, and get their tag now
+        guest = next((user for user in index.untagged if verify_password(user['password'], password)), None)
+        if guest is not None:
+            with store.transaction():
+                users = load_users()
+                for user in users:
+                    if user['username'] == guest['username']:
+                        user['guest_lookup_tag'] = tag
+                save_users(users)
+    elif guest is None and not index.by_tag.get(tag):
+        burn_password_verification(password)
     
-    # Look for a guest user with matching password
-    for user in users:
-        if user.get('guest') and verify_password(user['password'], password):
-            session['username'] = user['username']
-            flash('Guest login successful!', 'login_success')
-            return redirect(url_for('dashboard'))
+    if guest is not None:
+        rehash_password_if_needed(guest['username'], guest['password'], password)
+        session['username'] = guest['username']
+        flash('Guest login successful!', 'login_success')
+        return redirect(url_for('dashboard'))
     
     flash('Invalid guest password', 'login_error')
     return redirect(url_for('login'))
@@ -2688,10 +5351,10 @@ def update_currency_settings():
     symbol = request.form.get('currency_symbol', '$')
     position = request.form.get('currency_position', 'before')
     
-    set_key(dotenv_path, "CURRENCY_SYMBOL", symbol)
-    set_key(dotenv_path, "CURRENCY_POSITION", position)
+    settings.set("CURRENCY_SYMBOL", symbol)
+    settings.set("CURRENCY_POSITION", position)
     
-    flash('Currency settings updated! Please restart to see changes', 'success')
+    flash('Currency settings updated!', 'success')
     return redirect(url_for('setup_advanced'))
 
 @app.route('/update_self_registration_settings', methods=['POST'])
@@ -2701,8 +5364,8 @@ def update_self_registration_settings():
     enable_self_registration = request.form.get('enable_self_registration', 'false')
     joining_code = request.form.get('joining_code', '')
     
-    set_key(dotenv_path, "ENABLE_SELF_REGISTRATION", enable_self_registration)
-    set_key(dotenv_path, "JOINING_CODE", joining_code)
+    settings.set("ENABLE_SELF_REGISTRATION", enable_self_registration)
+    settings.set("JOINING_CODE", joining_code)
     
     flash('Self-registration settings updated successfully!', 'success')
     return redirect(url_for('setup_advanced'))
@@ -2729,39 +5392,35 @@ def manage_shared_lists():
         username = base_username
         counter = 1
         
-        while any(user['username'] == username for user in users):
-            username = f"{base_username}_{counter}"
-            counter += 1
-        
-        # Create shared list user
-        shared_list_user = {
-            "username": username,
-            "full_name": list_name,
-            "admin": False,
-            "guest": False,
-            "shared_list": True,
-            "list_owner": session['username'],
-            "list_members": members + [session['username']],  # Include creator
-            "avatar": avatar  # Add the selected avatar
-        }
-        
-        users.append(shared_list_user)
-        save_users(users)
+        with store.transaction():
+            users = load_users()
+
+            while any(user['username'] == username for user in users):
+                username = f"{base_username}_{counter}"
+                counter += 1
+
+            # Create shared list user
+            shared_list_user = {
+                "username": username,
+                "full_name": list_name,
+                "admin": False,
+                "guest": False,
+                "shared_list": True,
+                "list_owner": session['username'],
+                "list_members": members + [session['username']],  # Include creator
+                "avatar": avatar  # Add the selected avatar
+            }
+
+            users.append(shared_list_user)
+            save_users(users)
         flash(f'Shared list "{list_name}" created successfully!', 'success')
         return redirect(url_for('manage_shared_lists'))
     
     # Get available users for creating new lists
-    current_user_data = next((user for user in users if user["username"] == session['username']), None)
-    current_user_groups = current_user_data.get("groups", [])
-    
-    if not current_user_groups:
-        available_users = [user for user in users if not user.get('guest') and not user.get('shared_list')]
-    else:
-        available_users = [
-            user for user in users 
-            if (not user.get("groups") or any(group in current_user_groups for group in user.get("groups", [])))
-            and not user.get('guest') and not user.get('shared_list')
-        ]
+    available_users = [
+        user for user in visibility_index().visible_users(session['username'])
+        if not user.get('shared_list')
+    ]
     
     # Get existing shared lists for management
     shared_lists = [
@@ -2777,28 +5436,29 @@ def manage_shared_lists():
 @app.route('/delete_shared_list/<path:list_username>', methods=['POST'])
 @login_required
 def delete_shared_list(list_username):
-    users = load_users()
-    gift_ideas = load_gift_ideas()
-    
-    # Find the shared list
-    shared_list = next((user for user in users if user['username'] == list_username), None)
-    
-    if not shared_list:
-        flash('Shared list not found.', 'danger')
-        return redirect(url_for('manage_shared_lists'))
-    
-    # Check if current user is the owner
-    if shared_list.get('list_owner') != session['username']:
-        flash('Only the list owner can delete this shared list.', 'danger')
-        return redirect(url_for('manage_shared_lists'))
-    
-    # Remove shared list user
-    users = [user for user in users if user['username'] != list_username]
-    save_users(users)
-    
-    # Remove all ideas associated with this shared list
-    updated_gift_ideas = [idea for idea in gift_ideas if idea['user_id'] != list_username]
-    save_gift_ideas(updated_gift_ideas)
+    with store.transaction():
+        users = load_users()
+        gift_ideas = load_gift_ideas()
+
+        # Find the shared list
+        shared_list = next((user for user in users if user['username'] == list_username), None)
+
+        if not shared_list:
+            flash('Shared list not found.', 'danger')
+            return redirect(url_for('manage_shared_lists'))
+
+        # Check if current user is the owner
+        if shared_list.get('list_owner') != session['username']:
+            flash('Only the list owner can delete this shared list.', 'danger')
+            return redirect(url_for('manage_shared_lists'))
+
+        # Remove shared list user
+        users = [user for user in users if user['username'] != list_username]
+        save_users(users)
+
+        # Remove all ideas associated with this shared list
+        updated_gift_ideas = [idea for idea in gift_ideas if idea['user_id'] != list_username]
+        save_gift_ideas(updated_gift_ideas)
     
     flash(f'Shared list "{shared_list["full_name"]}" deleted successfully!', 'success')
     return redirect(url_for('manage_shared_lists'))
@@ -2806,31 +5466,75 @@ def delete_shared_list(list_username):
 @app.route('/edit_shared_list_members/<path:list_username>', methods=['POST'])
 @login_required
 def edit_shared_list_members(list_username):
-    users = load_users()
-    
-    # Find the shared list
-    shared_list = next((user for user in users if user['username'] == list_username), None)
-    
-    if not shared_list:
-        flash('Shared list not found.', 'danger')
-        return redirect(url_for('manage_shared_lists'))
+    with store.transaction():
+        users = load_users()
+
+        # Find the shared list
+        shared_list = next((user for user in users if user['username'] == list_username), None)
+
+        if not shared_list:
+            flash('Shared list not found.', 'danger')
+            return redirect(url_for('manage_shared_lists'))
+
+        # Check if current user is the owner
+        if shared_list.get('list_owner') != session['username']:
+            flash('Only the list owner can edit members.', 'danger')
+            return redirect(url_for('manage_shared_lists'))
+
+        # Get selected members and always include the owner
+        new_members = request.form.getlist('members')
+        if session['username'] not in new_members:
+            new_members.append(session['username'])
+
+        # Update the shared list members
+        shared_list['list_members'] = new_members
+        save_users(users)
     
-    # Check if current user is the owner
-    if shared_list.get('list_owner') != session['username']:
-        flash('Only the list owner can edit members.', 'danger')
-        return redirect(url_for('manage_shared_lists'))
+    flash(f'Members updated for "{shared_list["full_name"]}"!', 'success')
+    return redirect(url_for('manage_shared_lists'))
+
+
+@app.route('/update_login_throttle', methods=['POST'])
+@admin_required
+def update_login_throttle():
+    """Update login attempt throttling settings"""
+    enable_login_throttle = request.form.get('enable_login_throttle', 'false').lower() == 'true'
+    try:
+        ip_attempts = max(1, int(request.form.get('ip_attempts', 20)))
+        user_attempts = max(1, int(request.form.get('user_attempts', 5)))
+    except ValueError:
+        flash('Login attempt limits must be whole numbers.', 'danger')
+        return redirect(url_for('setup_advanced'))
     
-    # Get selected members and always include the owner
-    new_members = request.form.getlist('members')
-    if session['username'] not in new_members:
-        new_members.append(session['username'])
+    settings.set("LOGIN_THROTTLE", str(enable_login_throttle).lower())
+    settings.set("LOGIN_IP_ATTEMPTS_PER_MINUTE", ip_attempts)
+    settings.set("LOGIN_USER_ATTEMPTS_PER_MINUTE", user_attempts)
     
-    # Update the shared list members
-    shared_list['list_members'] = new_members
-    save_users(users)
+    flash('Login throttling settings updated!', 'success')
+    return redirect(url_for('setup_advanced'))
+
+
+@app.route('/calibrate_password_hashing', methods=['POST'])
+@admin_required
+def calibrate_password_hashing():
+    """Benchmark argon2 on this machine and store parameters that fit the latency budget"""
+    try:
+        budget_ms = max(10, int(request.form.get('budget_ms', 250)))
+    except ValueError:
+        flash('The latency budget must be a whole number of milliseconds.', 'danger')
+        return redirect(url_for('setup_advanced'))
     
-    flash(f'Members updated for "{shared_list["full_name"]}"!', 'success')
-    return redirect(url_for('manage_shared_lists'))
+    # Benchmarking is KDF work like a sign-in, it counts against the same limit
+    params, measured, within_budget = hashing_pool.run(apply_password_hasher_calibration, budget_ms)
+    if not within_budget:
+        flash(f"A {budget_ms} ms budget is unattainable on this server: even the minimum argon2 costs "
+              f"(time cost {ARGON2_MIN_TIME_COST}, memory {ARGON2_MIN_MEMORY_COST // 1024} MiB) take {measured:.0f} ms per hash. "
+              "These minimum costs are used now.", 'warning')
+    else:
+        flash(f"Password hashing calibrated: time cost {params['ARGON2_TIME_COST']}, "
+              f"memory {params['ARGON2_MEMORY_COST'] // 1024} MiB, {measured:.0f} ms per hash. "
+              "Existing passwords are upgraded at their next login.", 'success')
+    return redirect(url_for('setup_advanced'))
 
 
 @app.route('/update_link_sharing', methods=['POST'])
@@ -2839,7 +5543,7 @@ def update_link_sharing():
     """Update global link sharing setting"""
     enable_link_sharing = request.form.get('enable_link_sharing', 'false').lower() == 'true'
     
-    set_key(dotenv_path, "ENABLE_LINK_SHARING", str(enable_link_sharing).lower())
+    settings.set("ENABLE_LINK_SHARING", str(enable_link_sharing).lower())
     
     flash('Link sharing settings updated!', 'success')
     return redirect(url_for('setup_advanced'))
@@ -2852,7 +5556,7 @@ def generate_share_token():
 @login_required
 def manage_sharing():
 
-    if not read_env_variable('ENABLE_LINK_SHARING', 'true').lower() == 'true':
+    if not settings.get_bool('ENABLE_LINK_SHARING', True):
         flash('Link sharing feature is currently disabled by administrator.', 'danger')
         return redirect(url_for('dashboard'))
 
@@ -2889,61 +5593,71 @@ def manage_sharing():
         target_entity['sharing'] = {'public_links': []}
     
     if request.method == 'POST':
-        # Create new share link
-        if 'create_link' in request.form:
-            link_name = request.form.get('link_name', 'My Gift List')
-            days_valid = int(request.form.get('days_valid', 30))
-            allow_purchases = request.form.get('allow_purchases', 'false') == 'true'
-            
-            new_link = {
-                'token': generate_share_token(),
-                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'expires_at': (datetime.now() + timedelta(days=days_valid)).strftime('%Y-%m-%d %H:%M:%S'),
-                'is_active': True,
-                'name': link_name,
-                'created_by': session['username'],
-                'allow_purchases': allow_purchases,  # New field
-                'visitor_purchases': []  # Track visitor purchases
-            }
-            
-            target_entity['sharing']['public_links'].append(new_link)
-            save_users(users)
-            flash('New share link created!', 'success')
-        
-        # Toggle link status
-        elif 'toggle_link' in request.form:
-            token = request.form['token']
-            for link in target_entity['sharing']['public_links']:
-                if link['token'] == token:
-                    link['is_active'] = not link['is_active']
-                    save_users(users)
-                    status = "activated" if link['is_active'] else "deactivated"
-                    flash(f'Share link {status}!', 'success')
-                    break
-        
-        # Extend expiration date
-        elif 'extend_link' in request.form:
-            token = request.form['token']
-            additional_days = int(request.form.get('additional_days', 30))
-            
-            for link in target_entity['sharing']['public_links']:
-                if link['token'] == token:
-                    current_expiry = datetime.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S')
-                    new_expiry = current_expiry + timedelta(days=additional_days)
-                    link['expires_at'] = new_expiry.strftime('%Y-%m-%d %H:%M:%S')
-                    save_users(users)
-                    flash(f'Share link extended by {additional_days} days! New expiry: {new_expiry.strftime("%Y-%m-%d")}', 'success')
-                    break
-        
-        # Delete link
-        elif 'delete_link' in request.form:
-            token = request.form['token']
-            target_entity['sharing']['public_links'] = [
-                link for link in target_entity['sharing']['public_links'] 
-                if link['token'] != token
-            ]
-            save_users(users)
-            flash('Share link deleted!', 'success')
+        with store.transaction():
+            # Apply the change to the latest version of the target
+            users = load_users()
+            target_entity = next((user for user in users if user['username'] == target_username), None)
+            if not target_entity:
+                flash('Target not found', 'danger')
+                return redirect(url_for('dashboard'))
+            if 'sharing' not in target_entity:
+                target_entity['sharing'] = {'public_links': []}
+
+            # Create new share link
+            if 'create_link' in request.form:
+                link_name = request.form.get('link_name', 'My Gift List')
+                days_valid = int(request.form.get('days_valid', 30))
+                allow_purchases = request.form.get('allow_purchases', 'false') == 'true'
+
+                new_link = {
+                    'token': generate_share_token(),
+                    'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'expires_at': (datetime.now() + timedelta(days=days_valid)).strftime('%Y-%m-%d %H:%M:%S'),
+                    'is_active': True,
+                    'name': link_name,
+                    'created_by': session['username'],
+                    'allow_purchases': allow_purchases,  # New field
+                    'visitor_purchases': []  # Track visitor purchases
+                }
+
+                target_entity['sharing']['public_links'].append(new_link)
+                save_users(users)
+                flash('New share link created!', 'success')
+
+            # Toggle link status
+            elif 'toggle_link' in request.form:
+                token = request.form['token']
+                for link in target_entity['sharing']['public_links']:
+                    if link['token'] == token:
+                        link['is_active'] = not link['is_active']
+                        save_users(users)
+                        status = "activated" if link['is_active'] else "deactivated"
+                        flash(f'Share link {status}!', 'success')
+                        break
+
+            # Extend expiration date
+            elif 'extend_link' in request.form:
+                token = request.form['token']
+                additional_days = int(request.form.get('additional_days', 30))
+
+                for link in target_entity['sharing']['public_links']:
+                    if link['token'] == token:
+                        current_expiry = datetime.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S')
+                        new_expiry = current_expiry + timedelta(days=additional_days)
+                        link['expires_at'] = new_expiry.strftime('%Y-%m-%d %H:%M:%S')
+                        save_users(users)
+                        flash(f'Share link extended by {additional_days} days! New expiry: {new_expiry.strftime("%Y-%m-%d")}', 'success')
+                        break
+
+            # Delete link
+            elif 'delete_link' in request.form:
+                token = request.form['token']
+                target_entity['sharing']['public_links'] = [
+                    link for link in target_entity['sharing']['public_links'] 
+                    if link['token'] != token
+                ]
+                save_users(users)
+                flash('Share link deleted!', 'success')
     
     # Get all shared lists where current user is a member (for navigation)
     user_shared_lists = [
@@ -2962,51 +5676,27 @@ def manage_sharing():
 def shared_list(token):
 
 
-    if not read_env_variable('ENABLE_LINK_SHARING', 'true').lower() == 'true':
+    if not settings.get_bool('ENABLE_LINK_SHARING', True):
         return render_template('shared_list_expired.html'), 404
 
 
     """Public view of a shared gift list or individual user list"""
-    users = load_users()
-    gift_ideas_data = load_gift_ideas()
-    
     # Find the entity (user or shared list) that owns this share token
-    share_owner = None
-    active_link = None
-    is_expired = False
-    
-    for user in users:
-        if 'sharing' in user and 'public_links' in user['sharing']:
-            for link in user['sharing']['public_links']:
-                if link['token'] == token:
-                    # Check if link has expired
-                    expires_at = datetime.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S')
-                    if datetime.now() <= expires_at and link.get('is_active', True):
-                        share_owner = user
-                        active_link = link
-                    else:
-                        share_owner = user
-                        active_link = link
-                        is_expired = True
-                    break
-    
-    if not share_owner or not active_link:
+    share = share_token_index().get(token)
+    if share is None:
         return render_template('shared_list_expired.html'), 404
     
-    if is_expired:
+    # Check if link has expired or was deactivated
+    if not share.is_valid():
         return render_template('shared_list_expired.html'), 410  # 410 Gone
+    share_owner = share.owner
+    active_link = share.link
     
-    # Get gift ideas for the share owner (could be individual user or shared list)
-    user_gift_ideas = [
-        idea for idea in gift_ideas_data 
-        if idea['user_id'] == share_owner['username']
-    ]
-    
-    # Sort by priority
-    user_gift_ideas.sort(key=lambda x: (x.get('priority', float('inf')), x['gift_idea_id']))
+    # Get gift ideas for the share owner (could be individual user or shared list), sorted by priority
+    user_gift_ideas = load_gift_ideas_for(share_owner['username'])
     
     # Get currency formatting for display
-    imgenabled = read_env_variable('IMGENABLED', 'true').lower() == 'true'
+    imgenabled = settings.get_bool('IMGENABLED', True)
     
     return render_template('shared_list_public.html',
                          gift_ideas=user_gift_ideas,
@@ -3019,121 +5709,112 @@ def shared_list(token):
 @app.route('/shared/<token>/mark_bought/<int:idea_id>', methods=['POST'])
 def mark_shared_bought(token, idea_id):
     """Allow visitors to mark items as bought in shared lists"""
-    users = load_users()
-    gift_ideas_data = load_gift_ideas()
-    
-    # Find the share link
-    share_owner = None
-    active_link = None
-    
-    for user in users:
-        if 'sharing' in user and 'public_links' in user['sharing']:
-            for link in user['sharing']['public_links']:
-                if link['token'] == token and link.get('is_active', True):
-                    expires_at = datetime.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S')
-                    if datetime.now() <= expires_at:
-                        share_owner = user
-                        active_link = link
-                    break
-    
-    if not share_owner or not active_link:
-        return jsonify({'error': 'Share link not found or expired'}), 404
-    
-    if not active_link.get('allow_purchases', False):
-        return jsonify({'error': 'Purchases not allowed for this share link'}), 403
-    
-    # Find the gift idea
-    idea = find_idea_by_id(gift_ideas_data, idea_id)
-    if not idea or idea['user_id'] != share_owner['username']:
-        return jsonify({'error': 'Gift idea not found'}), 404
-    
-    # Get visitor name from request
-    visitor_name = request.json.get('visitor_name', '').strip()
-    if not visitor_name:
-        return jsonify({'error': 'Visitor name is required'}), 400
-    
-    # Generate unique visitor ID
-    visitor_id = secrets.token_urlsafe(16)
-    
-    # Mark as bought by visitor
-    if not idea.get('bought_by'):
-        idea['bought_by'] = f"visitor:{visitor_name}"
-        idea['date_bought'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        idea['visitor_id'] = visitor_id
-        
-        # Track visitor purchase
-        if 'visitor_purchases' not in active_link:
-            active_link['visitor_purchases'] = []
-        active_link['visitor_purchases'].append({
-            'idea_id': idea_id,
-            'visitor_name': visitor_name,
-            'visitor_id': visitor_id,
-            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        })
-        
-        save_gift_ideas(gift_ideas_data)
-        save_users(users)
-        
-        return jsonify({
-            'success': True, 
-            'message': 'Item marked as purchased',
-            'visitor_id': visitor_id
-        })
-    else:
-        return jsonify({'error': 'Item already purchased'}), 400
+    with store.transaction():
+        users = load_users()
+        gift_ideas_data = load_gift_ideas()
+
+        # Find the share link
+        share_owner = None
+        active_link = None
+
+        share = share_token_index().get(token)
+        if share is not None and share.is_valid():
+            share_owner, active_link = share.resolve(users)
+
+        if not share_owner or not active_link:
+            return jsonify({'error': 'Share link not found or expired'}), 404
+
+        if not active_link.get('allow_purchases', False):
+            return jsonify({'error': 'Purchases not allowed for this share link'}), 403
+
+        # Find the gift idea
+        idea = find_idea_by_id(gift_ideas_data, idea_id)
+        if not idea or idea['user_id'] != share_owner['username']:
+            return jsonify({'error': 'Gift idea not found'}), 404
+
+        # Get visitor name from request
+        visitor_name = request.json.get('visitor_name', '').strip()
+        if not visitor_name:
+            return jsonify({'error': 'Visitor name is required'}), 400
+
+        # Generate unique visitor ID
+        visitor_id = secrets.token_urlsafe(16)
+
+        # Mark as bought by visitor
+        if not idea.get('bought_by'):
+            idea['bought_by'] = f"visitor:{visitor_name}"
+            record_purchase_time(idea)
+            idea['visitor_id'] = visitor_id
+
+            # Track visitor purchase
+            if 'visitor_purchases' not in active_link:
+                active_link['visitor_purchases'] = []
+            active_link['visitor_purchases'].append({
+                'idea_id': idea_id,
+                'visitor_name': visitor_name,
+                'visitor_id': visitor_id,
+                'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            })
+
+            save_gift_ideas(gift_ideas_data)
+            save_users(users)
+
+            return jsonify({
+                'success': True, 
+                'message': 'Item marked as purchased',
+                'visitor_id': visitor_id
+            })
+        else:
+            return jsonify({'error': 'Item already purchased'}), 400
 
 @app.route('/shared/<token>/mark_not_bought/<int:idea_id>', methods=['POST'])
 def mark_shared_not_bought(token, idea_id):
     """Allow visitors to unmark items as bought"""
-    users = load_users()
-    gift_ideas_data = load_gift_ideas()
-    
-    # Find the share link
-    share_owner = None
-    active_link = None
-    
-    for user in users:
-        if 'sharing' in user and 'public_links' in user['sharing']:
-            for link in user['sharing']['public_links']:
-                if link['token'] == token and link.get('is_active', True):
-                    expires_at = datetime.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S')
-                    if datetime.now() <= expires_at:
-                        share_owner = user
-                        active_link = link
-                    break
-    
-    if not share_owner or not active_link:
-        return jsonify({'error': 'Share link not found or expired'}), 404
-    
-    # Find the gift idea
-    idea = find_idea_by_id(gift_ideas_data, idea_id)
-    if not idea or idea['user_id'] != share_owner['username']:
-        return jsonify({'error': 'Gift idea not found'}), 404
-    
-    # Get visitor ID from request
-    visitor_id = request.json.get('visitor_id')
-    if not visitor_id:
-        return jsonify({'error': 'Visitor ID required'}), 400
-    
-    # Check if this visitor made the purchase
-    if idea.get('bought_by', '').startswith('visitor:') and idea.get('visitor_id') == visitor_id:
-        idea['bought_by'] = None
-        idea.pop('date_bought', None)
-        idea.pop('visitor_id', None)
-        
-        # Remove from visitor purchases tracking
-        if 'visitor_purchases' in active_link:
-            active_link['visitor_purchases'] = [
-                purchase for purchase in active_link['visitor_purchases']
-                if purchase['idea_id'] != idea_id
-            ]
-        
-        save_gift_ideas(gift_ideas_data)
-        save_users(users)
-        
-        return jsonify({'success': True, 'message': 'Purchase cancelled'})
-    else:
-        return jsonify({'error': 'You can only cancel your own purchases'}), 403
+    with store.transaction():
+        users = load_users()
+        gift_ideas_data = load_gift_ideas()
+
+        # Find the share link
+        share_owner = None
+        active_link = None
+
+        share = share_token_index().get(token)
+        if share is not None and share.is_valid():
+            share_owner, active_link = share.resolve(users)
+
+        if not share_owner or not active_link:
+            return jsonify({'error': 'Share link not found or expired'}), 404
+
+        # Find the gift idea
+        idea = find_idea_by_id(gift_ideas_data, idea_id)
+        if not idea or idea['user_id'] != share_owner['username']:
+            return jsonify({'error': 'Gift idea not found'}), 404
+
+        # Get visitor ID from request
+        visitor_id = request.json.get('visitor_id')
+        if not visitor_id:
+            return jsonify({'error': 'Visitor ID required'}), 400
+
+        # Check if this visitor made the purchase
+        if idea.get('bought_by', '').startswith('visitor:') and idea.get('visitor_id') == visitor_id:
+            idea['bought_by'] = None
+            idea.pop('date_bought', None)
+            idea.pop('bought_at', None)
+            idea.pop('visitor_id', None)
+
+            # Remove from visitor purchases tracking
+            if 'visitor_purchases' in active_link:
+                active_link['visitor_purchases'] = [
+                    purchase for purchase in active_link['visitor_purchases']
+                    if purchase['idea_id'] != idea_id
+                ]
+
+            save_gift_ideas(gift_ideas_data)
+            save_users(users)
+
+            return jsonify({'success': True, 'message': 'Purchase cancelled'})
+        else:
+            return jsonify({'error': 'You can only cancel your own purchases'}), 403
     
 def generate_share_url(token):
     """Generate share URL with proper scheme (HTTPS if available)"""
@@ -3144,5 +5825,257 @@ def generate_share_url(token):
     # Generate external URL with proper scheme
     return url_for("shared_list", token=token, _external=True, _scheme=scheme)
 
+# Delta sync API
+SYNC_USER_FIELDS = ('username', 'full_name', 'avatar', 'birthday', 'shared_list')
+PURCHASE_FIELDS = ('bought_by', 'date_bought', 'bought_at', 'bought_anonymously')
+
+def sync_idea(idea, viewer, visible, hide_purchaser):
+    """Return idea the way viewer may see it, or None if it is not on a list they can see."""
+    recipient = idea.get('user_id')
+    if recipient == viewer:
+        # Their own list: only what they added themselves, and never whether it was bought
+        if idea.get('added_by') != viewer:
+            return None
+        idea = {key: value for key, value in idea.items() if key not in PURCHASE_FIELDS}
+    elif recipient not in visible:
+        return None
+    else:
+        idea = hide_purchaser_details(dict(idea), viewer, hide_purchaser)
+    idea.pop('visitor_id', None)
+    return idea
+
+@app.route('/api/changes')
+@login_required
+@guest_allowed
+def api_changes():
+    """Ideas and users changed since the cursor returned by the previous call.
+
+    Without a cursor, or when the cursor is too old or the users the caller
+    can see have changed, everything is returned with "reset": true.
+    Otherwise only changed records are returned, with the IDs and usernames
+    the client should drop in deleted_ideas/deleted_users.
+    """
+    viewer = current_identity().username
+    hide_purchaser = read_env_variable('HIDE_PURCHASER', 'user_choice')
+    visible_users = visibility_index().visible_users(viewer)
+    visible = {user['username'] for user in visible_users}
+
+    # The cursor also covers what the caller can see, a change there needs a full reload
+    view_key = hashlib.sha1(json.dumps([viewer, sorted(visible), hide_purchaser]).encode()).hexdigest()[:12]
+    data_version, _, cursor_view = request.args.get('since', '').partition('.')
+    version, changes = store.changes_since(data_version if data_version and cursor_view == view_key else None)
+
+    reset = changes is None
+    if reset:
+        # Loaded after the version was taken, so nothing is missed; a later call may repeat some records
+        changes = {'ideas': (load_gift_ideas(), []), 'users': (load_users(), [])}
+
+    ideas, deleted_ideas = [], list(changes['ideas'][1])
+    for idea in changes['ideas'][0]:
+        synced = sync_idea(idea, viewer, visible, hide_purchaser)
+        if synced is not None:
+            ideas.append(synced)
+        elif not reset:
+            # May have moved out of sight
+            deleted_ideas.append(idea['gift_idea_id'])
+
+    users, deleted_users = [], list(changes['users'][1])
+    for user in changes['users'][0]:
+        if user['username'] in visible or user['username'] == viewer:
+            users.append({field: user.get(field) for field in SYNC_USER_FIELDS})
+        elif not reset:
+            deleted_users.append(user['username'])
+
+    return jsonify({
+        'cursor': f'{version}.{view_key}',
+        'reset': reset,
+        'ideas': ideas,
+        'deleted_ideas': deleted_ideas,
+        'users': users,
+        'deleted_users': deleted_users,
+    })
+
+
+# Background jobs
+class JobScheduler:
+    """Runs maintenance jobs on a background thread of one elected worker process.
+
+    Every process starts the scheduler thread on its first request, so the
+    thread is never inherited through a fork. The thread keeps trying to take
+    a non-blocking flock on lock_path: the process holding it is the leader
+    and runs the jobs that are due, the others take over when it exits.
+    Intervals are read from the settings on every tick, 0 disables a job.
+    The outcome of every run is stored in state_path for all workers to show,
+    and the next run is scheduled from it, also across restarts.
+    """
+
+    def __init__(self, lock_path, state_path, tick=5):
+        self.lock_path = Path(lock_path)
+        self.state_path = Path(state_path)
+        self.tick = tick
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._lock_file = None
+        self._leader = False
+
+    def job(self, name, title, interval_key, default_minutes):
+        """Register the decorated function as a job, its return value is recorded as the result."""
+        def decorator(function):
+            self.jobs[name] = {
+                'name': name,
+                'title': title,
+                'interval_key': interval_key,
+                'default_minutes': default_minutes,
+                'function': function,
+                'lock': threading.Lock(),
+            }
+            return function
+        return decorator
+
+    def interval(self, name):
+        job = self.jobs[name]
+        return max(0, settings.get_int(job['interval_key'], job['default_minutes'])) * 60
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._lock_file is not None:
+                # Inherited from the parent, keeping it open would hold on to the parent's lock
+                self._lock_file.close()
+                self._lock_file = None
+            self._leader = False
+            threading.Thread(target=self._run, name='job-scheduler', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _try_lead(self):
+        if fcntl is None:
+            return True  # No flock, assume a single process
+        if self._leader:
+            return True
+        if self._lock_file is None:
+            self.lock_path.parent.mkdir(exist_ok=True, parents=True)
+            self._lock_file = open(self.lock_path, 'a+')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        self._leader = True
+        print(f"Job scheduler running in process {os.getpid()}")
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                if self._try_lead():
+                    self.run_due_jobs()
+            except Exception as e:
+                print(f"Error in job scheduler: {e}")
+            time.sleep(self.tick)
+
+    def run_due_jobs(self):
+        state = self._read()
+        now = time.time()
+        for name in self.jobs:
+            interval = self.interval(name)
+            if interval == 0:
+                continue
+            last_run = state.get(name, {}).get('started_at')
+            if last_run is None or now - last_run >= interval:
+                self.run(name)
+
+    def run(self, name):
+        """Run a job right away in this thread and record the outcome."""
+        job = self.jobs[name]
+        with job['lock']:
+            started_at = time.time()
+            started = time.perf_counter()
+            result, error = None, None
+            try:
+                result = job['function']()
+            except Exception as e:
+                error = f'{e}'
+                print(f"Job {name} failed: {e}")
+            entry = {
+                'started_at': started_at,
+                'duration_ms': round(1000 * (time.perf_counter() - started), 1),
+                'result': result,
+                'error': error,
+                'pid': os.getpid(),
+            }
+            self._record(name, entry)
+        return entry
+
+    def _read(self):
+        try:
+            with open(self.state_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Error reading job scheduler state: {e}")
+            return {}
+
+    def _record(self, name, entry):
+        with self._file_lock, process_lock:
+            state = self._read()
+            state[name] = entry
+            atomic_write_json(self.state_path, state, indent=2)
+
+    def status(self):
+        state = self._read()
+        jobs = []
+        for name, job in self.jobs.items():
+            entry = state.get(name, {})
+            interval = self.interval(name)
+            started_at = entry.get('started_at')
+            jobs.append({
+                'name': name,
+                'title': job['title'],
+                'interval_minutes': interval // 60,
+                'last_run': datetime.fromtimestamp(started_at).strftime('%Y-%m-%d %H:%M:%S') if started_at else None,
+                'next_run': datetime.fromtimestamp(started_at + interval).strftime('%Y-%m-%d %H:%M:%S') if started_at and interval else None,
+                'duration_ms': entry.get('duration_ms'),
+                'result': entry.get('result'),
+                'error': entry.get('error'),
+            })
+        return jobs
+
+
+scheduler = JobScheduler(app.config['SCHEDULER_LOCK_FILE'], app.config['SCHEDULER_STATE_FILE'])
+
+@app.before_request
+def start_scheduler():
+    scheduler.ensure_started()
+
+@scheduler.job('purge_ideas', 'Archive old bought ideas', 'PURGE_INTERVAL_MINUTES', 1440)
+def purge_ideas_job():
+    return f"Archived {delete_old_gift_ideas()} gift ideas"
+
+@scheduler.job('avatar_gc', 'Delete unused avatars', 'AVATAR_GC_INTERVAL_MINUTES', 60)
+def avatar_gc_job():
+    removed = cleanup_unused_avatars(load_users(), min_age=app.config['AVATAR_CLAIM_TIMEOUT'])
+    return f"Removed {removed} avatars"
+
+@scheduler.job('outbox', 'Send queued emails', 'OUTBOX_INTERVAL_MINUTES', 1)
+def outbox_job():
+    sent, failed = outbox.drain()
+    return f"Sent {sent} emails, {failed} failed"
+
+@scheduler.job('journal_compaction', 'Compact the change journal', 'JOURNAL_COMPACT_INTERVAL_MINUTES', 60)
+def journal_compaction_job():
+    if not isinstance(storage, JournalStorage):
+        return f"Not needed with {storage.name} storage"
+    return f"Folded {storage.compact()} events into the snapshot"
+
+@scheduler.job('cache_compaction', 'Compact caches', 'CACHE_COMPACT_INTERVAL_MINUTES', 60)
+def cache_compaction_job():
+    return f"Dropped {og_image_cache.compact()} expired image previews"
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, debug=True)